@@ -13,9 +13,10 @@ from astropy.io import ascii
 from astropy.stats import sigma_clip
 
 # PYPEIT imports
-from pypeit.core import pydl
 from pypeit import msgs
 
+from legendre2d import Legendre2DFit
+
 def prettyplot():
     # set some plotting parameters
     plt.rcParams["xtick.top"] = True
@@ -108,21 +109,9 @@ def fit2darc(all_wv,
 
     msgs.info("First iteration")
     # all lines have the same weight
-    invvar = np.ones(len(all_wv), dtype=np.float64)
     all_wv_order = all_wv * t
-    work2d = np.zeros((nycoeff*nocoeff, len(all_wv)), dtype=np.float64)
-    worky = pydl.flegendre(pix_nrm, nycoeff)
-    workt = pydl.flegendre(t_nrm, nocoeff)
-    for i in range(nocoeff):
-        for j in range(nycoeff):
-            work2d[j*nocoeff+i,:] = worky[j,:] * workt[i,:]
-    work2di = np.transpose(work2d * np.outer(np.ones(nocoeff*nycoeff,
-                                             dtype=np.float64),
-                                             invvar))
-    alpha = work2d.dot(work2di)
-    beta = all_wv_order.dot(work2di)
-    res = np.linalg.solve(alpha,beta)
-    wv_mod = res.dot(work2d)
+    fit = Legendre2DFit(pix_nrm, t_nrm, all_wv_order, nycoeff, nocoeff)
+    wv_mod = fit.model
     if debug:
         # set some plotting parameters
         prettyplot()
@@ -160,17 +149,11 @@ def fit2darc(all_wv,
     msgs.info("Second iteration")
     # Mask Values
     # msk = True means a bad value
-    msk = sigma_clip(wv_mod-all_wv_order, sigma=sigmarjct, cenfunc=np.ma.mean).mask
-    if np.any(msk):
-        msgs.info("Rejecting: {} of {} lines.".format(len(msk[np.where(msk == True)]),len(msk)))
-        invvar[msk] = 0.
-        work2di = np.transpose(work2d * np.outer(np.ones(nocoeff*nycoeff,
-                                                 dtype=np.float64),
-                                                 invvar))
-        alpha = work2d.dot(work2di)
-        beta = all_wv_order.dot(work2di)
-        res = np.linalg.solve(alpha,beta)
-        wv_mod = res.dot(work2d)
+    # Only the rejected lines are removed from the normal equations
+    if fit.reject(sigrej=sigmarjct):
+        msk = np.logical_not(fit.gpm)
+        msgs.info("Rejecting: {} of {} lines.".format(np.sum(msk),len(msk)))
+        wv_mod = fit.model
         if debug:
             prettyplot()
             plt.figure(figsize=(7,5))
@@ -213,9 +196,8 @@ def fit2darc(all_wv,
         msgs.info("No line rejected")
 
     # Check quality
-    gd_wv = invvar > 0.
-    resid = (wv_mod[gd_wv]-all_wv_order[gd_wv])
-    fin_rms = np.sqrt(np.mean(resid**2))
+    gd_wv = fit.gpm
+    fin_rms = fit.rms
     msgs.info("RMS: {0:.5f} Ang*Order#".format(fin_rms))
 
     # Plot QA
@@ -224,7 +206,6 @@ def fit2darc(all_wv,
 
     all_pix_qa = np.arange(np.min(all_pix),np.max(all_pix),1)
     pix_nrm_qa = 2. * (all_pix_qa - nrmp[0])/nrmp[1]
-    worky_qa = pydl.flegendre(pix_nrm_qa, nycoeff)
     mn, mx = np.min(wv_mod/t), np.max(wv_mod/t)
     order = np.arange(np.min(t),np.max(t)+1,1)
 
@@ -241,12 +222,7 @@ def fit2darc(all_wv,
         bb = (ii-np.min(order))/(np.max(order)-np.min(order))
         tsub = np.ones_like(len(all_pix_qa),dtype=np.float64) * ii
         t_nrm_qa = 2. * (tsub - nrmt[0])/nrmt[1]
-        work2d_qa = np.zeros((nycoeff*nocoeff, len(all_pix_qa)), dtype=np.float64)
-        workt_qa = pydl.flegendre(t_nrm_qa, nocoeff)
-        for i in range(nocoeff):
-            for j in range(nycoeff):
-                work2d_qa[j*nocoeff+i,:] = worky_qa[j,:] * workt_qa[i,:]
-        wv_mod_qa = res.dot(work2d_qa)
+        wv_mod_qa = fit.eval(pix_nrm_qa, t_nrm_qa)
         plt.plot(wv_mod_qa/ii, all_pix_qa,
                  color=(rr,gg,bb), linestyle='-')
         # Residuals
@@ -277,12 +253,7 @@ def fit2darc(all_wv,
                 bb = (ii-np.min(order))/(np.max(order)-np.min(order))
                 tsub = np.ones_like(len(all_pix_qa),dtype=np.float64) * ii
                 t_nrm_qa = 2. * (tsub - nrmt[0])/nrmt[1]
-                work2d_qa = np.zeros((nycoeff*nocoeff, len(all_pix_qa)), dtype=np.float64)
-                workt_qa = pydl.flegendre(t_nrm_qa, nocoeff)
-                for i in range(nocoeff):
-                    for j in range(nycoeff):
-                        work2d_qa[j*nocoeff+i,:] = worky_qa[j,:] * workt_qa[i,:]
-                wv_mod_qa = res.dot(work2d_qa)
+                wv_mod_qa = fit.eval(pix_nrm_qa, t_nrm_qa)
                 ax[ii_row,ii_col].plot(all_pix_qa, wv_mod_qa/ii/10000.,
                                color=(rr,gg,bb), linestyle='-')
                 ax[ii_row,ii_col].set_title('Order = {0:0.0f}'.format(ii))
@@ -12,8 +12,8 @@ from scipy.io import readsav
 from astropy.io import ascii
 from astropy.stats import sigma_clip
 
-# PYPEIT imports
-from pypeit.core import pydl
+# Local imports
+from legendre2d import legendre2d_basis
 
 ###############################################################
 # Porting XIDL code x_fit2darc to python
@@ -153,13 +153,7 @@ nycoeff = 3
 # nocoeff is the order direction. 5 seems to give better rms.
 nocoeff = 5
 
-work2d = np.zeros((nycoeff*nocoeff, np.sum(pixid)), dtype=np.float64)
-worky = pydl.flegendre(pix_nrm_pypeit, nycoeff)
-workt = pydl.flegendre(t_nrm_pypeit, nocoeff)
-
-for i in range(nocoeff):
-    for j in range(nycoeff):
-        work2d[j*nocoeff+i,:] = worky[j,:] * workt[i,:]
+work2d = legendre2d_basis(pix_nrm_pypeit, t_nrm_pypeit, nycoeff, nocoeff).T
 
 
 if debug: 
@@ -0,0 +1,180 @@
+"""
+Weighted least-squares fit of a 2D Legendre polynomial, as used for the 2D wavelength solution of echelle
+spectrographs (x_fit2darc in XIDL).
+
+The tensor-product design matrix of the nycoeff x nocoeff Legendre polynomials is built with a single
+broadcast, and the normal equations are solved by Cholesky factorization. Rejection only downdates the
+normal matrix with the rows whose mask changed, rather than rebuilding it from all of the lines, and
+fit_legendre2d_orders fits many trial (nycoeff, nocoeff) at once from the design and normal matrices of the
+largest of them, e.g. to choose the orders of the fit for X-Shooter, NIRES or GNIRS arcs with thousands of lines.
+"""
+import numpy as np
+import scipy.linalg
+from astropy.stats import sigma_clip
+
+from pypeit import msgs
+
+
+def legendre2d_basis(pix_nrm, t_nrm, nycoeff, nocoeff):
+    """
+    Design matrix of the 2D Legendre polynomial.
+
+    Args:
+        pix_nrm (ndarray): Normalized pixel positions of the lines, shape (nline,).
+        t_nrm (ndarray): Normalized order numbers of the lines, shape (nline,).
+        nycoeff (int): Number of coefficients along the pixel direction.
+        nocoeff (int): Number of coefficients along the order direction.
+
+    Returns:
+        ndarray: Shape (nline, nycoeff*nocoeff). Column j*nocoeff + i is P_j(pix_nrm)*P_i(t_nrm), i.e. the
+        transpose of work2d in x_fit2darc.
+    """
+    worky = np.polynomial.legendre.legvander(np.asarray(pix_nrm, dtype=float), nycoeff - 1)
+    workt = np.polynomial.legendre.legvander(np.asarray(t_nrm, dtype=float), nocoeff - 1)
+    return (worky[:, :, None]*workt[:, None, :]).reshape(worky.shape[0], nycoeff*nocoeff)
+
+
+class Legendre2DFit(object):
+    """
+    Weighted least-squares fit of y with a 2D Legendre polynomial of the pixel position and order number.
+
+    The normal matrix alpha = A^T W A and vector beta = A^T W y are kept, so that changing the mask only needs
+    the rows that were rejected or restored.
+
+    Args:
+        pix_nrm, t_nrm (ndarray): Normalized pixel positions and order numbers of the lines, shape (nline,).
+        y (ndarray): Values to fit, e.g. the wavelength times the order number, shape (nline,).
+        nycoeff, nocoeff (int): Number of coefficients along the pixel and order directions.
+        invvar (ndarray): Inverse variances of y. Lines with invvar <= 0 are never used. Defaults to 1.
+        basis, alpha, beta (ndarray): Precomputed design matrix, normal matrix and vector for invvar, e.g. from
+            fit_legendre2d_orders. They are computed if not given.
+
+    Attributes:
+        coeff (ndarray): Best-fit coefficients, in the column order of legendre2d_basis.
+        model (ndarray): Fitted values at the lines.
+        gpm (ndarray): True for the lines used in the fit.
+    """
+    def __init__(self, pix_nrm, t_nrm, y, nycoeff, nocoeff, invvar=None, basis=None, alpha=None, beta=None):
+        self.nycoeff, self.nocoeff = nycoeff, nocoeff
+        self.y = np.asarray(y, dtype=float)
+        self.invvar = np.ones_like(self.y) if invvar is None else np.asarray(invvar, dtype=float)
+        self.basis = legendre2d_basis(pix_nrm, t_nrm, nycoeff, nocoeff) if basis is None else basis
+        self.gpm = self.invvar > 0.0
+        if alpha is None or beta is None:
+            self._normal_equations()
+        else:
+            self.alpha, self.beta = alpha.copy(), beta.copy()
+        self.solve()
+
+    @property
+    def ncoeff(self):
+        return self.nycoeff*self.nocoeff
+
+    def _normal_equations(self):
+        w = np.where(self.gpm, self.invvar, 0.0)
+        work2di = self.basis*w[:, None]
+        self.alpha = self.basis.T.dot(work2di)
+        self.beta = self.y.dot(work2di)
+
+    def solve(self):
+        """Solve the normal equations for the current mask."""
+        if np.sum(self.gpm) < self.ncoeff:
+            msgs.error('Only {:d} lines left to fit {:d} coefficients'.format(np.sum(self.gpm), self.ncoeff))
+        try:
+            self.coeff = scipy.linalg.cho_solve(scipy.linalg.cho_factor(self.alpha), self.beta)
+        except np.linalg.LinAlgError:
+            # e.g. all of the remaining lines are in too few orders
+            self.coeff = np.linalg.lstsq(self.alpha, self.beta, rcond=None)[0]
+        self.model = self.basis.dot(self.coeff)
+
+    def set_mask(self, gpm):
+        """
+        Refit with a new good pixel mask. The normal equations are downdated with the rows that are rejected and
+        updated with the rows that are restored. If most of the rows change they are recomputed instead, which is
+        cheaper and avoids the round-off of a large downdate.
+        """
+        gpm = np.asarray(gpm, dtype=bool) & (self.invvar > 0.0)
+        changed = gpm != self.gpm
+        nchanged = np.sum(changed)
+        if nchanged == 0:
+            return
+        if nchanged > np.sum(gpm)//2:
+            self.gpm = gpm
+            self._normal_equations()
+        else:
+            # +w for the restored rows and -w for the rejected rows
+            rows = np.where(changed)[0]
+            w = np.where(gpm[rows], 1.0, -1.0)*self.invvar[rows]
+            work2di = self.basis[rows]*w[:, None]
+            self.alpha += self.basis[rows].T.dot(work2di)
+            self.beta += self.y[rows].dot(work2di)
+            self.gpm = gpm
+        self.solve()
+
+    def reject(self, sigrej=3.0):
+        """
+        One round of rejection. As in x_fit2darc, the residuals of all of the lines are sigma clipped, so that
+        previously rejected lines can come back.
+
+        Returns:
+            bool: True if the mask changed.
+        """
+        msk = sigma_clip(self.model - self.y, sigma=sigrej, cenfunc=np.ma.mean).mask
+        gpm = np.logical_not(msk) & (self.invvar > 0.0)
+        if np.array_equal(gpm, self.gpm):
+            return False
+        self.set_mask(gpm)
+        return True
+
+    def iterate(self, sigrej=3.0, maxiter=1):
+        """Reject and refit until the mask does not change, or for maxiter rounds. Returns the number of rounds."""
+        for niter in range(maxiter):
+            if not self.reject(sigrej=sigrej):
+                return niter
+        return maxiter
+
+    @property
+    def rms(self):
+        """RMS of the residuals of the lines used in the fit."""
+        return np.sqrt(np.mean((self.model[self.gpm] - self.y[self.gpm])**2))
+
+    def eval(self, pix_nrm, t_nrm):
+        """Evaluate the fit at normalized pixel positions and order numbers."""
+        pix_nrm, t_nrm = np.broadcast_arrays(np.atleast_1d(pix_nrm), np.atleast_1d(t_nrm))
+        return legendre2d_basis(pix_nrm, t_nrm, self.nycoeff, self.nocoeff).dot(self.coeff)
+
+
+def fit_legendre2d_orders(pix_nrm, t_nrm, y, orders, invvar=None, sigrej=3.0, maxiter=1):
+    """
+    Fit y with 2D Legendre polynomials of several orders, e.g. to choose the orders of the fit.
+
+    The design and normal matrices are only computed for the largest nycoeff and nocoeff. The basis functions of
+    the smaller fits are a subset of those, so their design and normal matrices are sub-blocks of them, and only
+    the rejection iterations are done separately for each fit.
+
+    Args:
+        pix_nrm, t_nrm, y, invvar: See Legendre2DFit.
+        orders (list): (nycoeff, nocoeff) of each fit.
+        sigrej (float): Rejection threshold.
+        maxiter (int): Maximum number of rejection rounds of each fit.
+
+    Returns:
+        dict: The Legendre2DFit of each (nycoeff, nocoeff) in orders.
+    """
+    nymax = max(ny for ny, no in orders)
+    nomax = max(no for ny, no in orders)
+    basis = legendre2d_basis(pix_nrm, t_nrm, nymax, nomax)
+    y = np.asarray(y, dtype=float)
+    invvar = np.ones_like(y) if invvar is None else np.asarray(invvar, dtype=float)
+    work2di = basis*np.where(invvar > 0.0, invvar, 0.0)[:, None]
+    alpha = basis.T.dot(work2di)
+    beta = y.dot(work2di)
+
+    fits = {}
+    for nycoeff, nocoeff in orders:
+        idx = (np.arange(nycoeff)[:, None]*nomax + np.arange(nocoeff)[None, :]).ravel()
+        fit = Legendre2DFit(pix_nrm, t_nrm, y, nycoeff, nocoeff, invvar=invvar, basis=basis[:, idx],
+                            alpha=alpha[np.ix_(idx, idx)], beta=beta[idx])
+        fit.iterate(sigrej=sigrej, maxiter=maxiter)
+        fits[(nycoeff, nocoeff)] = fit
+    return fits
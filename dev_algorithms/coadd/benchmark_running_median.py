@@ -0,0 +1,54 @@
+"""
+Compare running_median with scipy.ndimage.median_filter across window sizes.
+
+Checks that the results are identical and reports the run time of each, for a single long
+spectrum and for a batch of spectra filtered at once.
+
+    python benchmark_running_median.py --nspec 100000 --nbatch 50
+"""
+import time
+import argparse
+
+import numpy as np
+import scipy.ndimage
+
+from running_median import running_median
+
+
+def best_time(func, repeat):
+    """Return the result of func and the fastest of repeat calls to it"""
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nspec', type=int, default=100000, help='Length of each spectrum')
+    parser.add_argument('--nbatch', type=int, default=50, help='Number of spectra in the batched comparison')
+    parser.add_argument('--windows', type=int, nargs='+', default=[5, 11, 51, 101, 501, 1001, 5001],
+                        help='Window sizes to compare')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to repeat each timing')
+    pargs = parser.parse_args()
+
+    rng = np.random.default_rng(1234)
+    sequence = rng.random(pargs.nspec)
+    batch = rng.random((pargs.nbatch, pargs.nspec//10))
+
+    print('{:>8s} {:>8s} {:>14s} {:>14s} {:>8s} {:>9s}'.format(
+        'input', 'window', 'median_filter', 'running_median', 'speedup', 'identical'))
+    for window in pargs.windows:
+        for name, data in [('1d', sequence), ('batch', batch)]:
+            expected, t_scipy = best_time(
+                lambda: scipy.ndimage.median_filter(data, size=(1,)*(data.ndim - 1) + (window,), mode='reflect'),
+                pargs.repeat)
+            result, t_running = best_time(lambda: running_median(data, window), pargs.repeat)
+            print('{:>8s} {:8d} {:13.4f}s {:13.4f}s {:7.1f}x {:>9s}'.format(
+                name, window, t_scipy, t_running, t_scipy/t_running, str(np.array_equal(expected, result))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Benchmark the peak memory use of the in-memory and streaming 1D coadds versus the number of exposures.
+
+Synthetic spec1d files are written to a scratch directory, and each coadd is run in its own process so
+that its peak RSS can be measured. The streaming coadd is checked against combspec run on all of the spectra
+loaded into memory.
+
+    python benchmark_streaming_coadd.py --nexp 10 50 100 200 --nspec 20000
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+import coadd1d_old as coadd1d
+
+OBJNAME = 'SPAT0100-SLIT0000-DET01'
+
+
+def write_spec1d_files(outdir, nexp, nspec, seed=1234):
+    """Write nexp synthetic spec1d files with a single object each."""
+    rng = np.random.default_rng(seed)
+    fnames = []
+    for iexp in range(nexp):
+        fname = os.path.join(outdir, 'spec1d_{:04d}.fits'.format(iexp))
+        fnames.append(fname)
+        if os.path.isfile(fname):
+            continue
+        wave = np.linspace(5000.0, 9000.0, nspec)*(1 + 2e-5*rng.normal())
+        sn = rng.uniform(2.0, 10.0)
+        flux = 1.0 + 0.5*np.sin(wave/100.0)
+        sig = flux/sn
+        ivar = 1.0/sig**2
+        flux = flux + sig*rng.normal(size=nspec)
+        mask = rng.uniform(size=nspec) > 0.02
+        cols = [fits.Column(name='OPT_WAVE', format='D', array=wave),
+                fits.Column(name='OPT_FLAM', format='D', array=flux),
+                fits.Column(name='OPT_FLAM_IVAR', format='D', array=ivar),
+                fits.Column(name='OPT_COUNTS', format='D', array=flux),
+                fits.Column(name='OPT_COUNTS_IVAR', format='D', array=ivar),
+                fits.Column(name='OPT_MASK', format='L', array=mask)]
+        hdu = fits.BinTableHDU.from_columns(cols, name=OBJNAME)
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(fname)
+    return fnames
+
+
+def coadd_in_memory(fnames, gdobj, wave_grid, **kwargs):
+    """Load all of the spectra into (nexp, nspec) arrays and coadd them with combspec."""
+    nexp = len(fnames)
+    arrays = None
+    for iexp, wave, flux, ivar, mask in coadd1d.iter_1dspec(fnames, gdobj):
+        if arrays is None:
+            arrays = [np.zeros((nexp, wave.size)) for i in range(3)] + [np.zeros((nexp, wave.size), dtype=bool)]
+        for array, value in zip(arrays, [wave, flux, ivar, mask]):
+            array[iexp, :] = value
+    waves, fluxes, ivars, masks = arrays
+
+    wave_stack, flux_stack, ivar_stack, mask_stack, outmask, weights, scales, rms_sn = coadd1d.combspec(
+        waves, fluxes, ivars, masks, wave_grid=wave_grid, show=False, **kwargs)
+    return wave_stack, flux_stack, ivar_stack, mask_stack, rms_sn
+
+
+def run_one(pargs):
+    """Run one coadd and print its peak RSS in MB and run time."""
+    nexp = pargs.nexp[0]
+    fnames = write_spec1d_files(pargs.outdir, nexp, pargs.nspec)
+    gdobj = [OBJNAME]*len(fnames)
+    wave_grid = np.linspace(5000.0, 9000.0, pargs.nspec)
+    t0 = time.perf_counter()
+    if pargs.run == 'memory':
+        result = coadd_in_memory(fnames, gdobj, wave_grid)
+    else:
+        wave_stack, flux_stack, ivar_stack, mask_stack, nused, rms_sn = coadd1d.coadd_streaming(
+            fnames, gdobj, wave_grid, scratch_dir=pargs.outdir)
+        result = wave_stack, flux_stack, ivar_stack, mask_stack, rms_sn
+    dt = time.perf_counter() - t0
+    np.savez(os.path.join(pargs.outdir, '{:}_{:d}.npz'.format(pargs.run, nexp)), *result)
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(maxrss/(1024.0**2 if sys.platform == 'darwin' else 1024.0), dt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nexp', type=int, nargs='+', default=[10, 50, 100, 200],
+                        help='Numbers of exposures to coadd')
+    parser.add_argument('--nspec', type=int, default=20000, help='Number of pixels in each spectrum')
+    parser.add_argument('--outdir', type=str, default=None,
+                        help='Directory for the synthetic spec1d files. Defaults to a temporary directory')
+    parser.add_argument('--run', type=str, choices=['memory', 'streaming'], help=argparse.SUPPRESS)
+    pargs = parser.parse_args()
+
+    if pargs.run is not None:
+        run_one(pargs)
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outdir = tmpdir if pargs.outdir is None else pargs.outdir
+        os.makedirs(outdir, exist_ok=True)
+        # Write the files up front, so that it isn't included in the timings
+        write_spec1d_files(outdir, max(pargs.nexp), pargs.nspec)
+
+        print('{:>6s} {:>16s} {:>16s} {:>10s} {:>10s} {:>12s}'.format(
+            'nexp', 'memory RSS (MB)', 'stream RSS (MB)', 'memory (s)', 'stream (s)', 'max |diff|'))
+        for nexp in pargs.nexp:
+            stats = {}
+            for run in ['memory', 'streaming']:
+                out = subprocess.run([sys.executable, __file__, '--run', run, '--nexp', str(nexp),
+                                      '--nspec', str(pargs.nspec), '--outdir', outdir],
+                                     check=True, capture_output=True, text=True)
+                stats[run] = [float(x) for x in out.stdout.split()[-2:]]
+
+            memory = np.load(os.path.join(outdir, 'memory_{:d}.npz'.format(nexp)))
+            streaming = np.load(os.path.join(outdir, 'streaming_{:d}.npz'.format(nexp)))
+            diff = max([np.max(np.abs(memory[key].astype(float) - streaming[key])
+                               /np.fmax(np.abs(memory[key]), 1.0)) for key in memory.files])
+            print('{:6d} {:16.1f} {:16.1f} {:10.2f} {:10.2f} {:12.3g}'.format(
+                nexp, stats['memory'][0], stats['streaming'][0], stats['memory'][1], stats['streaming'][1], diff))
+
+
+if __name__ == '__main__':
+    main()
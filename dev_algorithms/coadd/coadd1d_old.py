@@ -1,4 +1,10 @@
+import os
+import time
+import tempfile
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 import scipy
+import scipy.linalg
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import interpolate
@@ -18,6 +24,8 @@ from matplotlib.ticker import NullFormatter, NullLocator
 
 import IPython
 
+from running_median import running_median
+
 ## Plotting parameters
 plt.rcdefaults()
 plt.rcParams['font.family'] = 'times new roman'
@@ -394,6 +402,89 @@ def poly_ratio_fitfunc_chi2(theta, flux_ref, thismask, arg_dict):
     #chi2 = np.sum(np.square(chi_vec))
     return loss_function
 
+def poly_ratio_basis(wave, norder, func, wave_min, wave_max):
+    """
+    Basis matrix of the rescaling polynomial, such that the polynomial evaluated at wave is basis.dot(theta),
+    identical to utils.func_val(theta, wave, func, minx=wave_min, maxx=wave_max).
+
+    Args:
+        wave: wavelengths, shape (nspec,)
+        norder: number of polynomial coefficients
+        func: 'polynomial', 'legendre' or 'chebyshev'
+        wave_min, wave_max: wavelength range mapped onto [-1, 1] for the legendre and chebyshev polynomials
+
+    Returns:
+        basis: shape (nspec, norder)
+    """
+    if func == 'polynomial':
+        return np.polynomial.polynomial.polyvander(wave, norder - 1)
+    xv = 2.0*(wave - wave_min)/(wave_max - wave_min) - 1.0
+    if func == 'legendre':
+        return np.polynomial.legendre.legvander(xv, norder - 1)
+    if func == 'chebyshev':
+        return np.polynomial.chebyshev.chebvander(xv, norder - 1)
+    msgs.error('Fitting function {:} is not supported by poly_ratio_basis'.format(func))
+
+def poly_ratio_fitfunc_chi2_jac(theta, flux_ref, thismask, arg_dict):
+    """
+    Same loss function as poly_ratio_fitfunc_chi2, together with its analytic gradient with respect to theta.
+
+    The model is a polynomial squared multiplying the spectrum, so the gradient follows from the chain rule through
+    the polynomial basis (see poly_ratio_basis), the rescaled errors, the Huber loss, and the robust dispersion
+    chi_std that sets the Huber transition. This replaces the norder + 1 function evaluations that the optimizer
+    would otherwise need to estimate the gradient by finite differences.
+
+    Args:
+        theta: polynomial coefficients
+        flux_ref:
+        thismask:
+        arg_dict: as for poly_ratio_fitfunc_chi2, plus 'basis' from poly_ratio_basis
+
+    Returns:
+        loss_function, grad
+    """
+    flux_med = arg_dict['flux_med']
+    ivar_med = arg_dict['ivar_med']
+    flux_ref_med = arg_dict['flux_ref_med']
+    ivar_ref_med = arg_dict['ivar_ref_med']
+    basis = arg_dict['basis']
+    mask_both = arg_dict['mask'] & thismask
+
+    poly = basis.dot(theta)
+    ymult = poly**2
+    vmult = np.fmax(ymult,1e-4)*(ymult <= 1.0) + np.sqrt(ymult)*(ymult > 1.0)
+    dvmult = (ymult > 1e-4)*(ymult <= 1.0) + 0.5/np.sqrt(np.fmax(ymult, 1.0))*(ymult > 1.0)
+    var_ref = 1.0/(ivar_ref_med + np.invert(mask_both))
+    ivarfit = mask_both/(1.0/(ivar_med + np.invert(mask_both)) + np.square(vmult)*var_ref)
+    sqrt_ivarfit = np.sqrt(ivarfit)
+    resid = flux_ref_med - ymult*flux_med
+    chi_vec = mask_both*resid*sqrt_ivarfit
+    # Derivative of chi_vec with respect to theta
+    dchi_dy = mask_both*(-flux_med*sqrt_ivarfit - resid*vmult*var_ref*sqrt_ivarfit**3*dvmult)
+    dchi = (dchi_dy*2.0*poly)[:, None]*basis
+
+    # The dispersion of the sigma clipped chi_vec, as computed by sigma_clipped_stats in poly_ratio_fitfunc_chi2,
+    # and its derivative. The set of clipped pixels is held fixed.
+    clipped = stats.sigma_clip(np.ma.MaskedArray(chi_vec, np.invert(mask_both)), cenfunc='median',
+                               stdfunc='mad_std', maxiters=5, sigma=2.0)
+    igood = np.invert(np.ma.getmaskarray(clipped))
+    if np.any(igood):
+        chi_dev = chi_vec[igood] - np.mean(chi_vec[igood])
+        chi_std = np.sqrt(np.mean(np.square(chi_dev)))
+        dchi_std = chi_dev.dot(dchi[igood, :])/(chi_dev.size*chi_std) if chi_std > 0.0 else np.zeros_like(theta)
+    else:
+        chi_std, dchi_std = np.nan, np.zeros_like(theta)
+
+    robust_scale = 2.0
+    delta = robust_scale*chi_std
+    huber_vec = scipy.special.huber(delta, chi_vec)*mask_both
+    loss_function = np.sum(np.square(huber_vec))
+    core = np.abs(chi_vec) <= delta
+    dhuber_dchi = np.where(core, chi_vec, delta*np.sign(chi_vec))
+    dhuber_ddelta = np.where(core, 0.0, np.abs(chi_vec) - delta)
+    grad = 2.0*(huber_vec*dhuber_dchi).dot(dchi) + 2.0*np.sum(huber_vec*dhuber_ddelta)*robust_scale*dchi_std
+    return loss_function, grad
+
 def poly_ratio_fitfunc(flux_ref, thismask, arg_dict, **kwargs_opt):
 
     # flux_ref, ivar_ref act like the 'data', the rescaled flux will be the 'model'
@@ -401,7 +492,12 @@ def poly_ratio_fitfunc(flux_ref, thismask, arg_dict, **kwargs_opt):
     # Function that we are optimizing
     #result = scipy.optimize.differential_evolution(poly_ratio_fitfunc_chi2, args=(flux_ref, ivar_ref, thismask, arg_dict,), **kwargs_opt)
     guess = arg_dict['guess']
-    result = scipy.optimize.minimize(poly_ratio_fitfunc_chi2, guess, args=(flux_ref, thismask, arg_dict),  **kwargs_opt)
+    if arg_dict.get('analytic_jac', False):
+        result = scipy.optimize.minimize(poly_ratio_fitfunc_chi2_jac, guess, args=(flux_ref, thismask, arg_dict),
+                                         jac=True, **kwargs_opt)
+    else:
+        result = scipy.optimize.minimize(poly_ratio_fitfunc_chi2, guess, args=(flux_ref, thismask, arg_dict),
+                                         **kwargs_opt)
     #result = scipy.optimize.least_squares(poly_ratio_fitfunc_chi, guess, args=(flux_ref, thismask, arg_dict),  **kwargs_opt)
     flux = arg_dict['flux']
     ivar = arg_dict['ivar']
@@ -446,7 +542,13 @@ def median_filt_spec(flux, ivar, mask, med_width):
 
 def solve_poly_ratio(wave, flux, ivar, flux_ref, ivar_ref, norder, mask = None, mask_ref = None,
                      scale_min = 0.05, scale_max = 100.0, func='legendre',
-                     maxiter=3, sticky=True, lower=3.0, upper=3.0, median_frac=0.01, debug=False):
+                     maxiter=3, sticky=True, lower=3.0, upper=3.0, median_frac=0.01, analytic_jac=True, debug=False):
+    """
+    Fit a polynomial ratio (the square of a polynomial in wavelength) that rescales flux to match flux_ref.
+
+    If analytic_jac is True the loss is minimized with its analytic gradient (poly_ratio_fitfunc_chi2_jac), otherwise
+    the gradient is estimated by finite differences. Every rejection iteration starts from the median ratio.
+    """
 
     if mask is None:
         mask = (ivar > 0.0)
@@ -471,7 +573,10 @@ def solve_poly_ratio(wave, flux, ivar, flux_ref, ivar_ref, norder, mask = None,
                     flux_med = flux_med, ivar_med = ivar_med,
                     flux_ref_med = flux_ref_med, ivar_ref_med = ivar_ref_med,
                     ivar_ref = ivar_ref, wave = wave, wave_min = wave_min,
-                    wave_max = wave_max, func = func, norder = norder, guess = guess, debug=debug)
+                    wave_max = wave_max, func = func, norder = norder, guess = guess, debug=debug,
+                    analytic_jac=analytic_jac)
+    if analytic_jac:
+        arg_dict['basis'] = poly_ratio_basis(wave, norder, func, wave_min, wave_max)
 
     result, ymodel, ivartot, outmask = utils.robust_optimize(flux_ref, poly_ratio_fitfunc, arg_dict, inmask=mask_ref,
                                                              maxiter=maxiter, lower=lower, upper=upper, sticky=sticky)
@@ -488,87 +593,299 @@ def solve_poly_ratio(wave, flux, ivar, flux_ref, ivar_ref, norder, mask = None,
     return ymult, flux_rescale, ivar_rescale, outmask
 
 
-def interp_oned(wave_new, wave_old, flux_old, ivar_old, mask_old):
+def _linear_columns(x_new, x, y):
+    '''
+    Linearly interpolate the columns of y, sampled at the increasing abscissa x, onto x_new. A single
+    searchsorted is shared by all of the columns.
+    Args:
+       x_new: (one-D array) New abscissa, shape (nnew,)
+       x: (one-D array) Old abscissa, shape (nold,)
+       y: (two-D array) Values to interpolate, shape (nold, ncol)
+    Returns :
+       y_new: (two-D array) shape (nnew, ncol)
+    '''
+    idx = np.clip(np.searchsorted(x, x_new, side='right') - 1, 0, x.size - 2)
+    t = ((x_new - x[idx])/(x[idx + 1] - x[idx]))[:, None]
+    return y[idx, :]*(1.0 - t) + y[idx + 1, :]*t
+
+def _pixel_edges(wave):
+    '''
+    Return the pixel edges (size nspec + 1) of a wavelength grid given its pixel centers.
+    '''
+    mid = 0.5*(wave[1:] + wave[:-1])
+    return np.concatenate(([wave[0] - (mid[0] - wave[0])], mid, [wave[-1] + (wave[-1] - mid[-1])]))
+
+def _rebin_integrals(wave_new, wave_old, y):
+    '''
+    Integrate the columns of y, treated as constant across each old pixel, over the pixels of wave_new.
+    Args:
+       wave_new: (one-D array) New wavelength, shape (nnew,)
+       wave_old: (one-D array) Old wavelength, shape (nold,)
+       y: (two-D array) Values per unit wavelength, shape (nold, ncol)
+    Returns :
+       integrals: (two-D array) shape (nnew, ncol)
+       coverage: (one-D array) Wavelength interval of each new pixel covered by old pixels, shape (nnew,)
+       width_new: (one-D array) Width of each new pixel, shape (nnew,)
+    '''
+    edges_old = _pixel_edges(wave_old)
+    edges_new = _pixel_edges(wave_new)
+    cum_y = np.vstack((np.zeros((1, y.shape[1])), np.cumsum(y*np.diff(edges_old)[:, None], axis=0)))
+    # Clip the new edges to the old grid, so that nothing is integrated outside of it
+    edges_clip = np.clip(edges_new, edges_old[0], edges_old[-1])
+    integrals = np.diff(_linear_columns(edges_clip, edges_old, cum_y), axis=0)
+    coverage = np.diff(edges_clip)
+    return integrals, coverage, np.diff(edges_new)
+
+def _resample_columns(wave_new, wave_good, fluxes_good, ivars_good, kind='cubic'):
+    '''
+    Resample several spectra sampled at the same good wavelengths onto wave_new.
+    Args:
+       wave_new: (one-D array) New wavelength, shape (nnew,)
+       wave_good: (one-D array) Wavelengths of the good pixels, shape (ngood,)
+       fluxes_good: (two-D array) Fluxes of the good pixels, shape (ngood, ncol)
+       ivars_good: (two-D array) Ivars of the good pixels, shape (ngood, ncol)
+       kind: 'linear', 'cubic' or 'flux'. 'flux' rebins the spectra, conserving flux. Cubic interpolation of
+             fewer than 4 good pixels is linear, and with fewer than 2 good pixels all of wave_new is masked.
+    Returns :
+       fluxes_new, ivars_new, masks_new (bool), each of shape (nnew, ncol)
+    '''
+    ncol = fluxes_good.shape[1]
+    if wave_good.size < 2:
+        # Nothing to interpolate between, so all of the new pixels are masked
+        return np.zeros((wave_new.size, ncol)), np.zeros((wave_new.size, ncol)), \
+               np.zeros((wave_new.size, ncol), dtype=bool)
+    if kind == 'cubic' and wave_good.size < 4:
+        # Too few pixels for a cubic spline
+        kind = 'linear'
+
+    # interp1d sorts its input, so do the same
+    if np.any(np.diff(wave_good) < 0.0):
+        isort = np.argsort(wave_good, kind='stable')
+        wave_good, fluxes_good, ivars_good = wave_good[isort], fluxes_good[isort, :], ivars_good[isort, :]
+
+    if kind == 'flux':
+        # The rebinned variance is sum(var_i*width_i^2*frac_i)/coverage^2, where frac_i is the
+        # fraction of old pixel i within the new pixel.
+        vars_good = utils.calc_ivar(ivars_good)
+        integrals, coverage, width_new = _rebin_integrals(
+            wave_new, wave_good, np.hstack((fluxes_good, vars_good*np.diff(_pixel_edges(wave_good))[:, None])))
+        good_cov = coverage > 0.0
+        fluxes_new = np.zeros((wave_new.size, ncol))
+        vars_new = np.zeros((wave_new.size, ncol))
+        fluxes_new[good_cov, :] = integrals[good_cov, :ncol]/coverage[good_cov, None]
+        vars_new[good_cov, :] = integrals[good_cov, ncol:]/coverage[good_cov, None]**2
+        ivars_new = utils.calc_ivar(vars_new)
+        masks_float = (coverage/width_new)[:, None]
+    else:
+        values = np.hstack((fluxes_good, ivars_good))
+        if kind == 'linear':
+            values_new = _linear_columns(wave_new, wave_good, values)
+        elif kind == 'cubic':
+            # Same not-a-knot cubic spline as interp1d(kind='cubic'), built once for all the columns
+            values_new = interpolate.make_interp_spline(wave_good, values, k=3)(wave_new)
+        else:
+            msgs.error('Unrecognized interpolation kind {:}. Use linear, cubic or flux.'.format(kind))
+        # Only the good pixels are used as knots, so the interpolated float mask is one
+        # within the good wavelength range and zero (the fill value) outside of it.
+        inside = (wave_new >= wave_good[0]) & (wave_new <= wave_good[-1])
+        values_new[np.logical_not(inside), :] = 0.
+        fluxes_new, ivars_new = values_new[:, :ncol], values_new[:, ncol:]
+        masks_float = inside.astype(float)[:, None]
+
+    masks_new = (masks_float > 0.5) & (ivars_new > 0.) & (fluxes_new != 0.)
+    return fluxes_new, ivars_new, masks_new
+
+def interp_oned(wave_new, wave_old, flux_old, ivar_old, mask_old, kind='cubic'):
     '''
     Args:
        wave_new: (one-D array) New wavelength
        wave_old: (one-D array) Old wavelength
        flux_old: (one-D array) Old flux
        ivar_old: (one-D array) Old ivar
-       mask_old: (one-D array) Old float mask
+       mask_old: (one-D array) Old mask
+       kind: 'linear', 'cubic' or 'flux' (flux conserving rebinning)
     Returns :
        flux_new, ivar_new, mask_new (bool)
     '''
+    flux_new, ivar_new, mask_new = _resample_columns(wave_new, wave_old[mask_old], flux_old[mask_old, None],
+                                                     ivar_old[mask_old, None], kind=kind)
+    return flux_new[:, 0], ivar_new[:, 0], mask_new[:, 0]
 
-    # make the mask array to be float, used for interpolation
-    masks_float = np.zeros_like(flux_old)
-    masks_float[mask_old] = 1.0
+def _same_grid(wave1, wave2):
+    '''
+    Check whether two wavelength grids are bitwise identical.
+    '''
+    return wave1.shape == wave2.shape and wave1.dtype == wave2.dtype and np.array_equal(wave1, wave2)
+
+def _not_a_knot_slopes(x, y, start):
+    '''
+    Slopes at the knots of the not-a-knot cubic splines (as interp1d(kind='cubic')) through several sets of
+    knots. Each set gives a tridiagonal system, as in scipy's CubicSpline, and the systems of all of the sets
+    are solved together as one block diagonal banded system.
+    Args:
+       x: (one-D array) The knots of all of the sets one after the other, increasing within each set
+       y: (two-D array) Values at the knots, shape (x.size, ncol)
+       start: (one-D int array) Set i is x[start[i]:start[i+1]], with at least 4 knots
+    Returns :
+       slopes: (two-D array) shape (x.size, ncol)
+    '''
+    dx = np.diff(x)
+    slope = np.diff(y, axis=0)/dx[:, None]
+    # The rows of the first and last knot of each set, and the couplings between the sets, are set below
+    ab = np.zeros((3, x.size))
+    ab[1, 1:-1] = 2.0*(dx[:-1] + dx[1:])
+    ab[0, 2:] = dx[:-1]
+    ab[2, :-2] = dx[1:]
+    rhs = np.zeros(y.shape)
+    rhs[1:-1] = 3.0*(dx[1:, None]*slope[:-1] + dx[:-1, None]*slope[1:])
+
+    first, last = start[:-1], start[1:] - 1
+    ab[2, first[1:] - 1] = 0.0
+    ab[0, last[:-1] + 1] = 0.0
+    d = (x[first + 2] - x[first])[:, None]
+    ab[1, first] = dx[first + 1]
+    ab[0, first + 1] = d[:, 0]
+    rhs[first] = ((dx[first, None] + 2.0*d)*dx[first + 1, None]*slope[first] + dx[first, None]**2*slope[first + 1])/d
+    d = (x[last] - x[last - 2])[:, None]
+    ab[1, last] = dx[last - 2]
+    ab[2, last - 1] = d[:, 0]
+    rhs[last] = (dx[last - 1, None]**2*slope[last - 2] + (2.0*d + dx[last - 1, None])*dx[last - 2, None]*slope[last - 1])/d
+    return scipy.linalg.solve_banded((1, 1), ab, rhs)
+
+def _interp_rows(wave_new, knots, values, kind='cubic'):
+    '''
+    Interpolate several spectra, each sampled at its own knots, onto their new grids in one pass: one
+    searchsorted per spectrum, one banded solve for the cubic splines of all of them, and a single evaluation.
+    Args:
+       wave_new: (two-D array) New wavelengths of each spectrum, shape (nrow, nnew)
+       knots: list of nrow increasing one-D arrays, with at least 2 (linear) or 4 (cubic) knots each
+       values: list of nrow two-D arrays of the values at the knots, shape (knots[i].size, ncol)
+       kind: 'linear' or 'cubic' (not-a-knot, as interp1d(kind='cubic'))
+    Returns :
+       values_new: (three-D array) shape (nrow, nnew, ncol), zero outside of the knots of each spectrum
+       inside: (two-D bool array) shape (nrow, nnew), True within the knots of each spectrum
+    '''
+    start = np.concatenate(([0], np.cumsum([x.size for x in knots])))
+    x = np.concatenate(knots)
+    y = np.concatenate(values)
+    # The interval of each new wavelength, as an index into the concatenated knots
+    idx = np.array([np.clip(np.searchsorted(xk, wave, side='right') - 1, 0, xk.size - 2)
+                    for xk, wave in zip(knots, wave_new)]) + start[:-1, None]
+    dx = (x[idx + 1] - x[idx])[..., None]
+    if kind == 'linear':
+        t = (wave_new - x[idx])[..., None]/dx
+        values_new = y[idx]*(1.0 - t) + y[idx + 1]*t
+    else:
+        slopes = _not_a_knot_slopes(x, y, start)
+        h = (wave_new - x[idx])[..., None]
+        slope = (y[idx + 1] - y[idx])/dx
+        t = (slopes[idx] + slopes[idx + 1] - 2.0*slope)/dx
+        values_new = ((t/dx*h + (slope - slopes[idx])/dx - t)*h + slopes[idx])*h + y[idx]
+    inside = (wave_new >= x[start[:-1], None]) & (wave_new <= x[start[1:] - 1, None])
+    values_new[np.logical_not(inside), :] = 0.
+    return values_new, inside
+
+def interp_spec_batch(wave_new, waves, fluxes, ivars, masks, kind='cubic'):
+    '''
+    Resample a stack of spectra onto new wavelength grids.
+    For linear and cubic interpolation all of the exposures are resampled together (see _interp_rows), each
+    with its own good pixels as knots, so that the fluxes and ivars of an exposure share its knot search and
+    the cubic splines of all of the exposures are found with one banded solve. The flux conserving rebinning
+    is done one exposure at a time. Exposures already on their new grid are copied without resampling.
+    Exposures with fewer than 2 good pixels are masked, and those with fewer than 4 are interpolated linearly
+    rather than with a cubic spline.
+    Args:
+        wave_new: (two-D array) New wavelengths, shape (nexp, nspec_new)
+        waves: (two-D array) Old wavelengths, shape (nexp, nspec)
+        fluxes: (two-D array) shape (nexp, nspec)
+        ivars: (two-D array) shape (nexp, nspec)
+        masks: (two-D bool array) shape (nexp, nspec)
+        kind: 'linear', 'cubic' or 'flux' (flux conserving rebinning)
+    Returns:
+        fluxes_inter, ivars_inter, masks_inter, each of shape (nexp, nspec_new)
+    '''
+    if kind not in ['linear', 'cubic', 'flux']:
+        msgs.error('Unrecognized interpolation kind {:}. Use linear, cubic or flux.'.format(kind))
+    nexp = fluxes.shape[0]
+    fluxes_inter = np.zeros(wave_new.shape)
+    ivars_inter = np.zeros(wave_new.shape)
+    masks_inter = np.zeros(wave_new.shape, dtype=bool)
+
+    rows = {'linear': [], 'cubic': []}
+    for ii in range(nexp):
+        if _same_grid(wave_new[ii, :], waves[ii, :]):
+            # do not interpolate if the wavelength is exactly same with wave_new
+            fluxes_inter[ii, :] = fluxes[ii, :]
+            ivars_inter[ii, :] = ivars[ii, :]
+            masks_inter[ii, :] = masks[ii, :]
+            continue
+        good = masks[ii, :]
+        if kind == 'flux':
+            flux_new, ivar_new, mask_new = _resample_columns(wave_new[ii, :], waves[ii, good], fluxes[ii, good, None],
+                                                             ivars[ii, good, None], kind=kind)
+            fluxes_inter[ii, :], ivars_inter[ii, :], masks_inter[ii, :] = flux_new[:, 0], ivar_new[:, 0], mask_new[:, 0]
+            continue
+        wave_good = waves[ii, good]
+        values_good = np.column_stack((fluxes[ii, good], ivars[ii, good]))
+        # interp1d sorts its input, so do the same
+        if np.any(np.diff(wave_good) < 0.0):
+            isort = np.argsort(wave_good, kind='stable')
+            wave_good, values_good = wave_good[isort], values_good[isort, :]
+        if wave_good.size >= 4:
+            rows[kind].append((ii, wave_good, values_good))
+        elif wave_good.size >= 2:
+            rows['linear'].append((ii, wave_good, values_good))
+        # otherwise there is nothing to interpolate between, and the exposure stays masked
+
+    for this_kind, these_rows in rows.items():
+        if len(these_rows) == 0:
+            continue
+        iexp, knots, values = zip(*these_rows)
+        iexp = list(iexp)
+        values_new, inside = _interp_rows(wave_new[iexp, :], knots, values, kind=this_kind)
+        fluxes_inter[iexp, :] = values_new[..., 0]
+        ivars_inter[iexp, :] = values_new[..., 1]
+        masks_inter[iexp, :] = inside & (values_new[..., 1] > 0.) & (values_new[..., 0] != 0.)
 
-    flux_new = interpolate.interp1d(wave_old[mask_old], flux_old[mask_old], kind='cubic', \
-                                         bounds_error=False, fill_value=0.)(wave_new)
-    ivar_new = interpolate.interp1d(wave_old[mask_old], ivar_old[mask_old], kind='cubic', \
-                                         bounds_error=False, fill_value=0.)(wave_new)
-    mask_new_tmp = interpolate.interp1d(wave_old[mask_old], masks_float[mask_old], kind='cubic', \
-                                         bounds_error=False, fill_value=0.)(wave_new)
-    mask_new = (mask_new_tmp > 0.5) & (ivar_new > 0.) & (flux_new != 0.)
-    return flux_new,ivar_new,mask_new
+    return fluxes_inter, ivars_inter, masks_inter
 
-def interp_spec(wave_new, waves, fluxes, ivars, masks):
+def interp_spec(wave_new, waves, fluxes, ivars, masks, kind='cubic'):
     '''
     Interpolate all spectra to the page of wave_new
     Args:
-        waves:
-        fluxes:
-        sigs:
-        masks:
-        iref:
+        wave_new: (nspec_new,) or (nexp, nspec_new) array
+        waves: (nspec,) or (nexp, nspec) array
+        fluxes: (nspec,) or (nexp, nspec) array
+        ivars: (nspec,) or (nexp, nspec) array
+        masks: (nspec,) or (nexp, nspec) array
+        kind: 'linear', 'cubic' or 'flux' (flux conserving rebinning)
     Returns:
+        fluxes_inter, ivars_inter, masks_inter
     '''
 
-    if (fluxes.ndim==2) and (wave_new.ndim==1):
-        nexp = np.shape(fluxes)[0]
-        # Interpolate spectra to have the same wave grid with the iexp spectrum.
-        # And scale spectra to the same flux level with the iexp spectrum.
-        fluxes_inter = np.zeros((nexp, wave_new.size))
-        ivars_inter  = np.zeros((nexp, wave_new.size))
-        masks_inter  = np.zeros((nexp, wave_new.size), dtype=bool)
-        for ii in range(nexp):
-            mask_ii = masks[ii, :]
-            if np.sum(wave_new == waves[ii, :]) == np.size(wave_new):
-                # do not interpolate if the wavelength is exactly same with wave_new
-                fluxes_inter[ii, :] = fluxes[ii, :].copy()
-                ivars_inter[ii, :] = ivars[ii, :].copy()
-                masks_inter[ii, :] = mask_ii.copy()
-            else:
-                flux_inter_ii, ivar_inter_ii, mask_inter_ii = \
-                    interp_oned(wave_new, waves[ii, :],fluxes[ii, :],ivars[ii, :], masks[ii, :])
-                fluxes_inter[ii, :] = flux_inter_ii  # * ratio_ii
-                ivars_inter[ii, :] = ivar_inter_ii  # * ratio_ii
-                masks_inter[ii, :] = mask_inter_ii
-
-    elif (fluxes.ndim==1) and (wave_new.ndim==1):
-        fluxes_inter, ivars_inter, masks_inter = interp_oned(wave_new,waves,fluxes,ivars,masks)
-
-    elif (fluxes.ndim==1) and (wave_new.ndim==2):
-        nexp = np.shape(wave_new)[0]
-        fluxes_inter = np.zeros_like(wave_new)
-        ivars_inter = np.zeros_like(wave_new)
-        masks_inter = np.zeros_like(wave_new, dtype=bool)
-
-        for ii in range(nexp):
-            if np.sum(wave_new[ii, :] == waves) == np.size(waves):
-                # do not interpolate if the wavelength is exactly same with wave_new
-                fluxes_inter[ii, :] = fluxes.copy()
-                ivars_inter[ii, :] = ivars.copy()
-                masks_inter[ii, :] = masks.copy()
-            else:
-                flux_inter_ii, ivar_inter_ii, mask_inter_ii = \
-                    interp_oned(wave_new[ii, :], waves, fluxes, ivars, masks)
-                fluxes_inter[ii, :] = flux_inter_ii  # * ratio_ii
-                ivars_inter[ii, :] = ivar_inter_ii  # * ratio_ii
-                masks_inter[ii, :] = mask_inter_ii
-
-    return fluxes_inter, ivars_inter, masks_inter
+    if (fluxes.ndim==1) and (wave_new.ndim==1):
+        return interp_oned(wave_new, waves, fluxes, ivars, masks, kind=kind)
+
+    if (fluxes.ndim==1) and (kind != 'flux'):
+        # One spectrum onto many grids, e.g. a stack onto the native grid of each exposure. Build the
+        # interpolator once and evaluate it on all of the grids together.
+        fluxes_inter, ivars_inter, masks_inter = [x.reshape(wave_new.shape) for x in
+            interp_oned(wave_new.ravel(), waves, fluxes, ivars, masks, kind=kind)]
+        # do not interpolate if the wavelength is exactly same with wave_new
+        for ii in range(wave_new.shape[0]):
+            if _same_grid(wave_new[ii, :], waves):
+                fluxes_inter[ii, :] = fluxes
+                ivars_inter[ii, :] = ivars
+                masks_inter[ii, :] = masks
+        return fluxes_inter, ivars_inter, masks_inter
+
+    # Either many spectra onto one grid, or one spectrum onto many grids
+    nexp = fluxes.shape[0] if fluxes.ndim == 2 else wave_new.shape[0]
+    return interp_spec_batch(np.broadcast_to(wave_new, (nexp, wave_new.shape[-1])),
+                             np.broadcast_to(waves, (nexp, waves.shape[-1])),
+                             np.broadcast_to(fluxes, (nexp, fluxes.shape[-1])),
+                             np.broadcast_to(ivars, (nexp, ivars.shape[-1])),
+                             np.broadcast_to(masks, (nexp, masks.shape[-1])), kind=kind)
 
 def sn_weights(waves, fluxes, ivars, masks, dv_smooth=10000.0, const_weights=False, verbose=False):
     """ Calculate the S/N of each input spectrum and create an array of (S/N)^2 weights to be used
@@ -644,29 +961,44 @@ def sn_weights(waves, fluxes, ivars, masks, dv_smooth=10000.0, const_weights=Fal
         if verbose:
             msgs.info("Using wavelength dependent weights for coadding")
         weights = np.ones_like(flux_stack) #((fluxes.shape[0], fluxes.shape[1]))
-        spec_vec = np.arange(nspec)
         for iexp in range(nstack):
-            imask = mask_stack[iexp,:]
-            wave_now = wave_stack[iexp, imask]
-            spec_now = spec_vec[imask]
-            dwave = (wave_now - np.roll(wave_now,1))[1:]
-            dv = (dwave/wave_now[1:])*c_kms
-            dv_pix = np.median(dv)
-            med_width = int(np.round(dv_smooth/dv_pix))
-            # TODO Replace with fast_running_median
-            sn_med1 = scipy.ndimage.filters.median_filter(sn_val[iexp,imask]**2, size=med_width, mode='reflect')
-            sn_med2 = np.interp(spec_vec, spec_now, sn_med1)
-            #sn_med2 = np.interp(wave_stack[iexp,:], wave_now,sn_med1)
-            sig_res = np.fmax(med_width/10.0, 3.0)
-            gauss_kernel = convolution.Gaussian1DKernel(sig_res)
-            sn_conv = convolution.convolve(sn_med2, gauss_kernel)
-            weights[iexp,:] = sn_conv
+            weights[iexp,:] = smooth_sn_weights(wave_stack[iexp,:], sn_val[iexp,:], mask_stack[iexp,:],
+                                                dv_smooth=dv_smooth)
             if verbose:
                 msgs.info('S/N = {:4.2f}, averaged weight = {:4.2f} for {:}th exposure'.format(
                     rms_sn[iexp],np.mean(weights[iexp,:]), iexp))
     # Finish
     return rms_sn, weights
 
+def smooth_sn_weights(wave, sn_val, mask, dv_smooth=10000.0):
+    """ Wavelength dependent (S/N)^2 weights of a single spectrum, smoothed over dv_smooth km/s.
+
+    Parameters
+    ----------
+    wave: float ndarray, shape = (nspec,)
+    sn_val: float ndarray, shape = (nspec,)
+        S/N of each pixel
+    mask: bool ndarray, shape = (nspec,)
+        True=Good, False=Bad.
+
+    Returns
+    -------
+    weights : ndarray, shape = (nspec,)
+    """
+    spec_vec = np.arange(wave.size)
+    wave_now = wave[mask]
+    spec_now = spec_vec[mask]
+    dwave = (wave_now - np.roll(wave_now,1))[1:]
+    dv = (dwave/wave_now[1:])*c_kms
+    dv_pix = np.median(dv)
+    med_width = int(np.round(dv_smooth/dv_pix))
+    sn_med1 = scipy.ndimage.filters.median_filter(sn_val[mask]**2, size=med_width, mode='reflect')
+    sn_med2 = np.interp(spec_vec, spec_now, sn_med1)
+    #sn_med2 = np.interp(wave_stack[iexp,:], wave_now,sn_med1)
+    sig_res = np.fmax(med_width/10.0, 3.0)
+    gauss_kernel = convolution.Gaussian1DKernel(sig_res)
+    return convolution.convolve(sn_med2, gauss_kernel)
+
 def robust_median_ratio(flux,ivar,flux_ref,ivar_ref, ref_percentile=20.0, min_good=0.05, mask=None, mask_ref=None,
                         maxiters=5, max_factor = 10.0, sigrej = 3.0):
     '''
@@ -841,6 +1173,141 @@ def scale_spec(wave, flux, ivar, flux_ref, ivar_ref, mask=None, mask_ref=None, m
     return flux_scale, ivar_scale, scale, scale_method
 
 
+class StackAccumulator(object):
+    '''
+    Accumulate the binned sums used to compute a weighted stack of spectra on a fixed wavelength grid.
+
+    The bin of each pixel is found once with searchsorted, and all of the sums are filled with np.bincount.
+    Exposures can be added one at a time, so the full (nexp, nspec) arrays never need to be held in memory,
+    and pixels can be removed again, so rejection iterations can update the stack rather than recompute it.
+
+    Args:
+        wave_grid: (one-D array) Edges of the wavelength bins, as for np.histogram
+    '''
+
+    def __init__(self, wave_grid):
+        self.wave_grid = wave_grid
+        self.nbins = wave_grid.size - 1
+        self.nused = np.zeros(self.nbins, dtype=int)
+        self.weights_total = np.zeros(self.nbins)
+        self.wave_total = np.zeros(self.nbins)
+        self.flux_total = np.zeros(self.nbins)
+        self.var_total = np.zeros(self.nbins)
+
+    def bin_index(self, waves):
+        '''
+        Return the wave_grid bin of each wavelength, or -1 for wavelengths outside of the grid. Like np.histogram,
+        the last bin includes its upper edge.
+        '''
+        bins = np.searchsorted(self.wave_grid, waves, side='right') - 1
+        bins[waves == self.wave_grid[-1]] = self.nbins - 1
+        bins[np.logical_not((waves >= self.wave_grid[0]) & (waves <= self.wave_grid[-1]))] = -1
+        return bins
+
+    def _accumulate(self, waves, fluxes, ivars, masks, weights, bins, sign):
+        ubermask = masks & (weights > 0.0) & (waves > 1.0) & (ivars > 0.0)
+        bins_flat = self.bin_index(waves[ubermask]) if bins is None else bins[ubermask]
+        inside = bins_flat >= 0
+        bins_flat = bins_flat[inside]
+        waves_flat = waves[ubermask][inside]
+        weights_flat = weights[ubermask][inside]
+        vars_flat = utils.calc_ivar(ivars[ubermask][inside])
+
+        self.nused += sign*np.bincount(bins_flat, minlength=self.nbins)
+        self.weights_total += sign*np.bincount(bins_flat, weights=weights_flat, minlength=self.nbins)
+        self.wave_total += sign*np.bincount(bins_flat, weights=waves_flat*weights_flat, minlength=self.nbins)
+        self.flux_total += sign*np.bincount(bins_flat, weights=fluxes[ubermask][inside]*weights_flat,
+                                            minlength=self.nbins)
+        self.var_total += sign*np.bincount(bins_flat, weights=vars_flat*weights_flat**2, minlength=self.nbins)
+
+        if sign < 0:
+            # Clear the round off left in bins that no longer have any pixels
+            empty = self.nused == 0
+            for total in [self.weights_total, self.wave_total, self.flux_total, self.var_total]:
+                total[empty] = 0.0
+
+    def add(self, waves, fluxes, ivars, masks, weights, bins=None):
+        '''
+        Add the good pixels of one or more spectra to the stack.
+        Args:
+            waves, fluxes, ivars, masks, weights: arrays of the same shape, e.g. (nspec,) or (nexp, nspec)
+            bins: bin indices of waves from bin_index(), to avoid searching for them again
+        '''
+        self._accumulate(waves, fluxes, ivars, masks, weights, bins, 1)
+
+    def remove(self, waves, fluxes, ivars, masks, weights, bins=None):
+        '''
+        Remove pixels previously added to the stack. masks selects the pixels to remove.
+        Args:
+            waves, fluxes, ivars, masks, weights: arrays of the same shape, e.g. (nspec,) or (nexp, nspec)
+            bins: bin indices of waves from bin_index(), to avoid searching for them again
+        '''
+        self._accumulate(waves, fluxes, ivars, masks, weights, bins, -1)
+
+    def bin_order(self, bins):
+        '''
+        Index the pixels by bin, for update().
+        Args:
+            bins: bin indices of the pixels from bin_index(), e.g. (nexp, nspec)
+        Returns:
+            order: flat indices of the pixels sorted by bin, pixels of the same bin in their original order
+            starts: (nbins + 1,) the pixels of bin i are order[starts[i]:starts[i + 1]]
+        '''
+        bins_flat = bins.ravel()
+        order = np.argsort(bins_flat, kind='stable')
+        starts = np.searchsorted(bins_flat[order], np.arange(self.nbins + 1))
+        return order, starts
+
+    def update(self, waves, fluxes, ivars, masks, weights, changed, bins=None, order=None):
+        '''
+        Update the stack after the mask of some pixels has changed. Only the bins those pixels fall in are
+        touched, and their sums are recomputed from all of their good pixels, in the same order as add(), so the
+        result is identical to recomputing the whole stack rather than carrying the round off of remove().
+        With order from bin_order(), only the pixels of those bins are visited.
+        Args:
+            waves, fluxes, ivars, weights: the arrays the stack was built from, e.g. (nexp, nspec)
+            masks: the new mask of the pixels
+            changed: True for the pixels whose mask has changed
+            bins: bin indices of waves from bin_index(), to avoid searching for them again
+            order: the index of the pixels by bin from bin_order(), to avoid sorting them again
+        '''
+        if bins is None:
+            bins = self.bin_index(waves)
+        pix_order, starts = self.bin_order(bins) if order is None else order
+        bins_flat = bins.ravel()
+        changed_bins = bins_flat[np.flatnonzero(changed)]
+        affected = np.unique(changed_bins[changed_bins >= 0])
+        if affected.size == 0:
+            return
+
+        # The flat indices of all of the pixels in the affected bins
+        counts = starts[affected + 1] - starts[affected]
+        first = np.repeat(starts[affected] - (np.cumsum(counts) - counts), counts)
+        pix = pix_order[first + np.arange(first.size)]
+
+        self.nused[affected] = 0
+        for total in [self.weights_total, self.wave_total, self.flux_total, self.var_total]:
+            total[affected] = 0.0
+        self._accumulate(waves.ravel()[pix], fluxes.ravel()[pix], ivars.ravel()[pix], masks.ravel()[pix],
+                         weights.ravel()[pix], bins_flat[pix], 1)
+
+    def stack(self):
+        '''
+        Returns:
+            wave_stack, flux_stack, ivar_stack, mask_stack, nused for the pixels accumulated so far
+        '''
+        good = self.weights_total > 0.0
+        norm = self.weights_total + np.logical_not(good)
+        wave_stack = good*self.wave_total/norm
+        flux_stack = good*self.flux_total/norm
+        var_stack = good*self.var_total/norm**2
+        ivar_stack = utils.calc_ivar(var_stack)
+
+        # New mask for the stack
+        mask_stack = good & (self.nused > 0.0)
+
+        return wave_stack, flux_stack, ivar_stack, mask_stack, self.nused.copy()
+
 def compute_stack(waves,fluxes,ivars,masks,wave_grid,weights):
     '''
     Compute the stacked spectrum based on spectra and wave_grid with weights being taken into account.
@@ -855,36 +1322,374 @@ def compute_stack(waves,fluxes,ivars,masks,wave_grid,weights):
         weighted stacked wavelength, flux and ivar
     '''
 
-    ubermask = masks & (weights > 0.0) & (waves > 1.0) & (ivars > 0.0)
-    waves_flat = waves[ubermask].flatten()
-    fluxes_flat = fluxes[ubermask].flatten()
-    ivars_flat = ivars[ubermask].flatten()
-    vars_flat = utils.calc_ivar(ivars_flat)
-    weights_flat = weights[ubermask].flatten()
+    stack = StackAccumulator(wave_grid)
+    stack.add(waves, fluxes, ivars, masks, weights)
+    return stack.stack()
+
+def iter_1dspec(fnames, gdobj, order=None, ex_value='OPT', flux_value=True):
+    '''
+    Iterate over the spectra of objects in a list of spec1d files without loading them all into memory.
+    The files are memory mapped, so a spectrum is only read from disk when it is used.
+    Args:
+        fnames: list of spec1d files
+        gdobj: list of object names, one for each file
+        order: set to None if longslit data
+        ex_value: 'OPT' or 'BOX'
+        flux_value: use the fluxed spectra if True, otherwise the counts
+    Yields:
+        iexp, wave, flux, ivar, mask. The arrays are only valid until the next spectrum is read.
+    '''
+    for iexp, fname in enumerate(fnames):
+        with fits.open(fname, memmap=True) as hdul:
+            wave, flux, ivar, mask = read_spec1d_ext(hdul, fname, gdobj[iexp], order=order, ex_value=ex_value,
+                                                     flux_value=flux_value)
+            yield iexp, wave, flux, ivar, mask
+
+def read_spec1d_ext(hdul, fname, objid, order=None, ex_value='OPT', flux_value=True):
+    '''
+    Read the spectrum of an object from an open spec1d file.
+    Args:
+        hdul: the HDUList of the spec1d file
+        fname: the name of the file, for error messages
+        objid: the name of the object
+        order: set to None if longslit data
+        ex_value: 'OPT' or 'BOX'
+        flux_value: use the fluxed spectra if True, otherwise the counts
+    Returns:
+        wave, flux, ivar, mask
+    '''
+    if ex_value not in ['OPT', 'BOX']:
+        msgs.error('{:} is not recognized. Please change to either BOX or OPT.'.format(ex_value))
+    flux_key = 'FLAM' if flux_value else 'COUNTS'
+
+    ext = None
+    for hdu in hdul[1:]:
+        if objid in hdu.name and (order is None or 'ORDER{:04d}'.format(order) in hdu.name):
+            ext = hdu
+    if ext is None:
+        msgs.error('Can not find extension {:} in {:}.'.format(objid, fname))
+
+    data = ext.data
+    wave = data['{:}_WAVE'.format(ex_value)]
+    flux = data['{:}_{:}'.format(ex_value, flux_key)]
+    ivar = data['{:}_{:}_IVAR'.format(ex_value, flux_key)]
+    mask_key = '{:}_MASK'.format(ex_value)
+    mask = data[mask_key].astype(bool) if mask_key in data.names else ivar > 0.0
+    return wave, flux, ivar, mask
+
+def _sn_val(flux, ivar):
+    '''
+    S/N of each pixel, computed exactly as in sn_weights.
+    '''
+    sig = np.sqrt(utils.calc_ivar(ivar))
+    return flux*np.sqrt(utils.calc_ivar(sig**2))
+
+def exposure_weights(wave, flux, ivar, mask, rms_sn, const_weights, dv_smooth=10000.0):
+    '''
+    (S/N)^2 weights of a single exposure, as computed by sn_weights.
+    Args:
+        wave, flux, ivar, mask: (nspec,) arrays
+        rms_sn: RMS S/N of the exposure
+        const_weights: use a constant weight of rms_sn^2 rather than wavelength dependent weights
+    Returns:
+        weights: (nspec,) array
+    '''
+    if const_weights:
+        return np.full(wave.size, rms_sn**2)
+    return smooth_sn_weights(wave, _sn_val(flux, ivar), mask, dv_smooth=dv_smooth)
 
-    # Counts how many pixels in each wavelength bin
-    nused, wave_edges = np.histogram(waves_flat,bins=wave_grid,density=False)
+class ScratchArray(object):
+    '''
+    One or two-D array in a scratch file, read and written one slice (of a row) at a time, e.g. arr[irow, lo:hi].
+    Unlike a memory mapped array, the slices that have been read do not stay mapped into the process, so they do
+    not add to its memory use. The array starts out as zeros. Use it in a with statement, or call close(), so that
+    the file is closed.
 
-    # Calculate the summed weights for the denominator
-    weights_total, wave_edges = np.histogram(waves_flat,bins=wave_grid,density=False,weights=weights_flat)
+    Args:
+        filename: the scratch file, which is created if it does not exist
+        shape: (size,) or (nrow, ncol)
+        dtype: the data type of the array
+    '''
 
-    # Calculate the stacked wavelength
-    wave_stack_total, wave_edges = np.histogram(waves_flat,bins=wave_grid,density=False,weights=waves_flat*weights_flat)
-    wave_stack = (weights_total > 0.0)*wave_stack_total/(weights_total+(weights_total==0.))
+    def __init__(self, filename, shape, dtype=float):
+        self.shape = shape
+        self.size = int(np.prod(shape))
+        self.dtype = np.dtype(dtype)
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT)
+        try:
+            os.ftruncate(self.fd, self.size*self.dtype.itemsize)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _offsets(self, index):
+        if len(self.shape) == 2:
+            irow, index = index
+            start, stop, step = index.indices(self.shape[1])
+            start, stop = start + irow*self.shape[1], stop + irow*self.shape[1]
+        else:
+            start, stop, step = index.indices(self.size)
+        return start*self.dtype.itemsize, max(stop - start, 0)
 
-    # Calculate the stacked flux
-    flux_stack_total, wave_edges = np.histogram(waves_flat,bins=wave_grid,density=False,weights=fluxes_flat*weights_flat)
-    flux_stack = (weights_total > 0.0)*flux_stack_total/(weights_total+(weights_total==0.))
+    def __getitem__(self, index):
+        offset, count = self._offsets(index)
+        return np.frombuffer(bytearray(os.pread(self.fd, count*self.dtype.itemsize, offset)), dtype=self.dtype)
 
-    # Calculate the stacked ivar
-    var_stack_total, wave_edges = np.histogram(waves_flat,bins=wave_grid,density=False,weights=vars_flat*weights_flat**2)
-    var_stack = (weights_total > 0.0)*var_stack_total/(weights_total+(weights_total==0.))**2
-    ivar_stack = utils.calc_ivar(var_stack)
+    def __setitem__(self, index, value):
+        offset, count = self._offsets(index)
+        os.pwrite(self.fd, np.broadcast_to(np.asarray(value, dtype=self.dtype), (count,)).tobytes(), offset)
 
-    # New mask for the stack
-    mask_stack = (weights_total > 0.0) & (nused > 0.0)
+    def close(self):
+        os.close(self.fd)
 
-    return wave_stack, flux_stack, ivar_stack, mask_stack, nused
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _iter_chunks(values, chunk_size):
+    for start in range(0, values.size, chunk_size):
+        yield np.asarray(values[start:start + chunk_size])
+
+def _chunked_kth(values, k, lo, hi, chunk_size, nbins=1024):
+    '''
+    The k-th smallest (counting from zero) of the elements of a one-D array, e.g. a ScratchArray, within
+    [lo, hi]. The array is read chunk_size elements at a time, and the range is narrowed with histograms until
+    few enough elements are left to sort.
+    '''
+    # Start from the smallest and largest elements within the range, so that the histogram bins are finite
+    lo_in, hi_in = np.inf, -np.inf
+    for chunk in _iter_chunks(values, chunk_size):
+        chunk = chunk[(chunk >= lo) & (chunk <= hi)]
+        if chunk.size > 0:
+            lo_in, hi_in = min(lo_in, chunk.min()), max(hi_in, chunk.max())
+    lo, hi = lo_in, hi_in
+    closed = True
+    while True:
+        edges = np.linspace(lo, hi, nbins + 1)
+        counts = np.zeros(nbins, dtype=int)
+        for chunk in _iter_chunks(values, chunk_size):
+            chunk = chunk[(chunk >= lo) & ((chunk <= hi) if closed else (chunk < hi))]
+            ibin = np.fmin(np.searchsorted(edges, chunk, side='right') - 1, nbins - 1)
+            counts += np.bincount(ibin, minlength=nbins)
+        cumcounts = np.cumsum(counts)
+        ibin = np.searchsorted(cumcounts, k, side='right')
+        k -= cumcounts[ibin] - counts[ibin]
+        lo, hi, closed = edges[ibin], edges[ibin + 1], closed and ibin == nbins - 1
+        if np.nextafter(lo, hi) >= hi:
+            # The range can not be narrowed any further, so all of the elements left are lo (or hi)
+            nlo = sum([np.sum(chunk == lo) for chunk in _iter_chunks(values, chunk_size)])
+            return lo if k < nlo else hi
+        if counts[ibin] <= chunk_size:
+            break
+
+    selected = np.concatenate([chunk[(chunk >= lo) & ((chunk <= hi) if closed else (chunk < hi))]
+                               for chunk in _iter_chunks(values, chunk_size)])
+    return np.partition(selected, k)[k]
+
+def sigma_clip_streaming(values, sigma=3.0, maxiters=5, chunk_size=1000000):
+    '''
+    Sigma clip the elements of a one-D array that is too large to be held in memory, e.g. a ScratchArray,
+    reading chunk_size elements at a time. The clipping is the same as astropy.stats.sigma_clip(values, sigma=sigma,
+    maxiters=maxiters), with the median as the center and the standard deviation as the width.
+    Args:
+        values: (one-D array) the finite values to clip
+    Returns:
+        min_value, max_value: the elements outside of [min_value, max_value] are clipped
+    '''
+    # The elements kept by each iteration are those within the bounds of all of the iterations so far
+    lo, hi = -np.inf, np.inf
+    min_value, max_value = lo, hi
+    nchanged, iteration = 1, 0
+    while nchanged != 0 and iteration < maxiters:
+        iteration += 1
+        size, total = 0, 0.0
+        for chunk in _iter_chunks(values, chunk_size):
+            chunk = chunk[(chunk >= lo) & (chunk <= hi)]
+            size += chunk.size
+            total += np.sum(chunk)
+        if size == 0:
+            break
+        mean = total/size
+        std = np.sqrt(sum([np.sum((chunk[(chunk >= lo) & (chunk <= hi)] - mean)**2)
+                           for chunk in _iter_chunks(values, chunk_size)])/size)
+        median = _chunked_kth(values, size//2, lo, hi, chunk_size)
+        if size % 2 == 0:
+            median = 0.5*(median + _chunked_kth(values, size//2 - 1, lo, hi, chunk_size))
+        min_value, max_value = median - sigma*std, median + sigma*std
+        lo, hi = max(lo, min_value), min(hi, max_value)
+        nchanged = size - sum([np.sum((chunk >= lo) & (chunk <= hi)) for chunk in _iter_chunks(values, chunk_size)])
+    return min_value, max_value
+
+def _add_stack_chunk(stack, scratch, fluxes, ivars, masks, pix_lo, pix_hi, bin_lo, bin_hi):
+    '''
+    Add the pixels of every exposure that fall in the stack bins [bin_lo, bin_hi) to the stack, reading only
+    the pixels [pix_lo[iexp], pix_hi[iexp]) of each exposure from the scratch arrays.
+    '''
+    use = np.flatnonzero(pix_hi > pix_lo)
+    if use.size == 0:
+        return
+    chunks = [np.concatenate([scratch[name][iexp, pix_lo[iexp]:pix_hi[iexp]] for iexp in use])
+              for name in ['waves', fluxes, ivars, masks, 'weights']]
+    bins = stack.bin_index(chunks[0])
+    bins[(bins < bin_lo) | (bins >= bin_hi)] = -1
+    stack.add(*chunks, bins=bins)
+
+def coadd_streaming(fnames, gdobj, wave_grid, order=None, ex_value='OPT', flux_value=True, dv_smooth=10000.0,
+                    const_weights=False, ref_percentile=20.0, maxiter_scale=5, sigrej=3, scale_method=None,
+                    hand_scale=None, sn_max_medscale=2.0, sn_min_medscale=0.5, maxiter_reject=5, sn_cap=20.0,
+                    lower=3.0, upper=3.0, chunk_size=1000000, scratch_dir=None, verbose=False):
+    '''
+    Coadd many spectra as combspec does, without holding all of them in memory.
+
+    The spec1d files are read lazily (see iter_1dspec) once, and the spectra are copied to scratch arrays (see
+    ScratchArray) in scratch_dir. The steps of combspec are then done out of core:
+
+        - the S/N of all of the exposures is sigma clipped together as in sn_weights (see sigma_clip_streaming),
+          which decides between constant and wavelength dependent weights
+        - the weights, the scaling to the initial stack (scale_spec) and the rejection against the current stack
+          (update_errors and djs_reject) are computed one exposure at a time
+        - the stack is accumulated in chunks of the wavelength grid, reading only the pixels of each exposure
+          that fall in the chunk
+
+    At most one exposure or chunk_size pixels are in memory at a time, besides the stack itself, so memory use
+    does not grow with the number of exposures. The result is that of combspec within floating point round off.
+    Exposures without any good pixels get no weight. Unlike combspec, maxrej is not supported, since it limits
+    the number of rejected pixels of all of the exposures together.
+    Args:
+        fnames: list of spec1d files
+        gdobj: list of object names, one for each file
+        wave_grid: edges of the wavelength bins of the stack, e.g. from new_wave_grid
+        order: set to None if longslit data
+        ex_value: 'OPT' or 'BOX'
+        flux_value: use the fluxed spectra if True, otherwise the counts
+        dv_smooth, const_weights: as for sn_weights
+        ref_percentile, maxiter_scale, sigrej, scale_method, hand_scale, sn_max_medscale, sn_min_medscale: as
+            for scale_spec
+        maxiter_reject, sn_cap, lower, upper: as for combspec
+        chunk_size: number of pixels of all of the exposures read at a time
+        scratch_dir: directory for the scratch arrays, which are deleted at the end. Defaults to the system
+            temporary directory
+    Returns:
+        wave_stack, flux_stack, ivar_stack, mask_stack, nused, rms_sn
+    '''
+    nexp = len(fnames)
+    nspec = np.array([wave.size for iexp, wave, flux, ivar, mask in iter_1dspec(
+        fnames, gdobj, order=order, ex_value=ex_value, flux_value=flux_value)])
+    stack = StackAccumulator(wave_grid)
+    # The stack bins of each chunk, and the first and last pixel of each exposure in each of them
+    bins_chunk = max(chunk_size//nexp, 1)
+    nchunk = (stack.nbins + bins_chunk - 1)//bins_chunk
+    pix_lo = np.full((nexp, nchunk), nspec.max())
+    pix_hi = np.zeros((nexp, nchunk), dtype=int)
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as tmpdir, contextlib.ExitStack() as scratch_files:
+        # Spectra shorter than the longest one are padded with masked pixels
+        scratch = {name: scratch_files.enter_context(
+                       ScratchArray(os.path.join(tmpdir, name + '.dat'), (nexp, nspec.max()), dtype=dtype))
+                   for name, dtype in [('waves', float), ('fluxes', float), ('ivars', float), ('masks', bool),
+                                       ('weights', float), ('fluxes_scale', float), ('ivars_scale', float),
+                                       ('outmask', bool)]}
+        # The S/N of the good pixels of all of the exposures, one after the other
+        sn_end = np.zeros(nexp + 1, dtype=int)
+        with open(os.path.join(tmpdir, 'sn.dat'), 'wb') as sn_file:
+            for iexp, wave, flux, ivar, mask in iter_1dspec(fnames, gdobj, order=order, ex_value=ex_value,
+                                                            flux_value=flux_value):
+                for name, value in zip(['waves', 'fluxes', 'ivars', 'masks'], [wave, flux, ivar, mask]):
+                    scratch[name][iexp, :nspec[iexp]] = value
+                sn_val = _sn_val(np.asarray(flux), np.asarray(ivar))[np.asarray(mask)]
+                sn_val = sn_val[np.isfinite(sn_val)]
+                sn_file.write(sn_val.tobytes())
+                sn_end[iexp + 1] = sn_end[iexp] + sn_val.size
+
+                bins = stack.bin_index(np.asarray(wave))
+                good = np.flatnonzero(bins >= 0)
+                np.minimum.at(pix_lo[iexp], bins[good]//bins_chunk, good)
+                np.maximum.at(pix_hi[iexp], bins[good]//bins_chunk, good + 1)
+
+        # The S/N of each exposure, sigma clipped with those of all of the other exposures as in sn_weights
+        with ScratchArray(os.path.join(tmpdir, 'sn.dat'), (sn_end[-1],)) as sn_all:
+            min_value, max_value = sigma_clip_streaming(sn_all, sigma=3, maxiters=5, chunk_size=chunk_size)
+            rms_sn = np.zeros(nexp)
+            has_sn = np.zeros(nexp, dtype=bool)
+            for iexp in range(nexp):
+                sn_val = np.asarray(sn_all[sn_end[iexp]:sn_end[iexp + 1]])
+                sn_val = sn_val[(sn_val >= min_value) & (sn_val <= max_value)]
+                has_sn[iexp] = sn_val.size > 0
+                rms_sn[iexp] = np.abs(np.mean(sn_val)) if has_sn[iexp] else 0.0
+        if not np.any(has_sn):
+            msgs.error('No good pixels in any of the exposures')
+        rms_sn_stack = np.sqrt(np.mean(rms_sn[has_sn]**2))
+        use_const = const_weights or rms_sn_stack <= 3.0
+        if verbose:
+            msgs.info("Using {:} weights for coadding, RMS S/N = {:g}".format(
+                'constant' if use_const else 'wavelength dependent', rms_sn_stack))
+
+        for iexp in np.flatnonzero(has_sn):
+            spec = slice(0, nspec[iexp])
+            scratch['weights'][iexp, spec] = exposure_weights(
+                scratch['waves'][iexp, spec], scratch['fluxes'][iexp, spec], scratch['ivars'][iexp, spec],
+                scratch['masks'][iexp, spec], rms_sn[iexp], use_const, dv_smooth=dv_smooth)
+
+        def compute_stack_chunks(fluxes, ivars, masks):
+            new_stack = StackAccumulator(wave_grid)
+            for ichunk in range(nchunk):
+                _add_stack_chunk(new_stack, scratch, fluxes, ivars, masks, pix_lo[:, ichunk], pix_hi[:, ichunk],
+                                 ichunk*bins_chunk, (ichunk + 1)*bins_chunk)
+            return new_stack.stack()
+
+        # Rescale the spectra to line up with the initial stack, so that outliers can be sensibly rejected
+        wave_stack, flux_stack, ivar_stack, mask_stack, nused = compute_stack_chunks('fluxes', 'ivars', 'masks')
+        for iexp in range(nexp):
+            spec = slice(0, nspec[iexp])
+            wave, flux, ivar, mask = [scratch[name][iexp, spec] for name in ['waves', 'fluxes', 'ivars', 'masks']]
+            if has_sn[iexp]:
+                flux_stack_nat, ivar_stack_nat, mask_stack_nat = interp_spec(wave, wave_stack, flux_stack,
+                                                                             ivar_stack, mask_stack)
+                flux, ivar = scale_spec(wave, flux, ivar, flux_stack_nat, ivar_stack_nat, mask=mask,
+                                        mask_ref=mask_stack_nat, ref_percentile=ref_percentile,
+                                        maxiters=maxiter_scale, sigrej=sigrej, scale_method=scale_method,
+                                        hand_scale=hand_scale, sn_max_medscale=sn_max_medscale,
+                                        sn_min_medscale=sn_min_medscale, debug=False)[:2]
+            scratch['fluxes_scale'][iexp, spec] = flux
+            scratch['ivars_scale'][iexp, spec] = ivar
+            scratch['outmask'][iexp, spec] = mask
+
+        iIter = 0
+        qdone = False
+        while (not qdone) and (iIter < maxiter_reject):
+            t0 = time.perf_counter()
+            wave_stack, flux_stack, ivar_stack, mask_stack, nused = compute_stack_chunks(
+                'fluxes_scale', 'ivars_scale', 'outmask')
+            qdone = True
+            nrej = 0
+            for iexp in np.flatnonzero(has_sn):
+                spec = slice(0, nspec[iexp])
+                wave, flux, ivar, mask, thismask = [scratch[name][iexp, spec] for name in
+                                                    ['waves', 'fluxes_scale', 'ivars_scale', 'masks', 'outmask']]
+                flux_stack_nat, ivar_stack_nat, mask_stack_nat = interp_spec(wave, wave_stack, flux_stack,
+                                                                             ivar_stack, mask_stack)
+                rejivar = update_errors(wave[None, :], flux[None, :], ivar[None, :], thismask[None, :],
+                                        flux_stack_nat[None, :], ivar_stack_nat[None, :],
+                                        mask_stack_nat[None, :], sn_cap=sn_cap)[0][0]
+                newmask, qdone_exp = pydl.djs_reject(flux, flux_stack_nat, outmask=thismask, inmask=mask,
+                                                     invvar=rejivar, lower=lower, upper=upper, sticky=False)
+                qdone = qdone and qdone_exp
+                nrej += np.sum(np.invert(newmask))
+                scratch['outmask'][iexp, spec] = newmask
+            msgs.info('Rejection iteration {:d}: {:d} pixels masked in {:.2f}s'.format(
+                iIter + 1, nrej, time.perf_counter() - t0))
+            iIter = iIter + 1
+
+        if (iIter == maxiter_reject) & (maxiter_reject != 0):
+            msgs.warn('Maximum number of iterations maxiter={:}'.format(maxiter_reject) + ' reached in coadd_streaming')
+
+        # The final stack using the final mask
+        wave_stack, flux_stack, ivar_stack, mask_stack, nused = compute_stack_chunks(
+            'fluxes_scale', 'ivars_scale', 'outmask')
+
+    return wave_stack, flux_stack, ivar_stack, mask_stack, nused, rms_sn
 
 def coadd_iexp_qa(wave, flux, ivar, flux_stack, ivar_stack, mask=None, mask_stack=None,
                   qafile=None, debug=False):
@@ -1109,11 +1914,12 @@ def combspec(waves, fluxes, ivars, masks, wave_grid_method='pixel', wave_grid_mi
              A_pix=None, v_pix=None, samp_fact = 1.0, ref_percentile=20.0, maxiter_scale=5, sigrej=3,
              scale_method=None, hand_scale=None, sn_max_medscale=2.0, sn_min_medscale=0.5, dv_smooth=10000.0,
              const_weights=False, maxiter_reject=5, sn_cap=20.0, lower=3.0, upper=3.0, maxrej=None,
-             qafile=None, outfile=None, debug=False):
+             qafile=None, outfile=None, debug=False, wave_grid=None, show=True):
 
-    # Define a common fixed wavegrid
-    wave_grid = new_wave_grid(waves,wave_method=wave_grid_method,wave_grid_min=wave_grid_min,wave_grid_max=wave_grid_max,
-                      A_pix=A_pix,v_pix=v_pix,samp_fact=samp_fact)
+    # Define a common fixed wavegrid, unless one was given
+    if wave_grid is None:
+        wave_grid = new_wave_grid(waves,wave_method=wave_grid_method,wave_grid_min=wave_grid_min,
+                                  wave_grid_max=wave_grid_max,A_pix=A_pix,v_pix=v_pix,samp_fact=samp_fact)
 
     # Evaluate the sn_weights. This is done once at the beginning
     rms_sn, weights = sn_weights(waves,fluxes,ivars,masks, dv_smooth=dv_smooth, const_weights=const_weights, verbose=True)
@@ -1139,17 +1945,30 @@ def combspec(waves, fluxes, ivars, masks, wave_grid_method='pixel', wave_grid_mi
     iIter = 0
     qdone = False
     thismask = np.copy(masks)
+    # The stack is updated in place as pixels are rejected (or restored), rather than recomputed
+    stack = StackAccumulator(wave_grid)
+    bins = stack.bin_index(waves)
+    order = stack.bin_order(bins)
+    stack.add(waves, fluxes_scale, ivars_scale, thismask, weights, bins=bins)
 #    while (not qdone) and (iIter < maxiter_reject):
     while (not qdone) and (iIter < maxiter_reject):
-        wave_stack, flux_stack, ivar_stack, mask_stack, nused = compute_stack(
-            waves, fluxes_scale, ivars_scale, thismask, wave_grid, weights)
+        t0 = time.perf_counter()
+        wave_stack, flux_stack, ivar_stack, mask_stack, nused = stack.stack()
         flux_stack_nat, ivar_stack_nat, mask_stack_nat = interp_spec(
             waves, wave_stack, flux_stack, ivar_stack,mask_stack)
         rejivars, sigma_corrs, outchi, maskchi = update_errors(waves, fluxes_scale, ivars_scale, thismask,
                                                                flux_stack_nat, ivar_stack_nat, mask_stack_nat,
                                                                sn_cap=sn_cap)
-        thismask, qdone = pydl.djs_reject(fluxes_scale, flux_stack_nat, outmask=thismask,inmask=masks, invvar=rejivars,
-                                          lower=lower,upper=upper, maxrej=maxrej, sticky=False)
+        newmask, qdone = pydl.djs_reject(fluxes_scale, flux_stack_nat, outmask=np.copy(thismask),inmask=masks,
+                                         invvar=rejivars, lower=lower,upper=upper, maxrej=maxrej, sticky=False)
+        # Only the stack bins of the newly rejected and restored pixels need updating
+        rejected = thismask & np.invert(newmask)
+        restored = newmask & np.invert(thismask)
+        stack.update(waves, fluxes_scale, ivars_scale, newmask, weights, rejected | restored, bins=bins,
+                     order=order)
+        thismask = newmask
+        msgs.info('Rejection iteration {:d}: {:d} pixels rejected, {:d} restored in {:.2f}s'.format(
+            iIter + 1, np.sum(rejected), np.sum(restored), time.perf_counter() - t0))
         # print out how much was rejected
         for iexp in range(nexp):
             thisreject = thismask[iexp,:]
@@ -1163,9 +1982,8 @@ def combspec(waves, fluxes, ivars, masks, wave_grid_method='pixel', wave_grid_mi
         msgs.warn('Maximum number of iterations maxiter={:}'.format(maxiter_reject) + ' reached in combspec')
     outmask = np.copy(thismask)
 
-    # Compute the final stack using this outmask
-    wave_stack, flux_stack, ivar_stack, mask_stack, nused = compute_stack(
-        waves, fluxes_scale, ivars_scale, outmask, wave_grid, weights)
+    # The final stack using this outmask
+    wave_stack, flux_stack, ivar_stack, mask_stack, nused = stack.stack()
     # Used only for plotting below
     flux_stack_nat, ivar_stack_nat, mask_stack_nat = interp_spec(waves, wave_stack, flux_stack, ivar_stack, mask_stack)
     if debug:
@@ -1180,7 +1998,7 @@ def combspec(waves, fluxes, ivars, masks, wave_grid_method='pixel', wave_grid_mi
     # Plot the final coadded spectrum
     if debug:
         weights_qa(waves, weights, outmask, debug=True)
-    coadd_qa(wave_stack,flux_stack,ivar_stack, nused, mask=mask_stack, qafile=qafile, debug=True)
+    coadd_qa(wave_stack,flux_stack,ivar_stack, nused, mask=mask_stack, qafile=qafile, debug=show)
 
     # Write to disk?
     if outfile is not None:
@@ -1192,6 +2010,129 @@ def combspec(waves, fluxes, ivars, masks, wave_grid_method='pixel', wave_grid_mi
     return wave_stack, flux_stack, ivar_stack, mask_stack, outmask, weights, scales, rms_sn
 
 
+def load_1dspec_objects(fnames, objids, order=None, ex_value='OPT', flux_value=True):
+    '''
+    Load the spectra of many objects, e.g. all of the objects on a slitmask, reading each spec1d file once.
+    Args:
+        fnames: list of nexp spec1d files
+        objids: dict mapping each object's name to the list of its object ids, one for each file
+        order: set to None if longslit data
+        ex_value: 'OPT' or 'BOX'
+        flux_value: use the fluxed spectra if True, otherwise the counts
+    Returns:
+        spectra: dict mapping each object's name to its (waves, fluxes, ivars, masks) arrays, of shape
+                 (nexp, nspec). Spectra shorter than the longest spectrum of the object are padded with
+                 masked pixels.
+        headers: list of the primary headers of the files
+    '''
+    nexp = len(fnames)
+    exposures = {name: [] for name in objids}
+    headers = []
+    for iexp, fname in enumerate(fnames):
+        with fits.open(fname, memmap=True) as hdul:
+            headers.append(hdul[0].header.copy())
+            for name, ids in objids.items():
+                exposures[name].append([np.array(x) for x in read_spec1d_ext(
+                    hdul, fname, ids[iexp], order=order, ex_value=ex_value, flux_value=flux_value)])
+
+    spectra = {}
+    for name, specs in exposures.items():
+        nspec = max([wave.size for wave, flux, ivar, mask in specs])
+        waves = np.zeros((nexp, nspec))
+        fluxes = np.zeros_like(waves)
+        ivars = np.zeros_like(waves)
+        masks = np.zeros_like(waves, dtype=bool)
+        for iexp, (wave, flux, ivar, mask) in enumerate(specs):
+            waves[iexp, :wave.size] = wave
+            fluxes[iexp, :wave.size] = flux
+            ivars[iexp, :wave.size] = ivar
+            masks[iexp, :wave.size] = mask
+        spectra[name] = (waves, fluxes, ivars, masks)
+    return spectra, headers
+
+def _combspec_object(name, waves, fluxes, ivars, masks, kwargs):
+    '''
+    Coadd a single object for multi_object_combspec, returning its name, the combspec result and the time taken.
+    '''
+    t0 = time.perf_counter()
+    result = combspec(waves, fluxes, ivars, masks, **kwargs)
+    # Don't accumulate the QA figures of every object
+    plt.close('all')
+    return name, result, time.perf_counter() - t0
+
+def _object_filename(filename, name):
+    '''
+    Output file of a single object for multi_object_combspec: the object's name is added before the extension,
+    e.g. coadd.fits becomes coadd_<name>.fits, so that the objects do not overwrite each other's files.
+    '''
+    if filename is None:
+        return None
+    root, ext = os.path.splitext(filename)
+    return '{:s}_{:s}{:s}'.format(root, name, ext)
+
+def multi_object_combspec(fnames, objids, nproc=1, order=None, ex_value='OPT', flux_value=True,
+                          wave_grid_method='pixel', wave_grid_min=None, wave_grid_max=None, A_pix=None, v_pix=None,
+                          samp_fact=1.0, **kwargs):
+    '''
+    Coadd many objects at once, e.g. all of the objects on a DEIMOS or MOSFIRE slitmask.
+
+    Each spec1d file is read once for all of the objects, all of the objects are coadded onto the same
+    wavelength grid, and the objects are coadded in parallel across nproc processes.
+    Args:
+        fnames: list of nexp spec1d files
+        objids: dict mapping each object's name to the list of its object ids, one for each file
+        nproc: number of processes to coadd the objects with
+        order, ex_value, flux_value: passed to load_1dspec_objects
+        wave_grid_method, wave_grid_min, wave_grid_max, A_pix, v_pix, samp_fact: passed to new_wave_grid to make
+            the wavelength grid shared by all of the objects
+        kwargs: passed to combspec. The QA plots are not shown unless show=True is given. A qafile or outfile
+            is written for each object, with the object's name added before the extension (see _object_filename).
+    Returns:
+        results: dict mapping each object's name to the outputs of combspec
+        timings: dict with the time taken to 'read' the files and make the wavelength 'grid', the 'total' time,
+                 and under 'objects' a dict of the time taken to coadd each object, keyed by the object's name
+    '''
+    t_start = time.perf_counter()
+    timings = {'objects': {}}
+
+    spectra, _ = load_1dspec_objects(fnames, objids, order=order, ex_value=ex_value, flux_value=flux_value)
+    timings['read'] = time.perf_counter() - t_start
+
+    # One wavelength grid shared by all of the objects
+    t0 = time.perf_counter()
+    nspec = max([waves.shape[1] for waves, fluxes, ivars, masks in spectra.values()])
+    all_waves = np.vstack([np.pad(waves, ((0, 0), (0, nspec - waves.shape[1])))
+                           for waves, fluxes, ivars, masks in spectra.values()])
+    wave_grid = new_wave_grid(all_waves, wave_method=wave_grid_method, wave_grid_min=wave_grid_min,
+                              wave_grid_max=wave_grid_max, A_pix=A_pix, v_pix=v_pix, samp_fact=samp_fact)
+    timings['grid'] = time.perf_counter() - t0
+
+    combspec_kwargs = dict(show=False)
+    combspec_kwargs.update(kwargs)
+    combspec_kwargs['wave_grid'] = wave_grid
+
+    results = {}
+    args = []
+    for name in objids:
+        object_kwargs = dict(combspec_kwargs)
+        for key in ['qafile', 'outfile']:
+            object_kwargs[key] = _object_filename(combspec_kwargs.get(key), name)
+        args.append((name,) + spectra[name] + (object_kwargs,))
+    if nproc == 1:
+        outputs = [_combspec_object(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            outputs = list(executor.map(_combspec_object, *zip(*args)))
+    for name, result, dt in outputs:
+        results[name] = result
+        timings['objects'][name] = dt
+        msgs.info('Coadded {:} in {:.2f}s'.format(name, dt))
+
+    timings['total'] = time.perf_counter() - t_start
+    msgs.info('Coadded {:d} objects from {:d} files in {:.2f}s'.format(len(objids), len(fnames), timings['total']))
+    return results, timings
+
+
 ###### Old functions
 def long_reject(waves, fluxes, ivars, masks, fluxes_stack, ivars_stack, do_offset=True,
                 sigrej_final=3.,do_var_corr=True, qafile=None, SN_MAX = 20.0, debug=False):
@@ -1200,6 +2141,11 @@ def long_reject(waves, fluxes, ivars, masks, fluxes_stack, ivars_stack, do_offse
 
     outmasks = np.copy(masks)
 
+    # var_tot of all of the exposures, with its median filters computed for every exposure at once
+    vars_tot = utils.calc_ivar(ivars_stack) + utils.calc_ivar(ivars)
+    vars_med = running_median(vars_tot, 5)
+    vars_smooth = running_median(vars_tot, 99)
+
     # Loop on images to update noise model for rejection
     for iexp in range(nexp):
 
@@ -1210,14 +2156,13 @@ def long_reject(waves, fluxes, ivars, masks, fluxes_stack, ivars_stack, do_offse
 
         # Grab the stack with the same grid with the iexp
         newflux_now = fluxes_stack[iexp,:]
-        newvar = utils.calc_ivar(ivars_stack[iexp,:])
 
         # var_tot
-        var_tot = newvar + utils.calc_ivar(ivar)
+        var_tot = vars_tot[iexp,:]
         ivar_real = utils.calc_ivar(var_tot)
         # smooth out possible outliers in noise
-        var_med = scipy.ndimage.filters.median_filter(var_tot, size=5, mode='reflect')
-        var_smooth = scipy.ndimage.filters.median_filter(var_tot, size=99, mode='reflect')
+        var_med = vars_med[iexp,:]
+        var_smooth = vars_smooth[iexp,:]
         # conservatively always take the largest variance
         var_final = np.maximum(var_med, var_smooth)
         ivar_final = utils.calc_ivar(var_final)
@@ -1339,11 +2284,17 @@ def long_comb(waves, fluxes, ivars, masks,wave_method='pixel', wave_grid_min=Non
     # Doing rejections and coadding based on the scaled spectra
     iIter = 0
     thismask = np.copy(masks)
+    # The stack is updated in place as pixels are rejected, rather than recomputed
+    stack = StackAccumulator(wave_grid)
+    bins = stack.bin_index(waves)
+    order = stack.bin_order(bins)
+    stack.add(waves, fluxes_scale, ivars_scale, thismask, weights, bins=bins)
     while iIter < maxiter_reject:
-        wave_stack, flux_stack, ivar_stack, mask_stack, nused = compute_stack(waves, fluxes_scale, ivars_scale,thismask,\
-                                                                       wave_grid, weights)
+        t0 = time.perf_counter()
+        wave_stack, flux_stack, ivar_stack, mask_stack, nused = stack.stack()
         fluxes_native_stack, ivars_native_stack, masks_native_stack = interp_spec(waves, wave_stack, flux_stack, \
                                                                                   ivar_stack,mask_stack)
+        prevmask = thismask
         if iIter == maxiter_reject -1:
             thismask = long_reject(waves, fluxes_scale, ivars_scale, thismask, fluxes_native_stack, \
                                    ivars_native_stack, SN_MAX=sn_max_reject, do_offset=do_offset, \
@@ -1354,8 +2305,17 @@ def long_comb(waves, fluxes, ivars, masks,wave_method='pixel', wave_grid_min=Non
                                    ivars_native_stack, SN_MAX=sn_max_reject, do_offset=do_offset, \
                                    sigrej_final=sigrej_final, do_var_corr=do_var_corr, qafile=None,\
                                    debug=False)
+        rejected = prevmask & np.invert(thismask)
+        stack.update(waves, fluxes_scale, ivars_scale, thismask, weights, rejected, bins=bins, order=order)
+        nrej = np.sum(rejected)
+        msgs.info('Rejection iteration {:d}: {:d} pixels rejected in {:.2f}s'.format(
+            iIter + 1, nrej, time.perf_counter() - t0))
 
         iIter = iIter +1
+        # The mask, and therefore the stack, won't change again. Keep going when debugging so the
+        # QA of the final iteration is shown.
+        if nrej == 0 and not debug:
+            break
 
     # TODO Add a plot of nused on the final coadd. Maybe add a second plot where we show the S/N weights
     # Plot the final coadded spectrum
@@ -0,0 +1,69 @@
+"""
+Running median filter with the same 'reflect' boundary conditions as scipy.ndimage.median_filter.
+
+The window is moved along an axis with bottleneck's double heap moving median, which takes
+O(n log w) time for a window of w pixels. Masked pixels are ignored, and multi-dimensional input
+is filtered along every row in a single call, e.g. all of the exposures of a coadd at once, where
+median_filter takes O(n w) time. For a single spectrum median_filter is as fast, so use it there.
+"""
+import numpy as np
+import bottleneck
+
+from pypeit import msgs
+
+
+def running_median(data, window_size, mask=None, axis=-1):
+    """
+    Compute the running median of data along an axis.
+
+    The input is extended by reflecting about the edge of the last pixel, as for the
+    scipy.ndimage.median_filter 'reflect' mode (`d c b a | a b c d | d c b a`), and the window
+    of pixel i covers pixels i - window_size//2 to i + (window_size-1)//2. Without masked pixels
+    the result is identical to median_filter, which for even window sizes is the larger of the
+    two middle values. With masked pixels the median of the good pixels of each window is
+    returned, the mean of the two middle values if there is an even number of them.
+
+    Windows larger than the data are clamped to the largest size of the same parity that fits
+    in it, since the reflected input then repeats itself within a window (and median_filter
+    reads past the end of its reflected input for some such sizes).
+
+    Args:
+        data (array): Values to filter.
+        window_size (int): Size of the running window in pixels.
+        mask (bool array, optional): Same shape as data, True for good pixels. Masked pixels,
+            and NaNs in data, are ignored when computing the median. The result is NaN where a
+            window has no good pixels.
+        axis (int): Axis to filter along. Defaults to the last axis.
+
+    Returns:
+        ndarray: Median filtered values, with the same shape as data.
+    """
+    window_size = int(window_size)
+    if window_size < 1:
+        msgs.error('window_size must be at least 1, not {:d}'.format(window_size))
+
+    values = np.moveaxis(np.asarray(data, dtype=float), axis, -1)
+    if mask is not None:
+        values = np.where(np.moveaxis(np.asarray(mask, dtype=bool), axis, -1), values, np.nan)
+    nspec = values.shape[-1]
+    if window_size > nspec:
+        window_size = nspec - (window_size - nspec) % 2 if nspec > 1 else 1
+    if window_size == 1 or nspec == 0:
+        return np.moveaxis(values.copy(), -1, axis)
+
+    # move_median gives the median of the window ending at each pixel, so pad by the part of the
+    # centered window that extends past each edge and drop the first window_size-1 outputs.
+    pad = [(0, 0)]*(values.ndim - 1) + [(window_size//2, (window_size - 1)//2)]
+    padded = np.pad(values, pad, mode='symmetric')
+    if window_size % 2 == 0 and not np.isnan(padded).any():
+        # The larger of the two middle values, as median_filter. Each value is followed by +inf and
+        # -inf, so that the window_size values of a window, with the window_size +inf and the
+        # window_size-1 -inf around them, have an odd size and their median is the one we want.
+        fill = np.empty(padded.shape[:-1] + (3*padded.shape[-1],))
+        fill[..., 0::3] = padded
+        fill[..., 1::3] = np.inf
+        fill[..., 2::3] = -np.inf
+        result = bottleneck.move_median(fill, 3*window_size - 1, axis=-1)[..., 3*window_size - 2::3]
+    else:
+        result = bottleneck.move_median(padded, window_size, min_count=1, axis=-1)[..., window_size - 1:]
+    return np.moveaxis(result[..., :nspec], -1, axis)
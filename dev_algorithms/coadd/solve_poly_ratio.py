@@ -1,21 +1,14 @@
-
-
+"""
+Compare the solve_poly_ratio fits with the analytic gradient (the default) to the original finite difference fits,
+on the LRIS and GMOS stacks of dev_coadd1d.py. Every exposure is rescaled to the first one of its stack.
+"""
 import numpy as np
-import scipy
-import matplotlib.pyplot as plt
+import time
 import os
 from pypeit import utils
-from pypeit.core import coadd
-from scipy import interpolate
-from coadd1d import interp_spec
-from scipy import stats
-from pypeit import msgs
-import IPython
-from coadd1d import solve_poly_ratio
 from astropy.table import Table
 from astropy.io import fits
-from matplotlib import pyplot as plt
-import sys
+from coadd1d_old import interp_spec, solve_poly_ratio, load_1dspec_objects
 
 
 def read_lris_stack():
@@ -57,18 +50,52 @@ def read_lris_stack():
     return wave_arr, flux_arr, ivar_arr, mask_arr
 
 
-#plt.plot(wave_ref, flux_ref, drawstyle='steps-mid')
-#for ii in range(nfiles):
-#    plt.plot(wave_arr[:,ii], flux_arr[:,ii],drawstyle='steps-mid')
+def read_gmos_stack():
+    datapath = os.path.join(os.getenv('HOME'),'Dropbox/PypeIt_Redux/GMOS/R400_Flux/')
+    fnames = [datapath+'spec1d_flux_S20180903S0136-J0252-0503_GMOS-S_1864May27T160716.387.fits',\
+              datapath+'spec1d_flux_S20180903S0137-J0252-0503_GMOS-S_1864May27T160719.968.fits',\
+              datapath+'spec1d_flux_S20180903S0138-J0252-0503_GMOS-S_1864May27T160723.353.fits',\
+              datapath+'spec1d_flux_S20180903S0141-J0252-0503_GMOS-S_1864May27T160727.033.fits',\
+              datapath+'spec1d_flux_S20180903S0142-J0252-0503_GMOS-S_1864May27T160730.419.fits',\
+              datapath+'spec1d_flux_S20181015S0140-J0252-0503_GMOS-S_1864May27T185252.770.fits']
+    gdobj = ['SPAT1073-SLIT0001-DET03','SPAT1167-SLIT0001-DET03','SPAT1071-SLIT0001-DET03','SPAT1072-SLIT0001-DET03',
+             'SPAT1166-SLIT0001-DET03','SPAT1073-SLIT0001-DET03']
+    spectra, headers = load_1dspec_objects(fnames, {'J0252-0503': gdobj})
+    return spectra['J0252-0503']
+
+
+def compare_poly_ratio(waves, fluxes, ivars, masks, norder=3, label=''):
+    """
+    Rescale every exposure to the first one with and without the analytic gradient, and print the
+    cumulative timings and the largest fractional difference between the two rescaling vectors.
+    """
+    wave = waves[0, :]
+    flux_ref, ivar_ref, mask_ref = fluxes[0, :], ivars[0, :], masks[0, :]
+    fluxes_inter, ivars_inter, masks_inter = interp_spec(wave, waves, fluxes, ivars, masks)
+
+    print('{:s} norder={:d}'.format(label, norder))
+    print('{:>5s} {:>10s} {:>10s} {:>14s}'.format('iexp', 'fd (s)', 'jac (s)', 'max rel diff'))
+    total = np.zeros(2)
+    for iexp in range(1, waves.shape[0]):
+        ymults = []
+        for ii, analytic_jac in enumerate([False, True]):
+            t0 = time.perf_counter()
+            ymult, flux_rescale, ivar_rescale, outmask = solve_poly_ratio(
+                wave, fluxes_inter[iexp], ivars_inter[iexp], flux_ref, ivar_ref, norder,
+                mask=masks_inter[iexp], mask_ref=mask_ref, analytic_jac=analytic_jac)
+            total[ii] += time.perf_counter() - t0
+            ymults.append(ymult)
+        good = masks_inter[iexp] & mask_ref
+        diff = np.max(np.abs(ymults[1] - ymults[0])[good]/ymults[0][good])
+        print('{:5d} {:10.3f} {:10.3f} {:14.3g}'.format(iexp, *total, diff))
+    print('Speedup: {:.1f}x'.format(total[0]/total[1]))
 
-    #flux_inter, ivar_inter, mask_inter = interp_spec(wave_ref, wave_arr, flux_arr, ivar_arr, mask_arr)
 
-    #idx = 5
-    #wave = wave_ref
-    #flux = flux_inter[idx, :]
-    #ivar = ivar_inter[idx, :]
-    #mask = ivar > 0
-    #norder = 3
+if __name__ == '__main__':
+    waves, fluxes, ivars, masks = read_lris_stack()
+    for norder in [2, 3, 5]:
+        compare_poly_ratio(waves.T, fluxes.T, ivars.T, masks.T, norder=norder, label='LRIS')
 
-#ymult,flux_rescale, ivar_rescale, outmask = solve_poly_ratio(wave, flux, ivar, flux_ref, ivar_ref, norder,
- #                                                            mask=mask, mask_ref=mask_ref, debug=True)
\ No newline at end of file
+    waves, fluxes, ivars, masks = read_gmos_stack()
+    for norder in [2, 3, 5]:
+        compare_poly_ratio(waves, fluxes, ivars, masks, norder=norder, label='GMOS')
@@ -0,0 +1,108 @@
+"""
+Benchmark the red/blue slit matching of dmost_slit_matching on a synthetic DEIMOS mask.
+
+The KD-tree matching of spec1d_match_red_blue is timed against the previous loop over the blue
+objects, and the two match tables are checked to be identical.
+
+    python benchmark_slit_matching.py --nobj 2000
+"""
+import time
+import argparse
+
+import numpy as np
+from astropy.table import Table
+
+import dmost_slit_matching
+
+
+def match_red_blue_loop(aslits):
+    """The previous spec1d_match_red_blue: exact RA equality, one blue object at a time."""
+    aslits['det'] = [int(obj['name'].split('DET')[1]) for obj in aslits]
+    slits = aslits[~(aslits['name'] == 'SERENDIP')]
+    rslits = slits[slits['det'] > 4]
+    bslits = slits[slits['det'] <= 4]
+
+    n = 0
+    for obj in bslits:
+        mtc = (obj['objra'] == rslits['objra'])
+        if np.sum(mtc) == 1:
+            robj = rslits[mtc]
+            if n == 0:
+                matches = Table([[obj['name']], [robj['name']], [obj['det']], [robj['det']],
+                                 [obj['objra']], [obj['objdec']], [obj['objname']], [obj['maskdef_id']], [obj['slit']]],
+                                names=('bname', 'rname', 'bdet', 'rdet', 'objra', 'objdec', 'objname', 'maskdef_id',
+                                       'xpos'))
+            else:
+                matches.add_row((obj['name'], robj['name'], obj['det'], robj['det'],
+                                 obj['objra'], obj['objdec'], obj['objname'], obj['maskdef_id'], obj['slit']))
+            n += 1
+    return matches, n
+
+
+def synthetic_mask(nobj, frac_unmatched=0.05, nserendip=20, seed=1234):
+    """
+    The spec1d txt table of a mask with nobj objects, each with a blue (DET1-4) and a red (DET5-8)
+    spectrum, except for a fraction that only has one of them, plus serendipitous detections.
+    """
+    rng = np.random.default_rng(seed)
+    ra = 150.0 + rng.uniform(-0.05, 0.05, nobj)
+    dec = 2.0 + rng.uniform(-0.1, 0.1, nobj)
+    maskdef_id = np.arange(nobj) + 1000
+    det = rng.integers(1, 5, nobj)
+    spat = rng.integers(10, 2000, nobj)
+
+    which = rng.uniform(size=nobj)
+    has_blue = which > frac_unmatched/2
+    has_red = which < 1 - frac_unmatched/2
+
+    names, ras, decs, objnames, maskids, slits = [], [], [], [], [], []
+    for has, off in [(has_blue, 0), (has_red, 4)]:
+        for i in np.where(has)[0]:
+            names.append('SPAT{:04d}-SLIT{:04d}-DET{:02d}'.format(spat[i], i, det[i] + off))
+            ras.append(ra[i])
+            decs.append(dec[i])
+            objnames.append('obj{:05d}'.format(i))
+            maskids.append(maskdef_id[i])
+            slits.append(i)
+    # Serendipitous detections next to the targets, only seen on one side
+    for i in range(nserendip):
+        names.append('SPAT{:04d}-SLIT{:04d}-DET{:02d}'.format(spat[i] + 20, i, det[i] + 4*(i % 2)))
+        ras.append(ra[i] + 2e-4)
+        decs.append(dec[i])
+        objnames.append('serendip')
+        maskids.append(maskdef_id[i])
+        slits.append(i)
+
+    srt = rng.permutation(len(names))
+    return Table([np.array(names)[srt], np.array(ras)[srt], np.array(decs)[srt], np.array(objnames)[srt],
+                  np.array(maskids)[srt], np.array(slits)[srt]],
+                 names=('name', 'objra', 'objdec', 'objname', 'maskdef_id', 'slit'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nobj', type=int, default=2000, help='Number of objects on the mask')
+    pargs = parser.parse_args()
+
+    aslits = synthetic_mask(pargs.nobj)
+
+    t0 = time.perf_counter()
+    loop_matches, loop_n = match_red_blue_loop(aslits.copy())
+    t1 = time.perf_counter()
+    matches, n = dmost_slit_matching.spec1d_match_red_blue(aslits.copy())
+    t2 = time.perf_counter()
+    all_matches, all_n = dmost_slit_matching.spec1d_match_red_blue(aslits.copy(), keep_unmatched=True)
+    t3 = time.perf_counter()
+
+    # The loop version has 2D (length 1) rname and rdet columns
+    same = (n == loop_n) and all(np.array_equal(np.asarray(matches[key]).ravel(), np.asarray(loop_matches[key]).ravel())
+                                 for key in matches.colnames)
+    print('{:d} objects, {:d} spectra'.format(pargs.nobj, len(aslits)))
+    print('loop:          {:8.3f} s, {:d} matches'.format(t1 - t0, loop_n))
+    print('KD-tree:       {:8.3f} s, {:d} matches, identical to loop: {}'.format(t2 - t1, n, same))
+    print('KD-tree + unmatched: {:8.3f} s, {:d} rows ({:d} blue only, {:d} red only)'.format(
+        t3 - t2, all_n, np.sum(all_matches['rname'] == '-1'), np.sum(all_matches['bname'] == '-1')))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 import numpy as np
 import os
+import time
+from functools import lru_cache
 
 from astropy.table import Table
 from astropy.io import ascii,fits
@@ -61,55 +63,161 @@ def spec_normalize(wave,spec,ivar,nlow=75,npoly=1):
     return nwave,nspec,nivar
 
 
+########################################
+# SKY LINE LIST -- VACUUM WAVELENGTHS, READ ONCE
+SKY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sky_single_mg.dat')
+
+@lru_cache(maxsize=None)
+def load_sky_lines(sky_file=SKY_FILE):
+    sky = ascii.read(sky_file)
+    wave = np.array(sky['Wave'], dtype=float)
+    wave.flags.writeable = False
+    return wave
+
+
+########################################
+# RESULTS OF THE SKY LINE FITS, ONE ROW PER LINE
+SKY_LINE_DTYPE = [('wave', float), ('diff', float), ('diff_err', float),
+                  ('los', float), ('los_err', float), ('cont', float),
+                  ('ampl', float), ('npix', int), ('success', bool)]
+
+
+########################################
+def fit_gaussians(x, y, ivar, gpm, p0, maxiter=200, ftol=1.49012e-08, xtol=1.49012e-08):
+    # Levenberg-Marquardt fit of the gaussian() model to nline windows at once.
+    #   x, y, ivar, gpm : (nline, npix) windows, padded with gpm=False
+    #   p0              : (nline, 4) initial guesses
+    # Returns the best-fit parameters and their errors, scaled by the
+    # reduced chi^2 as in curve_fit, and whether each fit converged.
+    nline = x.shape[0]
+    w = np.where(gpm, ivar, 0.)
+    dof = np.sum(gpm, axis=1) - 4
+
+    def model_jac(p):
+        dx = x - p[:, 2:3]
+        s2 = p[:, 3:4]**2
+        e = np.exp(-0.5*dx**2/s2)
+        ae = p[:, 1:2]*e
+        jac = np.stack([np.ones_like(e), e, ae*dx/s2, ae*dx**2/(s2*p[:, 3:4])], axis=-1)
+        return p[:, 0:1] + ae, jac
+
+    def chi2_of(p):
+        return np.sum(w*(y - model_jac(p)[0])**2, axis=1)
+
+    p = np.array(p0, dtype=float)
+    lam = np.full(nline, 1e-3)
+    active = np.ones(nline, dtype=bool)
+    converged = np.zeros(nline, dtype=bool)
+    with np.errstate(all='ignore'):
+        mod, jac = model_jac(p)
+        chi2 = np.sum(w*(y - mod)**2, axis=1)
+        for it in range(maxiter):
+            if not np.any(active):
+                break
+            jw = jac*w[:, :, None]
+            alpha = np.einsum('lpi,lpj->lij', jw, jac)
+            beta = np.einsum('lpi,lp->li', jw, y - mod)
+            diag = np.einsum('lii->li', alpha)
+            damped = alpha + (lam[:, None]*np.where(diag > 0, diag, 1.))[:, :, None]*np.eye(4)
+            dp = np.linalg.solve(damped[active], beta[active][:, :, None])[:, :, 0]
+            p_new = p.copy()
+            p_new[active] += dp
+            chi2_new = np.full(nline, np.inf)
+            chi2_new[active] = chi2_of(p_new)[active]
+            better = active & np.isfinite(chi2_new) & (chi2_new <= chi2)
+            # Converged if an accepted step barely changes chi^2 or the parameters
+            small = np.zeros(nline, dtype=bool)
+            small[active] = np.all(np.abs(dp) <= xtol*(np.abs(p[active]) + xtol), axis=1)
+            done = better & ((chi2 - chi2_new <= ftol*chi2) | small)
+            p[better] = p_new[better]
+            chi2[better] = chi2_new[better]
+            lam[better] /= 10.
+            lam[active & ~better] *= 10.
+            converged |= done
+            # Stuck, i.e. no step decreases chi^2 any more
+            converged |= active & ~better & (lam > 1e10) & np.isfinite(chi2)
+            active &= ~converged
+            mod, jac = model_jac(p)
+
+        jw = jac*w[:, :, None]
+        alpha = np.einsum('lpi,lpj->lij', jw, jac)
+        perr = np.full((nline, 4), np.inf)
+        ok = np.linalg.cond(alpha) < 1./np.finfo(float).eps
+        cov = np.linalg.inv(alpha[ok])
+        perr[ok] = np.sqrt(np.einsum('lii->li', cov)*(chi2[ok]/dof[ok])[:, None])
+    return p, perr, converged
+
+
+########################################
+def sky_line_windows(wave, line_wave, half_width=5.):
+    # Pixels with line-half_width < wave < line+half_width, for every line
+    # at once. wave must be sorted.
+    lo = np.searchsorted(wave, line_wave - half_width, side='right')
+    hi = np.searchsorted(wave, line_wave + half_width, side='left')
+    return lo, hi - lo
+
+
+########################################
+def fit_sky_lines(wave, flux, ivar, sky_lines=None, half_width=5., min_npix=20):
+    # Fit a gaussian to every sky line with more than min_npix pixels within
+    # half_width of it. Returns a structured array with SKY_LINE_DTYPE.
+    sky_lines = load_sky_lines() if sky_lines is None else sky_lines
+    wave = np.asarray(wave, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    ivar = np.asarray(ivar, dtype=float)
+    if np.any(np.diff(wave) < 0):
+        srt = np.argsort(wave, kind='stable')
+        wave, flux, ivar = wave[srt], flux[srt], ivar[srt]
+
+    lo, npix = sky_line_windows(wave, sky_lines, half_width=half_width)
+    use = npix > min_npix
+    out = np.zeros(np.sum(use), dtype=SKY_LINE_DTYPE)
+    out['wave'] = sky_lines[use]
+    out['npix'] = npix[use]
+    if out.size == 0:
+        return out
+
+    # Fixed size windows, padded with gpm = False
+    ipix = np.arange(np.max(npix[use]))
+    gpm = ipix[None, :] < npix[use][:, None]
+    idx = np.minimum(lo[use][:, None] + ipix[None, :], wave.size - 1)
+    x, y, iv = wave[idx], flux[idx], ivar[idx]
+
+    # Same initial guesses as gauss_guess
+    ymasked = np.where(gpm, y, np.nan)
+    p0 = np.stack([np.nanmedian(ymasked, axis=1),
+                   np.nanmax(ymasked, axis=1) - np.nanmin(ymasked, axis=1),
+                   np.sum(np.where(gpm, x, 0.), axis=1)/out['npix'],
+                   np.full(out.size, 0.5)], axis=1)
+
+    p, perr, success = fit_gaussians(x, y, iv, gpm, p0)
+    out['cont'], out['ampl'], out['los'] = p[:, 0], p[:, 1], p[:, 3]
+    out['diff'] = p[:, 2] - out['wave']
+    out['diff_err'] = np.where(np.isfinite(perr[:, 2]), perr[:, 2], 1000.)
+    out['los_err'] = perr[:, 3]
+    out['success'] = success
+    return out
+
+
 #####################################################
 # CALCULATE SKY EMISSION LINE 
 #
 def sky_em_residuals(wave,flux,ivar,plot=0, orig=False, toler=0.3):
 
-    # READ SKY LINES -- THESE ARE VACUUM WAVELENGTHS
-    #sky_file = DEIMOS_DROPBOX+'Other_data/sky_single_mg.dat'
-    # TODO -- Path in PypeIt
-    sky_file = 'sky_single_mg.dat'
-    sky=ascii.read(sky_file)
-    
+    # SKY LINES ARE VACUUM WAVELENGTHS, READ ONCE
+    sky_lines = load_sky_lines()
 
     if orig:
-        dwave = []
-        diff = []
-        diff_err  = []
-        los = []
-        los_err= []
-        for line in sky['Wave']:
-            wline = [line-5.,line+5.] 
-            mw    = (wave > wline[0]) & (wave < wline[1])
-            
-            p=[0,0,0,0]
-            if np.sum(mw) > 20:
-                p0 = gauss_guess(wave[mw],flux[mw])
-                try:
-                    p, pcov = curve_fit(gaussian,wave[mw],flux[mw], 
-                                        sigma = 1./np.sqrt(ivar[mw]), p0=p0)
-                    perr = np.sqrt(np.diag(pcov))
-                except:
-                    p=p0
-                    p[2] = -99
-                    perr=p0
-                gfit = gaussian(wave[mw],*p)
-                d = p[2] - line
-
-                if (plot==1):
-                    plt.figure(figsize=(8,3)) 
-                    plt.plot(wave[mw],gfit,'g')
-                    plt.plot(wave[mw],flux[mw])
-                    plt.title('{} {:0.2f} diff= {:0.3f}'.format(line,p[3],d))
-
-                if ~np.isfinite(perr[2]):
-                    perr[2] = 1000.
-                dwave = np.append(dwave,line)
-                diff = np.append(diff,d)
-                diff_err = np.append(diff_err,perr[2])
-                los = np.append(los,p[3])
-                los_err = np.append(los_err,perr[3])
+        # FIT ALL LINES AT ONCE
+        fits = fit_sky_lines(wave, flux, ivar, sky_lines=sky_lines)
+        if (plot==1):
+            for f in fits:
+                mw = (wave > f['wave']-5.) & (wave < f['wave']+5.)
+                p = [f['cont'], f['ampl'], f['wave']+f['diff'], f['los']]
+                plt.figure(figsize=(8,3))
+                plt.plot(wave[mw],gaussian(wave[mw],*p),'g')
+                plt.plot(wave[mw],flux[mw])
+                plt.title('{} {:0.2f} diff= {:0.3f}'.format(f['wave'],f['los'],f['diff']))
     else:
         # New approach
         all_tcent, all_ecent, cut_tcent, icut, arc_cont_sub, \
@@ -127,7 +235,7 @@ def sky_em_residuals(wave,flux,ivar,plot=0, orig=False, toler=0.3):
         los_err2 = []
         f_wv = interp1d(np.arange(wave.size), wave)
         gd_wave = f_wv(all_tcent[icut])
-        for line in sky['Wave']:
+        for line in sky_lines:
             if np.min(np.abs(line-gd_wave)) < toler:
                 imin = np.argmin(np.abs(line-gd_wave))
                 dwave2.append(line)
@@ -140,8 +248,9 @@ def sky_em_residuals(wave,flux,ivar,plot=0, orig=False, toler=0.3):
     #embed(header='compare these on 113 of dmost_flexure')
             
     if orig:
-        m=(diff_err < 0.1) & (diff_err > 0.0)
-        return dwave[m],diff[m],diff_err[m],los[m],los_err[m]
+        m = fits['success'] & (fits['diff_err'] < 0.1) & (fits['diff_err'] > 0.0)
+        fits = fits[m]
+        return fits['wave'],fits['diff'],fits['diff_err'],fits['los'],fits['los_err']
     else:
         return np.array(dwave2), np.array(diff2), np.array(diff_err2), \
             np.array(los2), np.array(los_err2)
@@ -157,60 +266,117 @@ def fit_sky_linear(wlines,wdiff,wdiff_err):
     return p
 
 #######################################################
-#  
+#  READ THE SPECTRA OF ALL SLITS IN ONE PASS
 #
-def measure_sky_lines(slits, nslits, hdu, orig=True):
+SPEC_COLUMNS = ['OPT_WAVE', 'OPT_COUNTS', 'OPT_COUNTS_SKY', 'OPT_COUNTS_IVAR']
+
+def read_slit_spectra(hdu, slits, columns=SPEC_COLUMNS):
+    # Copy the columns of the red and blue extensions of all slits with
+    # data out of the (memory-mapped) spec1d HDUList, so that they can be
+    # sent to the worker processes. Both arms are read for every slit with
+    # rSN > 0, which update_flexure_fit measures, even if the blue one is
+    # faint. Returns {extension name: {column: array}}
+    m = slits['rSN'] > 0
+    names = np.concatenate((slits['rname'][m], slits['bname'][m]))
+    spectra = {}
+    for name in np.unique(names):
+        try:
+            data = hdu[name].data
+            spectra[name] = {c: np.array(data[c]) for c in columns}
+        except KeyError:
+            continue
+    return spectra
+
+
+def run_slits(func, tasks, nproc=1):
+    # Run func over the per-slit tasks, in a process pool if nproc > 1
+    if nproc is None or nproc > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            return list(executor.map(func, tasks, chunksize=max(1, len(tasks)//(4*(nproc or os.cpu_count())))))
+    return [func(task) for task in tasks]
 
-    for i in np.arange(0,nslits,1):
-        if (i % 10) == 0:
-            print("Working on slit {} of {}".format(i, nslits))
 
-        if (slits['rSN'][i] > 1.) & (slits['bSN'][i] > 1.):
-            r = slits['rname'][i]
-            b = slits['bname'][i]
+#######################################################
+#  FIT THE SKY LINE OFFSETS OF ONE SLIT WITH A LINE
+#
+def measure_slit_sky_lines(task):
 
+    r_data, b_data, orig = task
 
-            # SKY LINES FIRST
-            r_sky_line, r_sky_diff,r_sky_ediff,r_los,r_elos = sky_em_residuals(hdu[r].data['OPT_WAVE'], \
-                                                    hdu[r].data['OPT_COUNTS_SKY'],\
-                                                    hdu[r].data['OPT_COUNTS_IVAR'], orig=orig)
+    # SKY LINES FIRST
+    r_sky_line, r_sky_diff,r_sky_ediff,r_los,r_elos = sky_em_residuals(r_data['OPT_WAVE'], \
+                                            r_data['OPT_COUNTS_SKY'],\
+                                            r_data['OPT_COUNTS_IVAR'], orig=orig)
 
-            b_sky_line, b_sky_diff,b_sky_ediff,b_los,b_elos = sky_em_residuals(hdu[b].data['OPT_WAVE'], \
-                                                    hdu[b].data['OPT_COUNTS_SKY'],\
-                                                    hdu[b].data['OPT_COUNTS_IVAR'], orig=orig)
+    b_sky_line, b_sky_diff,b_sky_ediff,b_los,b_elos = sky_em_residuals(b_data['OPT_WAVE'], \
+                                            b_data['OPT_COUNTS_SKY'],\
+                                            b_data['OPT_COUNTS_IVAR'], orig=orig)
 
 
-            sky_diff  = np.concatenate((r_sky_diff,b_sky_diff),axis=None)
-            sky_lines = np.concatenate((r_sky_line,b_sky_line),axis=None)
-            sky_ediff = np.concatenate((r_sky_ediff,b_sky_ediff),axis=None)
-            sky_los   = np.concatenate((r_los,b_los),axis=None)
+    sky_diff  = np.concatenate((r_sky_diff,b_sky_diff),axis=None)
+    sky_lines = np.concatenate((r_sky_line,b_sky_line),axis=None)
+    sky_ediff = np.concatenate((r_sky_ediff,b_sky_ediff),axis=None)
+    sky_los   = np.concatenate((r_los,b_los),axis=None)
 
-            # FIT SINGLE SLIT SKY LINES WITH A LINE           
-            if orig:
-                fitted_line = fit_sky_linear(sky_lines,sky_diff,sky_ediff)
-            else:
-                linear_fit = pypeit_fitting.robust_fit(sky_lines,
-                                               sky_diff,
-                                               weights=1./sky_ediff**2,  # TO BE CONFIRMED
-                                               function='polynomial', 
-                                               order=1,
-                                               maxrej=1,  # Might increase
-                                               lower=3., upper=3.)
-                # Save in tuple (flipped)
-                fitted_line = linear_fit.fitc
-            
-            slits['fit_slope'][i] = fitted_line[1]
-            slits['fit_b'][i]     = fitted_line[0]
-            slits['fit_los'][i]   = np.median(sky_los)
+    # FIT SINGLE SLIT SKY LINES WITH A LINE           
+    if orig:
+        fitted_line = fit_sky_linear(sky_lines,sky_diff,sky_ediff)
+    else:
+        linear_fit = pypeit_fitting.robust_fit(sky_lines,
+                                       sky_diff,
+                                       weights=1./sky_ediff**2,  # TO BE CONFIRMED
+                                       function='polynomial', 
+                                       order=1,
+                                       maxrej=1,  # Might increase
+                                       lower=3., upper=3.)
+        # Save in tuple (flipped)
+        fitted_line = linear_fit.fitc
+
+    return fitted_line[1], fitted_line[0], np.median(sky_los)
+
+
+#######################################################
+#  
+#
+def measure_sky_lines(slits, nslits, hdu, orig=True, nproc=1, spectra=None):
+
+    if spectra is None:
+        spectra = read_slit_spectra(hdu, slits)
+
+    islits = [i for i in np.arange(0,nslits,1) if (slits['rSN'][i] > 1.) & (slits['bSN'][i] > 1.)]
+    tasks = [(spectra[slits['rname'][i]], spectra[slits['bname'][i]], orig) for i in islits]
+    msgs.info("Measuring sky lines of {} slits".format(len(tasks)))
+
+    for i, (slope, b, los) in zip(islits, run_slits(measure_slit_sky_lines, tasks, nproc=nproc)):
+        slits['fit_slope'][i] = slope
+        slits['fit_b'][i]     = b
+        slits['fit_los'][i]   = los
 
 
     return slits
 
+
+#######################################################
+#  SKY LINE RESIDUAL OF ONE SLIT AFTER THE MASK FIT
+#
+def slit_sky_residual(task):
+
+    f, spectra, orig = task
+
+    all_wave,all_flux,all_ivar,all_sky = dmost_utils.load_spectrum(f,spectra,vacuum = 1)
+
+    dwave,diff,diff_err,los,elos = sky_em_residuals(
+        all_wave,all_sky,all_ivar, plot=0, orig=orig)
+    m=np.isfinite(diff)
+    return np.average(np.abs(diff[m]), weights = 1./diff_err[m]**2)
+
+
 #######################################################
 #  UPDATE SLITS FITS WITH ALL_MASK FIT
 #
 def update_flexure_fit(slits:list, nslits:int, hdu, pmodel_m,pmodel_b,pmodel_los, 
-                       orig=True):
+                       orig=True, nproc=1, spectra=None):
 
     fslits = slits
 
@@ -223,20 +389,19 @@ def update_flexure_fit(slits:list, nslits:int, hdu, pmodel_m,pmodel_b,pmodel_los
     fslits['fit_b']     = pmodel_b(slits['objra'],slits['objdec'])
     fslits['fit_los']   = pmodel_los(slits['objra'],slits['objdec'])
 
-    # CALCULATE RESIDUALS FROM FIT
-    resid_sky = []
-    for f in fslits:
+    if spectra is None:
+        spectra = read_slit_spectra(hdu, fslits)
 
-        if f['rSN'] > 0:
-            all_wave,all_flux,all_ivar,all_sky = dmost_utils.load_spectrum(f,hdu,vacuum = 1)
-
-            dwave,diff,diff_err,los,elos = sky_em_residuals(
-                all_wave,all_sky,all_ivar, plot=0, orig=orig)
-            m=np.isfinite(diff)
-            sky_mean = np.average(np.abs(diff[m]), weights = 1./diff_err[m]**2)
-            resid_sky = np.append(resid_sky,sky_mean)
-        if f['rSN'] <= 0:
-            resid_sky = np.append(resid_sky,-1)
+    # CALCULATE RESIDUALS FROM FIT
+    resid_sky = np.full(len(fslits), -1.)
+    islits = [i for i, f in enumerate(fslits) if f['rSN'] > 0]
+    tasks = []
+    for i in islits:
+        f = fslits[i]
+        names = [f['rname'], f['bname']]
+        tasks.append((dict(rname=f['rname'], bname=f['bname'], fit_slope=f['fit_slope'], fit_b=f['fit_b']),
+                      {n: spectra[n] for n in names if n in spectra}, orig))
+    resid_sky[islits] = run_slits(slit_sky_residual, tasks, nproc=nproc)
 
     fslits['resid_sky'] = resid_sky
 
@@ -271,8 +436,6 @@ def fit_mask_surfaces(slits):
     pmodel_los = fit_p(p_init, slits['objra'][mgood], 
                        slits['objdec'][mgood], slits['fit_los'][mgood])
 
-    embed(header='274 of dmostf')
-    
     return pmodel_m,pmodel_b,pmodel_los
 
 
@@ -434,7 +597,9 @@ def qa_flexure_plots(plot_dir, nslits, slits, fslits, hdu):
 
 
 #######################################################
-def flexure_correct(hdu, data_dir,clobber=0, orig=True):
+def flexure_correct(hdu, data_dir,clobber=0, orig=True, nproc=1):
+    # nproc > 1 measures the slits in a pool of nproc processes,
+    # nproc=None in one process per CPU
 
 
     filename = hdu.filename()
@@ -449,32 +614,54 @@ def flexure_correct(hdu, data_dir,clobber=0, orig=True):
 
     # IF FILE DOESN"T EXIST GENERATE
     if (not os.path.isfile(slit_table_file)) | (clobber == 1):
+        timing = {}
+        t0 = time.perf_counter()
 
         # CREATE SLIT TABLE
         msgs.info("Generating slit table")
         slits, nslits = dmost_slit_matching.create_slit_table(hdu,data_dir,txt)
+        t1 = time.perf_counter()
+        timing['slit table'] = t1 - t0
+
+        # READ ALL SPECTRA ONCE
+        msgs.info("Reading the spectra")
+        spectra = read_slit_spectra(hdu, slits)
+        t0, t1 = t1, time.perf_counter()
+        timing['read'] = t1 - t0
 
         # INITIAL SKY LINE STUFF
         msgs.info("Measuring sky lines")
-        slits = measure_sky_lines(slits, nslits,hdu, orig=orig)
+        slits = measure_sky_lines(slits, nslits,hdu, orig=orig, nproc=nproc, spectra=spectra)
+        t0, t1 = t1, time.perf_counter()
+        timing['sky lines'] = t1 - t0
 
         # FIT SURFACES
         msgs.info("Fitting the surface")
         pmodel_m, pmodel_b,pmodel_los = fit_mask_surfaces(slits)
+        t0, t1 = t1, time.perf_counter()
+        timing['surfaces'] = t1 - t0
 
      
         # ADD TO TABLE
         msgs.info("Table time")
         fslits = update_flexure_fit(slits,nslits, hdu, pmodel_m, pmodel_b,pmodel_los,
-                                    orig=orig)
+                                    orig=orig, nproc=nproc, spectra=spectra)
+        t0, t1 = t1, time.perf_counter()
+        timing['residuals'] = t1 - t0
 
         # REFIT FOR QA PLOTS
         msgs.info("Generate QA")
         qa_flexure_plots(data_dir,nslits,slits,fslits,hdu)
+        t0, t1 = t1, time.perf_counter()
+        timing['QA'] = t1 - t0
 
         msgs.info("Write to table")
         fslits.write(slit_table_file,overwrite=True)
 
+        msgs.info("Flexure of {} ({} slits, nproc={}): ".format(os.path.basename(filename), nslits, nproc) +
+                  ', '.join('{} {:0.1f}s'.format(k, v) for k, v in timing.items()) +
+                  ', total {:0.1f}s'.format(sum(timing.values())))
+
     # ELSE READ IT IN
     if os.path.isfile(slit_table_file):
         fslits = Table.read(slit_table_file)
@@ -482,5 +669,3 @@ def flexure_correct(hdu, data_dir,clobber=0, orig=True):
     print("All done!!")
 
     return fslits
-
-    
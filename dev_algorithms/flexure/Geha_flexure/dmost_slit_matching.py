@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 
 import scipy.ndimage as scipynd
 from scipy.optimize import curve_fit
+from scipy.spatial import cKDTree
 
 import linetools.utils
 
@@ -112,73 +113,93 @@ def get_arc_fit_residuals(slits,data_dir):
 #names=('bext', 'rext','bdet','rdet', 'bspat','rspat','xpos'))
 
 #######################################################
-# MATCH SLITS BASED ON RA
+# MATCH OBJECTS ON THE SKY WITHIN A TOLERANCE
 #######################################################
-def spec1d_match_red_blue(aslits):
+def radec_to_xyz(ra, dec):
+
+    # UNIT VECTORS OF (ra,dec) IN DEGREES
+    ra = np.deg2rad(np.asarray(ra, dtype=float))
+    dec = np.deg2rad(np.asarray(dec, dtype=float))
+    return np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)))
+
+
+def match_radec(ra1, dec1, ra2, dec2, tol=0.1):
+
+    # INDEX OF THE OBJECT IN (ra2,dec2) WITHIN tol ARCSEC OF EACH OBJECT
+    # IN (ra1,dec1), OR -1 IF THERE IS NONE OR MORE THAN ONE.  A KD-TREE
+    # ON UNIT VECTORS, SO THAT RA WRAPS AROUND AT 0/360 AND THE POLES ARE
+    # FINE, WITH tol AS THE CHORD BETWEEN THE TWO POSITIONS
+    idx = np.full(len(ra1), -1)
+    if (len(ra1) == 0) | (len(ra2) == 0):
+        return idx
+
+    tree = cKDTree(radec_to_xyz(ra2, dec2))
+    chord = 2.*np.sin(np.deg2rad(tol/3600.)/2.)
+    dist, ind = tree.query(radec_to_xyz(ra1, dec1), k=min(2, len(ra2)), distance_upper_bound=chord)
+    dist = dist.reshape(len(ra1), -1)
+    ind = ind.reshape(len(ra1), -1)
+
+    # EXACTLY ONE MATCH
+    one = np.isfinite(dist[:,0])
+    if dist.shape[1] > 1:
+        one &= ~np.isfinite(dist[:,1])
+    idx[one] = ind[one,0]
+    return idx
+
+
+#######################################################
+# MATCH SLITS BASED ON RA/DEC
+#######################################################
+def spec1d_match_red_blue(aslits, tol=0.1, keep_unmatched=False):
 
     # ADD DETECTOR NAME
-    det = []
-    for obj in aslits:
-        tmp =   obj['name'].split('DET')
-        tdet = int(tmp[1])
-        det.append(tdet)
-    aslits['det'] = det
+    aslits['det'] = [int(name.split('DET')[1]) for name in aslits['name']]
 
 
     # ***FOR THE MOMENT, REMOVE SERENDIPS
     m=aslits['name'] == 'SERENDIP'
     slits = aslits[~m]
     
-    # MATCH RED TO BLUE VIA RA/DEC
+    # MATCH RED TO BLUE VIA RA/DEC, WITHIN tol ARCSEC
     mb = slits['det'] <=4
     mr = slits['det'] >4
     rslits = slits[mr]
     bslits = slits[mb]
 
-    n=0
-
-    # SEARCH ON BLUE FIRST
-    for obj in bslits:
-
-        mtc = (obj['objra'] == rslits['objra'])
-        if (np.sum(mtc)==1):
-            robj = rslits[mtc]
-            if (obj['objdec'] != robj['objdec']):
-                print('DEC does not match RA!')
-
-            # START ARRAY
-            if (n==0):
-                matches = Table([[obj['name']],[robj['name']],[obj['det']],[robj['det']],\
-                            [obj['objra']],[obj['objdec']],[obj['objname']],[obj['maskdef_id']],[obj['slit']]], \
-                            names=('bname', 'rname','bdet','rdet', 'objra','objdec','objname','maskdef_id','xpos'))
-            if (n > 0):
-                matches.add_row((obj['name'],robj['name'],obj['det'],robj['det'],\
-                                 obj['objra'],obj['objdec'],obj['objname'],obj['maskdef_id'],obj['slit']))
-            n=n+1
-
-        # NO RED MATCH
-        if (np.sum(mtc)==-11): 
-        #if (np.sum(mtc)==0):        
-
-            if (n==0):
-                matches = Table([[obj['name']],['-1'],[obj['det']],[-1],\
-                             [obj['objra']],[obj['objdec']],[obj['objname']],[obj['maskdef_id']],[obj['slit']]], \
-                             names=('bname', 'rname','bdet','rdet', 'objra','objdec','objname','maskdef_id','xpos'))
-            if (n > 0):
-                matches.add_row((obj['name'],'-1',obj['det'],-1,\
-                                 obj['objra'],obj['objdec'],obj['objname'],obj['maskdef_id'],obj['slit']))
-            n=n+1
-
-
-    # SEARCH RED OBJECTS FOR NON-MATCHES IN BLUE
-    for obj in rslits:
-
-        mtc = (obj['objra'] == bslits['objra'])
-        #if (np.sum(mtc)==0):
-
-         #   matches.add_row(('-1',obj['name'],-1,obj['det'],\
-         #                        obj['objra'],obj['objdec'],obj['objname'],obj['maskdef_id'],obj['slit']))
-         #   n=n+1
+    # SEARCH ON BLUE FIRST, THEN RED OBJECTS WITH NO MATCH IN BLUE
+    ridx = match_radec(bslits['objra'], bslits['objdec'], rslits['objra'], rslits['objdec'], tol=tol)
+    bmatch = ridx >= 0
+    if keep_unmatched:
+        rmatched = np.zeros(len(rslits), dtype=bool)
+        rmatched[ridx[bmatch]] = True
+        bkeep = np.ones(len(bslits), dtype=bool)
+        rkeep = ~rmatched
+    else:
+        bkeep = bmatch
+        rkeep = np.zeros(len(rslits), dtype=bool)
+
+    b = bslits[bkeep]
+    r = rslits[rkeep]
+    rm = ridx[bkeep]
+    bm = rm >= 0
+
+    # UNMATCHED OBJECTS GET NAME '-1' AND DET -1 ON THE OTHER SIDE
+    rname = np.full(len(b), '-1', dtype=rslits['name'].dtype if len(rslits) else 'U2')
+    rname[bm] = rslits['name'][rm[bm]]
+    rdet = np.full(len(b), -1)
+    rdet[bm] = rslits['det'][rm[bm]]
+
+    matches = Table([np.concatenate((b['name'], np.full(len(r), '-1'))),
+                     np.concatenate((rname, r['name'])),
+                     np.concatenate((b['det'], np.full(len(r), -1))),
+                     np.concatenate((rdet, r['det'])),
+                     np.concatenate((b['objra'], r['objra'])),
+                     np.concatenate((b['objdec'], r['objdec'])),
+                     np.concatenate((b['objname'], r['objname'])),
+                     np.concatenate((b['maskdef_id'], r['maskdef_id'])),
+                     np.concatenate((b['slit'], r['slit']))],
+                    names=('bname', 'rname','bdet','rdet', 'objra','objdec','objname','maskdef_id','xpos'))
+    n = len(matches)
 
     return matches,n
 
@@ -194,7 +215,7 @@ def initialize_slits(nslits, rbext,hdu):
     for i in np.arange(0,nslits,1):
         
         
-        slits['rname'][i] = rbext['rname'][i][0]
+        slits['rname'][i] = rbext['rname'][i]
         slits['bname'][i] = rbext['bname'][i]
         slits['rdet'][i] = rbext['rdet'][i]
         slits['bdet'][i] = rbext['bdet'][i]
@@ -206,8 +227,8 @@ def initialize_slits(nslits, rbext,hdu):
         slits['slitname'][i] = rbext['objname'][i]
         slits['maskdef_id'][i] = rbext['maskdef_id'][i]
         
-        r =slits['bname'][i] 
-        hdr = hdu[r].header
+#        r =slits['bname'][i] 
+#        hdr = hdu[r].header
 #        slits['rms_arc_r'][i] = hdr['WAVE_RMS']
 
         rSN, bSN = calc_rb_SN(slits['rname'][i],slits['bname'][i], hdu)
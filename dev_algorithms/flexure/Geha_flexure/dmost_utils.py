@@ -60,6 +60,15 @@ def calc_rb_SN(r1,b1, hdu):
 
 
 
+#######################################################
+#  COLUMNS OF ONE EXTENSION: hdu IS THE spec1d HDUList, OR A DICT
+#  OF THE COLUMNS OF ITS EXTENSIONS (dmost_flexure.read_slit_spectra)
+def slit_data(hdu, name):
+
+    ext = hdu[name]
+    return ext if isinstance(ext, dict) else ext.data
+
+
 #######################################################
 #  GENERAL SCRIPT TO CALL 
 def load_spectrum(single_slit,hdu,vacuum=0):
@@ -68,11 +77,13 @@ def load_spectrum(single_slit,hdu,vacuum=0):
     b = single_slit['bname']
 
     try:
+        b_data = slit_data(hdu, b)
+        r_data = slit_data(hdu, r)
 
-        tmp_wave = np.concatenate((hdu[b].data['OPT_WAVE'],hdu[r].data['OPT_WAVE']),axis=None)
-        all_flux = np.concatenate((hdu[b].data['OPT_COUNTS'],hdu[r].data['OPT_COUNTS']),axis=None)
-        all_sky = np.concatenate((hdu[b].data['OPT_COUNTS_SKY'],hdu[r].data['OPT_COUNTS_SKY']),axis=None)
-        all_ivar = np.concatenate((hdu[b].data['OPT_COUNTS_IVAR'],hdu[r].data['OPT_COUNTS_IVAR']),axis=None)
+        tmp_wave = np.concatenate((b_data['OPT_WAVE'],r_data['OPT_WAVE']),axis=None)
+        all_flux = np.concatenate((b_data['OPT_COUNTS'],r_data['OPT_COUNTS']),axis=None)
+        all_sky = np.concatenate((b_data['OPT_COUNTS_SKY'],r_data['OPT_COUNTS_SKY']),axis=None)
+        all_ivar = np.concatenate((b_data['OPT_COUNTS_IVAR'],r_data['OPT_COUNTS_IVAR']),axis=None)
 
         fitwave  = single_slit['fit_slope']*tmp_wave + single_slit['fit_b']
         vwave = tmp_wave - fitwave
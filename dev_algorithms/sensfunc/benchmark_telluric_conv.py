@@ -0,0 +1,146 @@
+"""
+Accuracy and timing of the resolution ladder of TelluricConvolutionCache against the direct convolution of
+eval_telluric_batch, for the telluric grids and wavelength ranges of the pypeit_tellfit tests of the dev suite.
+
+For each case the telluric grid is read for the wavelength range of the coadded spectrum, and:
+
+    - the models of random parameters within the fit bounds are compared to the direct convolution,
+    - differential_evolution-like populations are evaluated with both methods,
+    - the same converged parameters are evaluated repeatedly, as in the rejection iterations of
+      robust_optimize, directly and through the memoized exact evaluation.
+
+The GNIRS and GMOS cases need the coadd1d files of a dev suite run in --redux_dir and the TelFit grids of
+pypeit (downloaded by pypeit if missing). The 'paranal' case uses the small grid in this directory and
+always runs:
+
+    python benchmark_telluric_conv.py --cases paranal gemini_gnirs/32_SB_SXD gemini_gmos/GS_HAM_R400_700
+"""
+import os
+import time
+import argparse
+
+import numpy as np
+
+from pypeit import data
+from pypeit.onespec import OneSpec
+from pypeit.spectrographs.util import load_spectrograph
+from pypeit.core.wavecal import wvutils
+
+from telluric_grid import read_telluric_grid, eval_telluric_batch, TelluricConvolutionCache
+
+# The pypeit_tellfit tests of test_scripts/test_setups.py
+TELLFIT_CASES = {'gemini_gnirs/32_SB_SXD': 'pisco_coadd.fits',
+                 'gemini_gmos/GS_HAM_R400_700': 'FRB180924_opt.fits'}
+PARANAL_GRID = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TelFit_Paranal_NIR_AM1.03_R5500.fits')
+
+
+def load_case(case, redux_dir, telgrid=None):
+    """
+    Telluric grid, pixels of the spectrum in it and the resolution guess of a case.
+
+    Returns:
+        tell_dict, ind_lower, ind_upper, resln_guess, or None if the coadd1d file does not exist
+    """
+    if case == 'paranal':
+        tell_dict = read_telluric_grid(PARANAL_GRID, 13000.0, 14500.0)
+        return tell_dict, 100, tell_dict['wave_grid'].size - 101, tell_dict['resln_guess']/2.0
+
+    coadd_file = os.path.join(redux_dir, case, TELLFIT_CASES[case])
+    if not os.path.isfile(coadd_file):
+        print('{:s}: {:s} not found, skipping'.format(case, coadd_file))
+        return None
+    spec = OneSpec.from_file(coadd_file)
+    wave = spec.wave[spec.mask.astype(bool) & (spec.wave > 1.0)]
+    if telgrid is None:
+        par = load_spectrograph(spec.PYP_SPEC).default_pypeit_par()
+        telgrid = data.get_telgrid_filepath(par['sensfunc']['IR']['telgridfile'])
+    tell_dict = read_telluric_grid(telgrid, wave.min(), wave.max())
+    ind_lower, ind_upper = np.searchsorted(tell_dict['wave_grid'], [wave.min(), wave.max()])
+    resln_guess = wvutils.get_sampling(wave)[2]
+    return tell_dict, int(ind_lower), int(min(ind_upper, tell_dict['wave_grid'].size - 1)), resln_guess
+
+
+def random_thetas(tell_dict, resln_guess, npop, rng, resln_frac_bounds=(0.5, 1.5), pix_shift_bounds=(-2.0, 2.0)):
+    """Parameters drawn uniformly within the bounds of the telluric fits, shape (npop, 6)."""
+    bounds = [(tell_dict['pressure_grid'].min(), tell_dict['pressure_grid'].max()),
+              (tell_dict['temp_grid'].min(), tell_dict['temp_grid'].max()),
+              (tell_dict['h2o_grid'].min(), tell_dict['h2o_grid'].max()),
+              (tell_dict['airmass_grid'].min(), tell_dict['airmass_grid'].max()),
+              (resln_guess*resln_frac_bounds[0], resln_guess*resln_frac_bounds[1]),
+              pix_shift_bounds]
+    return np.column_stack([rng.uniform(lo, hi, npop) for lo, hi in bounds])
+
+
+def run_case(case, pargs):
+    loaded = load_case(case, pargs.redux_dir, telgrid=pargs.telgrid)
+    if loaded is None:
+        return
+    tell_dict, ind_lower, ind_upper, resln_guess = loaded
+    print('{:s}: {:d} models x {:d} pixels, resolution {:.0f}'.format(
+        case, int(np.prod(tell_dict['tell_grid'].shape[:-1])), ind_upper - ind_lower + 1, resln_guess))
+    rng = np.random.default_rng(pargs.seed)
+
+    t0 = time.perf_counter()
+    try:
+        conv_cache = TelluricConvolutionCache(tell_dict, 0.5*resln_guess, 1.5*resln_guess, ind_lower, ind_upper,
+                                              res_step=pargs.res_step)
+    except ValueError as err:
+        print('    {:s}'.format(str(err)))
+        return
+    print('    ladder of {:d} resolutions, {:.1f} MB, built in {:.2f} s'.format(
+        conv_cache.res.size, conv_cache.conv_grid.nbytes/1e6, time.perf_counter() - t0))
+
+    # Accuracy
+    thetas = random_thetas(tell_dict, resln_guess, pargs.npop, rng)
+    direct = eval_telluric_batch(thetas, tell_dict, ind_lower, ind_upper)
+    ladder = conv_cache.eval(thetas)
+    exact = conv_cache.eval(thetas, exact=True)
+    print('    max |ladder - direct| = {:.2e}, max |memoized exact - direct| = {:.2e}'.format(
+        np.abs(ladder - direct).max(), np.abs(exact - direct).max()))
+
+    # Populations of a differential_evolution run
+    t0 = time.perf_counter()
+    for igen in range(pargs.ngen):
+        eval_telluric_batch(random_thetas(tell_dict, resln_guess, pargs.npop, rng), tell_dict, ind_lower, ind_upper)
+    t1 = time.perf_counter()
+    for igen in range(pargs.ngen):
+        conv_cache.eval(random_thetas(tell_dict, resln_guess, pargs.npop, rng))
+    t2 = time.perf_counter()
+    print('    {:d} populations of {:d}: direct {:.3f} s, ladder {:.3f} s ({:.1f}x)'.format(
+        pargs.ngen, pargs.npop, t1 - t0, t2 - t1, (t1 - t0)/(t2 - t1)))
+
+    # Repeated evaluations of the best fit
+    theta = thetas[0]
+    t0 = time.perf_counter()
+    for i in range(pargs.nrepeat):
+        eval_telluric_batch(theta[None, :], tell_dict, ind_lower, ind_upper)
+    t1 = time.perf_counter()
+    for i in range(pargs.nrepeat):
+        conv_cache.eval(theta, exact=True)
+    t2 = time.perf_counter()
+    print('    {:d} evaluations of the best fit: direct {:.4f} s, memoized {:.4f} s ({:s})'.format(
+        pargs.nrepeat, t1 - t0, t2 - t1, str(conv_cache._eval_exact.cache_info())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', default=['paranal'] + list(TELLFIT_CASES.keys()),
+                        help='Cases to run: paranal and/or the dev-suite setups')
+    parser.add_argument('--redux_dir', type=str,
+                        default=os.path.join(os.getenv('PYPEIT_DEV', '.'), 'REDUX_OUT'),
+                        help='Output directory of the dev suite with the coadd1d files')
+    parser.add_argument('--telgrid', type=str, default=None,
+                        help='Telluric grid to use rather than the default of the spectrograph')
+    parser.add_argument('--res_step', type=float, default=0.02, help='Fractional spacing of the ladder')
+    parser.add_argument('--npop', type=int, default=90, help='Size of the populations')
+    parser.add_argument('--ngen', type=int, default=20, help='Number of populations')
+    parser.add_argument('--nrepeat', type=int, default=50, help='Number of evaluations of the best fit')
+    parser.add_argument('--seed', type=int, default=1234, help='Random seed')
+    pargs = parser.parse_args()
+
+    for case in pargs.cases:
+        run_case(case, pargs)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,33 +2,35 @@ import numpy as np
 import scipy
 from sklearn import mixture
 
-def init_pca(filename,wave_grid,redshift):
-    # Read in the pickle file from coarse_pca.create_coarse_pca
-    # The relevant pieces are the wavelengths (wave_pca_c), the PCA components (pca_comp_c),
-    # and the Gaussian mixture model prior (mix_fit)
-    wave_pca_c, cont_all_c, pca_comp_c, coeffs_c,
-    mean_pca, covar_pca, diff_pca, mix_fit, chi2, dof = pickle.load(open(filename,'rb'))
-    num_comp = pca_comp_c.shape[0] # number of PCA components
-    # Interpolate PCA components onto wave_grid
-    pca_interp = scipy.interpolate.interp1d(wave_pca_c*(1+redshift),pca_comp_c,
-                                            bounds_error=False, axis=1)
-    nord = wave_grid.shape[1]
-    pca_comp_new = np.zeros(wave_grid.shape)
-    for ii in range(nord):
-        pca_comp_new[ii] = pca_interp(wave_grid[:,ii])
+from qso_pca import PCA_CACHE_DIR, load_pca_basis
+
+def init_pca(filename,wave_grid,redshift,cache_dir=PCA_CACHE_DIR):
+    # Read in the pickle file from coarse_pca.create_coarse_pca, or the components already resampled onto wave_grid
+    # from cache_dir, see qso_pca.load_pca_basis
+    # The relevant pieces are the PCA components interpolated onto wave_grid, of shape (num_comp,) + wave_grid.shape,
+    # i.e. all the orders at once, and the Gaussian mixture model prior (mix_fit)
+    basis = load_pca_basis(filename, wave_grid, redshift, fill_value=np.nan, cache_dir=cache_dir)
+    num_comp = basis['components'].shape[0] # number of PCA components
     # Construct the PCA dict
-    pca_dict = {'n_components': num_comp, 'components': pca_comp_new,
-            'prior': mix_fit, 'coeffs': coeffs_c}
+    pca_dict = {'n_components': num_comp, 'components': basis['components'],
+            'prior': basis['mix_fit'], 'coeffs': basis['coeffs']}
     return pca_dict
 
 def eval_pca(theta,pca_dict):
+    # theta can also be a batch of shape (nbatch, ntheta), evaluated with one matrix multiply
     C = pca_dict['components']
-    norm = theta[0]
-    A = theta[1:]
-    return norm*np.exp(np.dot(np.append(1.0,A),C))
+    thetas = np.atleast_2d(theta)
+    norm = thetas[:, 0]
+    A = thetas[:, 1:]
+    lnflux = np.tensordot(np.column_stack((np.ones(thetas.shape[0]), A)), C[:A.shape[1] + 1], axes=1)
+    model = norm.reshape((-1,) + (1,)*(C.ndim - 1))*np.exp(lnflux)
+    return model[0] if np.ndim(theta) == 1 else model
 
 def eval_pca_prior(theta,pca_dict):
     gmm = pca_dict['prior']
-    A = theta[1:]
-    return gmm.score_samples(A.reshape(1,-1))
+    A = np.atleast_2d(theta)[:, 1:]
+    return gmm.score_samples(A)
+
+
+
 
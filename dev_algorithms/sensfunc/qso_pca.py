@@ -1,32 +1,124 @@
-
-
-
 import numpy as np
 import scipy
 import matplotlib.pyplot as plt
 import os
+import hashlib
 from sklearn import mixture
 import pickle
 import IPython
 
+# Directory of the PCA components resampled onto the wavelength grids of the fits, see load_pca_basis
+PCA_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'qso_pca')
+# Number of bases kept in the cache, the least recently used ones are removed beyond it
+PCA_CACHE_MAX_FILES = 64
+
+# Gaussian mixture priors of the PCA coefficients, keyed by (file, npca)
+_prior_cache = {}
+
+
+def pca_basis_key(filename, wave_grid, redshift, fill_value=0.0):
+    # Hash of the PCA file (path, size and modification time, so that a new file is not matched to an old basis), the
+    # wavelength grid and the redshift, which identifies a resampled basis
+    stat = os.stat(filename)
+    key = hashlib.sha1('{:s} {:d} {:d} {!r} {!r} {!r}'.format(
+        os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, float(redshift), fill_value,
+        np.shape(wave_grid)).encode())
+    key.update(np.ascontiguousarray(wave_grid, dtype=float).tobytes())
+    return key.hexdigest()
+
 
+def evict_pca_cache(cache_dir, max_files=PCA_CACHE_MAX_FILES):
+    # Remove the least recently used bases (load_pca_basis touches a basis when it reads it) beyond max_files
+    cache_files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)
+                   if f.startswith('pca_basis_') and f.endswith('.pckl')]
+    if len(cache_files) <= max_files:
+        return
+    mtimes = []
+    for cache_file in cache_files:
+        try:
+            mtimes.append(os.stat(cache_file).st_mtime_ns)
+        except FileNotFoundError:
+            # Removed by another fit in the meantime
+            mtimes.append(-1)
+    for isort in np.argsort(mtimes)[:len(cache_files) - max_files]:
+        try:
+            os.remove(cache_files[isort])
+        except FileNotFoundError:
+            pass
+
+
+def load_pca_basis(filename, wave_grid, redshift, fill_value=0.0, cache_dir=PCA_CACHE_DIR,
+                   max_files=PCA_CACHE_MAX_FILES):
+    """
+    PCA components of the pickle file from coarse_pca.create_coarse_pca resampled onto wave_grid at a redshift.
+
+    The resampled components are cached in cache_dir, keyed by the file, a hash of wave_grid and the redshift, so that
+    setting up the fits of the same spectrum again, or at redshifts that were already tried, does not read the PCA file
+    and interpolate the components again. Use cache_dir=None to not cache them. Only the max_files most recently used
+    bases are kept, since every redshift gets its own basis; scans over redshift are better done with pca_eval, which
+    shifts the components of one basis.
+
+    Args:
+        filename: PCA pickle file
+        wave_grid: Wavelengths, of any shape
+        redshift: Redshift of the QSO
+        fill_value: Components outside the wavelength range of the PCA
+        cache_dir: Directory of the cached bases
+        max_files: Number of bases kept in cache_dir
+
+    Returns:
+        dict: components, shape (ncomp,) + wave_grid.shape, and the coeffs and mix_fit of the file
+    """
+    cache_file = None if cache_dir is None else \
+        os.path.join(cache_dir, 'pca_basis_{:s}.pckl'.format(pca_basis_key(filename, wave_grid, redshift, fill_value)))
+    if cache_file is not None and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                basis = pickle.load(f)
+            # Mark it as recently used, see evict_pca_cache
+            os.utime(cache_file)
+            return basis
+        except FileNotFoundError:
+            # Evicted by another fit in the meantime
+            pass
 
-def init_pca(filename,wave_grid,redshift, npca):
-    # Read in the pickle file from coarse_pca.create_coarse_pca
     # The relevant pieces are the wavelengths (wave_pca_c), the PCA components (pca_comp_c),
     # and the Gaussian mixture model prior (mix_fit)
+    wave_pca_c, cont_all_c, pca_comp_c, coeffs_c, mean_pca, covar_pca, diff_pca, mix_fit, chi2, dof = pickle.load(open(filename,'rb'))
+    # Interpolate PCA components onto wave_grid
+    pca_interp = scipy.interpolate.interp1d(wave_pca_c*(1.0 + redshift),pca_comp_c, bounds_error=False,
+                                            fill_value=fill_value, axis=1)
+    basis = dict(components=pca_interp(wave_grid), coeffs=coeffs_c, mix_fit=mix_fit)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written under a temporary name and renamed, so that fits running in parallel never read a partial file
+        tmp_file = '{:s}.{:d}'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(basis, f)
+        os.replace(tmp_file, cache_file)
+        evict_pca_cache(cache_dir, max_files=max_files)
+    return basis
+
+
+def pca_prior(filename, coeffs, npca):
+    # Generate a mixture model for the coefficients prior, what should ngauss be? Fitted once per file and npca
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime_ns, npca)
+    if key not in _prior_cache:
+        _prior_cache[key] = mixture.GaussianMixture(n_components = npca-1).fit(coeffs[:, 1:npca])
+    return _prior_cache[key]
+
+
+def init_pca(filename,wave_grid,redshift, npca, cache_dir=PCA_CACHE_DIR):
+    # Read in the pickle file from coarse_pca.create_coarse_pca, or the components already resampled onto wave_grid
+    # from cache_dir, see load_pca_basis
 
     loglam = np.log10(wave_grid)
     dloglam = np.median(loglam[1:] - loglam[:-1])
-    wave_pca_c, cont_all_c, pca_comp_c, coeffs_c, mean_pca, covar_pca, diff_pca, mix_fit, chi2, dof = pickle.load(open(filename,'rb'))
-    num_comp = pca_comp_c.shape[0] # number of PCA components
-    # Interpolate PCA components onto wave_grid
-    pca_interp = scipy.interpolate.interp1d(wave_pca_c*(1.0 + redshift),pca_comp_c, bounds_error=False, fill_value=0.0, axis=1)
-    pca_comp_new = pca_interp(wave_grid)
-    # Generate a mixture model for the coefficients prior, what should ngauss be?
-    prior = mixture.GaussianMixture(n_components = npca-1).fit(coeffs_c[:, 1:npca])
+    basis = load_pca_basis(filename, wave_grid, redshift, cache_dir=cache_dir)
+    prior = pca_prior(filename, basis['coeffs'], npca)
     # Construct the PCA dict
-    pca_dict = {'npca': npca, 'components': pca_comp_new, 'prior': prior, 'coeffs': coeffs_c,
+    pca_dict = {'npca': npca, 'components': basis['components'], 'prior': prior, 'coeffs': basis['coeffs'],
                 'z_fid': redshift, 'dloglam': dloglam}
     return pca_dict
 
@@ -34,19 +126,70 @@ def pca_eval(theta,pca_dict):
     # theta_pca[0] is redshift
     # theta_pca[1] is norm
     # theta_pca[2:npca+1] are the PCA dimensionality
+    # theta can also be a batch of shape (nbatch, npca+1), e.g. a differential_evolution population or a scan of
+    # trial redshifts, which is evaluated with one matrix multiply
 
     C = pca_dict['components']
     z_fid = pca_dict['z_fid']
     dloglam = pca_dict['dloglam']
     npca = pca_dict['npca']  # Size of the PCA currently being used, original PCA in the dict could be larger
-    z_qso = theta[0]
-    norm = theta[1]
-    A = theta[2:]
-    dshift = int(np.round(np.log10((1.0 + z_qso)/(1.0 + z_fid))/dloglam))
-    C_now = np.roll(C[:npca,:], dshift, axis=1)
-    return norm*np.exp(np.dot(np.append(1.0,A),C_now))
+    thetas = np.atleast_2d(theta)
+    z_qso = thetas[:, 0]
+    norm = thetas[:, 1]
+    A = thetas[:, 2:]
+    lnflux = np.dot(np.column_stack((np.ones(thetas.shape[0]), A)), C[:npca,:])
+    # Shifting the components by the redshift is the same as shifting their sum, i.e. np.roll of each row
+    dshift = np.round(np.log10((1.0 + z_qso)/(1.0 + z_fid))/dloglam).astype(int)
+    nspec = C.shape[1]
+    lnflux = np.take_along_axis(lnflux, (np.arange(nspec) - dshift[:, None]) % nspec, axis=1)
+    model = norm[:, None]*np.exp(lnflux)
+    return model[0] if np.ndim(theta) == 1 else model
 
 def pca_lnprior(theta,pca_dict):
+    # theta can also be a batch of shape (nbatch, npca+1), whose log priors are returned
     gaussian_mixture_model = pca_dict['prior']
-    A = theta[2:]
-    return gaussian_mixture_model.score_samples(A.reshape(1,-1))
\ No newline at end of file
+    A = np.atleast_2d(theta)[:, 2:]
+    return gaussian_mixture_model.score_samples(A)
+
+
+class QSOPCAModel(object):
+    """
+    PCA model of a QSO spectrum on a wavelength grid, whose components are resampled around a fiducial redshift and
+    cached on disk (see load_pca_basis).
+
+    eval and lnprior take one parameter vector (redshift, norm, npca-1 coefficients) or a batch of them, shape
+    (nbatch, npca+1), e.g. the population of a telluric_qso fit or a scan over trial redshifts, which eval handles by
+    shifting the components by whole pixels. Redshifts far from the fiducial one are better served by at_redshift,
+    which resamples the components there (and caches them, see load_pca_basis) unless they are within max_shift
+    pixels of the fiducial redshift.
+
+    Args:
+        filename: PCA pickle file from coarse_pca.create_coarse_pca
+        wave_grid: Wavelengths of the fit
+        redshift: Fiducial redshift
+        npca: Number of PCA components used
+        cache_dir: Directory of the cached bases, or None to not cache them
+    """
+    def __init__(self, filename, wave_grid, redshift, npca, cache_dir=PCA_CACHE_DIR):
+        self.filename = filename
+        self.wave_grid = wave_grid
+        self.npca = npca
+        self.cache_dir = cache_dir
+        self.pca_dict = init_pca(filename, wave_grid, redshift, npca, cache_dir=cache_dir)
+
+    @property
+    def redshift(self):
+        return self.pca_dict['z_fid']
+
+    def at_redshift(self, redshift, max_shift=0):
+        # Shifts of up to max_shift pixels are left to eval, reusing the components of this model
+        dshift = np.round(np.log10((1.0 + redshift)/(1.0 + self.redshift))/self.pca_dict['dloglam'])
+        if np.abs(dshift) <= max_shift:
+            return self
+        return QSOPCAModel(self.filename, self.wave_grid, redshift, self.npca, cache_dir=self.cache_dir)
+
+    def eval(self, thetas):
+        return pca_eval(thetas, self.pca_dict)
+
+    def lnprior(self, thetas):
+        return pca_lnprior(thetas, self.pca_dict)
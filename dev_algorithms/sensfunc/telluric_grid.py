@@ -0,0 +1,493 @@
+"""
+Memory-mapped access to the TelFit telluric model grids.
+
+The grids, e.g. TelFit_MaunaKea_3100_26100_R20000.fits, are 5D arrays of (pressure, temperature, humidity,
+airmass, wavelength) that can be several GB. read_telluric_grid returns the same dictionary as
+pypeit.core.telluric.read_telluric_grid, but its tell_grid is a TelluricGridArray: the FITS data stay
+memory-mapped, and indexing a wavelength window, e.g. tell_grid[:,:,:,:,ind_lower:ind_upper+1], reads only
+that window from the file. The most recently used windows are kept in an LRU cache, so that repeated fits
+of the same spectrum or order do not read them again, and processes working on the same grid share the
+pages of the file in the OS page cache rather than each holding a copy of the full grid.
+
+eval_telluric_batch evaluates the telluric model for a whole population of parameter vectors in one call,
+with multilinear interpolation in (pressure, temperature, humidity, airmass) rather than the nearest grid
+point, and the resolution convolution of all of the models done at once. TelluricConvolutionCache convolves
+the grid of a wavelength window once at a ladder of resolutions and interpolates the models between them, so
+that fits evaluating many trial resolutions do no convolutions at all.
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+import scipy.signal
+import scipy.sparse
+from astropy.io import fits
+
+from pypeit.core.wavecal import wvutils
+
+# Number of wavelength windows of each grid file kept in memory
+WINDOW_CACHE_SIZE = 16
+# Longest kernel of conv_telluric_batch convolved directly rather than with FFTs
+DIRECT_CONV_MAX_KERNEL = 32
+# Fractional spacing of the resolutions of TelluricConvolutionCache
+RES_LADDER_STEP = 0.02
+# Largest size of the convolved grids of TelluricConvolutionCache, in bytes
+LADDER_MAX_BYTES = 2e9
+# Number of exact evaluations memoized by TelluricConvolutionCache, and the quantization of their parameters
+EXACT_CACHE_SIZE = 256
+QUANTIZE_STEP = 1e-5
+
+
+class TelluricGridFile(object):
+    """
+    A memory-mapped TelFit grid file.
+
+    Args:
+        filename (str): The grid file.
+        cache_size (int): Number of wavelength windows to keep in the LRU cache.
+
+    Attributes:
+        wave (ndarray): Wavelengths of the grid, in the units of the file (nm for the TelFit grids).
+        pressure_grid, temp_grid, h2o_grid, airmass_grid (ndarray): The grid points of the other axes.
+        data (ndarray): The memory-mapped model grid, shape (npres, ntemp, nhum, nam, nwave).
+    """
+    def __init__(self, filename, cache_size=WINDOW_CACHE_SIZE):
+        self.filename = filename
+        self.hdul = fits.open(filename, memmap=True)
+        self.data = self.hdul[0].data
+        self.wave = np.array(self.hdul[1].data, dtype=float)
+        header = self.hdul[0].header
+        self.pressure_grid = header['PRES0'] + header['DPRES']*np.arange(0, header['NPRES'])
+        self.temp_grid = header['TEMP0'] + header['DTEMP']*np.arange(0, header['NTEMP'])
+        self.h2o_grid = header['HUM0'] + header['DHUM']*np.arange(0, header['NHUM'])
+        if header['NAM'] > 1:
+            self.airmass_grid = header['AM0'] + header['DAM']*np.arange(0, header['NAM'])
+        else:
+            self.airmass_grid = header['AM0'] + 1*np.arange(0, 1)
+        self.window = lru_cache(maxsize=cache_size)(self._read_window)
+
+    def __reduce__(self):
+        # e.g. to the worker processes of a fit, which memory-map the file again rather than copying the grid
+        return open_telluric_grid, (self.filename,)
+
+    def _read_window(self, ind_lower, ind_upper):
+        """Read the grid for wavelength pixels ind_lower:ind_upper (exclusive) into memory."""
+        window = np.array(self.data[..., ind_lower:ind_upper], dtype=float)
+        # Shared by all of the callers of the cache
+        window.flags.writeable = False
+        return window
+
+    def window_indices(self, wave_min=None, wave_max=None, pad=0):
+        """
+        Indices ind_lower, ind_upper (exclusive) of the grid pixels closest to wave_min and wave_max, in the
+        units of the file, extended by pad pixels on each side.
+        """
+        ind_lower = np.argmin(np.abs(self.wave - wave_min)) if wave_min is not None else 0
+        ind_upper = np.argmin(np.abs(self.wave - wave_max)) + 1 if wave_max is not None else self.wave.size
+        return int(np.fmax(ind_lower - pad, 0)), int(np.fmin(ind_upper + pad, self.wave.size))
+
+
+def open_telluric_grid(filename):
+    """Open a grid file, once per process."""
+    return _open_telluric_grid(os.path.abspath(filename))
+
+
+@lru_cache(maxsize=None)
+def _open_telluric_grid(filename):
+    return TelluricGridFile(filename)
+
+
+class TelluricGridArray(object):
+    """
+    The model grid of a TelluricGridFile restricted to wavelength pixels ind_lower:ind_upper, read from the
+    file when indexed.
+
+    Indexing with a slice along the wavelength axis, e.g. tell_grid[:,:,:,:,100:500], reads that window through
+    the LRU cache of the file. Indexing a single model, e.g. tell_grid[ip,it,ih,ia], reads only that spectrum, and
+    models() reads only the models it is given. Everything else reads the full grid, as does np.asarray(tell_grid).
+    """
+    def __init__(self, gridfile, ind_lower=0, ind_upper=None):
+        self.gridfile = gridfile
+        self.ind_lower = ind_lower
+        self.ind_upper = gridfile.wave.size if ind_upper is None else ind_upper
+
+    @property
+    def shape(self):
+        return self.gridfile.data.shape[:-1] + (self.ind_upper - self.ind_lower,)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def dtype(self):
+        return np.dtype(float)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.gridfile.window(self.ind_lower, self.ind_upper), dtype=dtype)
+
+    def models(self, inds):
+        """
+        Read only some of the model spectra, without going through the window cache.
+
+        Args:
+            inds (ndarray): Flat indices of the models in the (npres, ntemp, nhum, nam) grid.
+
+        Returns:
+            ndarray: Spectra, shape (len(inds), nspec).
+        """
+        lead = np.unravel_index(np.asarray(inds, dtype=int), self.shape[:-1])
+        return np.array(self.gridfile.data[lead + (slice(self.ind_lower, self.ind_upper),)], dtype=float)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            iell = [k is Ellipsis for k in key].index(True)
+            key = key[:iell] + (slice(None),)*(self.ndim - len(key) + 1) + key[iell + 1:]
+        key = key + (slice(None),)*(self.ndim - len(key))
+        if len(key) != self.ndim:
+            return np.asarray(self)[key]
+        lead, last = key[:-1], key[-1]
+        if not isinstance(last, slice) or last.step not in (None, 1):
+            return np.asarray(self)[key]
+        start, stop, _ = last.indices(self.shape[-1])
+        stop = max(start, stop)
+        if all(isinstance(k, (int, np.integer)) for k in lead):
+            # A single model spectrum is a contiguous read
+            return np.array(self.gridfile.data[lead + (slice(self.ind_lower + start, self.ind_lower + stop),)],
+                            dtype=float)
+        window = self.gridfile.window(self.ind_lower + start, self.ind_lower + stop)
+        return window[lead + (slice(None),)]
+
+
+def read_telluric_grid(filename, wave_min=None, wave_max=None, pad_frac=0.10, pad=None):
+    """
+    Read a telluric grid, memory-mapped. Same as pypeit.core.telluric.read_telluric_grid, except that tell_grid
+    is a TelluricGridArray.
+
+    Args:
+        filename (str): Telluric grid file.
+        wave_min, wave_max (float): Wavelength range in Angstrom to which the grid is trimmed.
+        pad_frac (float): The trimmed grid extends from (1 - pad_frac)*wave_min to (1 + pad_frac)*wave_max.
+        pad (int): If not None, the trimmed grid is instead padded by this number of pixels on each side.
+
+    Returns:
+        dict: wave_grid, dloglam, resln_guess, pix_per_sigma, tell_pad_pix, pressure_grid, temp_grid, h2o_grid,
+        airmass_grid and tell_grid.
+    """
+    gridfile = open_telluric_grid(filename)
+    # The grids are in nm
+    wave_grid_full = 10.0*gridfile.wave
+    if pad is None:
+        # As in PypeIt, ind_upper is exclusive
+        ind_lower = np.argmin(np.abs(wave_grid_full - (1.0 - pad_frac)*wave_min)) if wave_min is not None else 0
+        ind_upper = np.argmin(np.abs(wave_grid_full - (1.0 + pad_frac)*wave_max)) \
+            if wave_max is not None else wave_grid_full.size
+    else:
+        ind_lower, ind_upper = gridfile.window_indices(
+            None if wave_min is None else wave_min/10.0, None if wave_max is None else wave_max/10.0, pad=pad)
+    wave_grid = wave_grid_full[ind_lower:ind_upper]
+
+    dwave, dloglam, resln_guess, pix_per_sigma = wvutils.get_sampling(wave_grid)
+    tell_pad_pix = int(np.ceil(10.0*pix_per_sigma))
+
+    return dict(wave_grid=wave_grid,
+                dloglam=dloglam,
+                resln_guess=resln_guess,
+                pix_per_sigma=pix_per_sigma,
+                tell_pad_pix=tell_pad_pix,
+                pressure_grid=gridfile.pressure_grid,
+                temp_grid=gridfile.temp_grid,
+                h2o_grid=gridfile.h2o_grid,
+                airmass_grid=gridfile.airmass_grid,
+                tell_grid=TelluricGridArray(gridfile, ind_lower, ind_upper))
+
+
+def grid_weights(values, grid, method='linear'):
+    """
+    Interpolation indices and weights of values on a 1D grid.
+
+    Args:
+        values (ndarray): Values to interpolate at, shape (npop,).
+        grid (ndarray): Increasing grid points.
+        method (str): 'linear', or 'nearest' for the nearest grid point, as in
+            pypeit.core.telluric.interp_telluric_grid. Values outside of the grid are clipped to its edges.
+
+    Returns:
+        ind, weight: Lower grid index and the weight of the grid point above it, each shape (npop,).
+    """
+    values = np.asarray(values, dtype=float)
+    if len(grid) == 1:
+        return np.zeros(values.shape, dtype=int), np.zeros(values.shape)
+    if method == 'nearest':
+        ind = np.clip(np.round((values - grid[0])/(grid[1] - grid[0])).astype(int), 0, len(grid) - 1)
+        return ind, np.zeros(values.shape)
+    ind = np.clip(np.searchsorted(grid, values, side='right') - 1, 0, len(grid) - 2)
+    weight = np.clip((values - grid[ind])/(grid[ind + 1] - grid[ind]), 0.0, 1.0)
+    return ind, weight
+
+
+def interp_grid(values, grids, model_grid, method='linear'):
+    """
+    Interpolate a grid of spectra, e.g. the telluric grid, at many points at once.
+
+    Args:
+        values (ndarray): Points to interpolate at, shape (npop, ngrid).
+        grids (list): The grid points of each of the ngrid leading axes of model_grid.
+        model_grid (ndarray or TelluricGridArray): Spectra, shape (len(grids[0]), ..., len(grids[-1]), nspec).
+            Only the spectra at the corners around the points are read from a TelluricGridArray.
+        method (str): 'linear' for multilinear interpolation, or 'nearest' for the nearest grid point.
+
+    Returns:
+        ndarray: Spectra, shape (npop, nspec).
+    """
+    inds, weights = zip(*[grid_weights(values[:, i], grid, method=method) for i, grid in enumerate(grids)])
+    # Only the corners of the axes with more than one grid point
+    axes = [i for i, grid in enumerate(grids) if len(grid) > 1 and method == 'linear']
+    npop, ngrid_shape = values.shape[0], model_grid.shape[:-1]
+    cols, wgts = [], []
+    for corner in range(2**len(axes)):
+        corner_inds = list(inds)
+        weight = np.ones(npop)
+        for bit, iax in enumerate(axes):
+            upper = (corner >> bit) & 1
+            corner_inds[iax] = inds[iax] + upper
+            weight = weight*(weights[iax] if upper else 1.0 - weights[iax])
+        cols.append(np.ravel_multi_index(corner_inds, ngrid_shape))
+        wgts.append(weight)
+    # The interpolation is a sparse matrix of weights times the spectra of the corners that are used
+    corners, cols = np.unique(np.concatenate(cols), return_inverse=True)
+    if isinstance(model_grid, TelluricGridArray):
+        models = model_grid.models(corners)
+    else:
+        models = model_grid.reshape(-1, model_grid.shape[-1])[corners]
+    rows = np.tile(np.arange(npop), len(wgts))
+    interp_matrix = scipy.sparse.csr_matrix((np.concatenate(wgts), (rows, cols)), shape=(npop, corners.size))
+    return interp_matrix.dot(models)
+
+
+def interp_telluric_grid_batch(thetas, tell_dict, method='linear'):
+    """
+    Interpolate the telluric grid at many (pressure, temperature, humidity, airmass) at once.
+
+    Args:
+        thetas (ndarray): Shape (npop, 4).
+        tell_dict (dict): Telluric grid, see read_telluric_grid. Only the models that are needed are read from
+            a TelluricGridArray.
+        method (str): 'linear' for multilinear interpolation in the 4 parameters, or 'nearest' for the nearest
+            grid point.
+
+    Returns:
+        ndarray: Model spectra, shape (npop, nspec).
+    """
+    grids = [tell_dict['pressure_grid'], tell_dict['temp_grid'], tell_dict['h2o_grid'], tell_dict['airmass_grid']]
+    return interp_grid(np.atleast_2d(thetas), grids, tell_dict['tell_grid'], method=method)
+
+
+def conv_telluric_batch(tell_models, dloglam, res):
+    """
+    Convolve model spectra, each to its own resolution, with the kernels of pypeit.core.telluric.conv_telluric.
+
+    Args:
+        tell_models (ndarray): Shape (npop, nspec), on a grid with constant dloglam.
+        dloglam (float): Spacing of the grid in log10(wavelength).
+        res (ndarray): Resolution of each model, shape (npop,).
+
+    Returns:
+        ndarray: Convolved models, shape (npop, nspec).
+    """
+    tell_models = np.atleast_2d(tell_models)
+    res = np.broadcast_to(np.asarray(res, dtype=float), (tell_models.shape[0],))
+    # number of sigma per 1 pix
+    sig2pix = res*dloglam*np.log(10.0)*(2.0*np.sqrt(2.0*np.log(2)))
+    kernels = []
+    for s in sig2pix:
+        x = np.hstack([-1*np.flip(np.arange(s, 4, s)), np.arange(0, 4, s)])
+        kernels.append((1.0/(np.sqrt(2*np.pi)))*np.exp(-0.5*(x)**2)*s)
+    if max(g.size for g in kernels) <= DIRECT_CONV_MAX_KERNEL:
+        # Short kernels, i.e. high resolution: the direct convolution of each model is faster than the FFTs
+        return np.array([np.convolve(model, g, mode='same') for model, g in zip(tell_models, kernels)])
+    # Zero pad the kernels to a common odd length, keeping the element that mode='same' centers on in the middle,
+    # and convolve all of the models with one pair of FFTs
+    centers = [(g.size - 1)//2 for g in kernels]
+    half = max(max(c, g.size - 1 - c) for g, c in zip(kernels, centers))
+    kernel_arr = np.zeros((len(kernels), 2*half + 1))
+    for i, (g, c) in enumerate(zip(kernels, centers)):
+        kernel_arr[i, half - c:half - c + g.size] = g
+    return scipy.signal.fftconvolve(tell_models, kernel_arr, mode='same', axes=-1)
+
+
+def telluric_window(tell_dict, ind_lower=None, ind_upper=None):
+    """
+    Pixels of the wavelength grid that eval_telluric_batch convolves for the pixels ind_lower to ind_upper
+    (inclusive), i.e. padded by tell_pad_pix on each side.
+
+    Returns:
+        loglam_pad, ind_lower_pad, ind_upper_pad, trim: log10 wavelengths of the padded window, its first and
+        last (inclusive) pixels, and the slice of the window for ind_lower to ind_upper.
+    """
+    loglam = tell_dict['loglam'] if 'loglam' in tell_dict else np.log10(tell_dict['wave_grid'])
+    nspec = loglam.size
+    tell_pad_pix = tell_dict.get('tell_pad_pix', 0)
+
+    ind_lower = 0 if ind_lower is None else ind_lower
+    ind_upper = nspec - 1 if ind_upper is None else ind_upper
+    ind_lower_pad = int(np.fmax(ind_lower - tell_pad_pix, 0))
+    ind_upper_pad = int(np.fmin(ind_upper + tell_pad_pix, nspec - 1))
+    trim = slice(ind_lower - ind_lower_pad, ind_upper - ind_lower_pad + 1)
+    return loglam[ind_lower_pad:ind_upper_pad + 1], ind_lower_pad, ind_upper_pad, trim
+
+
+def shift_telluric_batch(tell_models, loglam, dloglam, thetas):
+    """
+    Shift and stretch the models as pypeit.core.telluric.shift_telluric, in place, with the shift and stretch
+    of each model in thetas[:, 5] and thetas[:, 6] (if ntheta is 6 or 7).
+    """
+    ntheta = thetas.shape[1]
+    if ntheta > 5:
+        stretch = thetas[:, 6] if ntheta == 7 else np.ones(thetas.shape[0])
+        for i in range(thetas.shape[0]):
+            loglam_shift = loglam[0] + np.arange(loglam.size)*dloglam*stretch[i] + thetas[i, 5]*dloglam
+            tell_models[i] = np.interp(loglam_shift, loglam, tell_models[i])
+    return tell_models
+
+
+def eval_telluric_batch(thetas, tell_dict, ind_lower=None, ind_upper=None, method='linear'):
+    """
+    Evaluate the telluric model for a population of parameter vectors at once, e.g. all of the members of a
+    differential_evolution population (vectorized=True).
+
+    Same as pypeit.core.telluric.eval_telluric, except for the interpolation method.
+
+    Args:
+        thetas (ndarray): Shape (npop, ntheta), with ntheta 5 (pressure, temperature, humidity, airmass,
+            resolution), 6 (and a shift) or 7 (and a stretch).
+        tell_dict (dict): Telluric grid, see read_telluric_grid. If it has no tell_pad_pix, the models are
+            convolved over the whole wavelength range of the grid.
+        ind_lower, ind_upper (int): First and last (inclusive) pixels of the wavelength grid to return.
+        method (str): See interp_telluric_grid_batch.
+
+    Returns:
+        ndarray: Models, shape (npop, ind_upper - ind_lower + 1).
+    """
+    thetas = np.atleast_2d(thetas)
+    if thetas.shape[1] not in [5, 6, 7]:
+        raise ValueError('Input model atmosphere parameters must have length 5, 6 or 7.')
+    loglam_pad, ind_lower_pad, ind_upper_pad, trim = telluric_window(tell_dict, ind_lower, ind_upper)
+
+    # Only the padded window is interpolated and convolved
+    window = dict(tell_dict, tell_grid=tell_dict['tell_grid'][..., ind_lower_pad:ind_upper_pad + 1])
+    tellmodel_hires = interp_telluric_grid_batch(thetas[:, :4], window, method=method)
+    tellmodel_conv = conv_telluric_batch(tellmodel_hires, tell_dict['dloglam'], thetas[:, 4])
+    tellmodel_conv = shift_telluric_batch(tellmodel_conv, loglam_pad, tell_dict['dloglam'], thetas)
+
+    return tellmodel_conv[:, trim]
+
+
+class TelluricConvolutionCache(object):
+    """
+    Telluric models of one wavelength window, with the grid convolved once at a ladder of resolutions.
+
+    Convolution and interpolation in the grid are both linear, so the model at (pressure, temperature,
+    humidity, airmass, resolution) is interpolated from the grid convolved at the two resolutions of the
+    ladder around it, and no convolution is done when evaluating it. The ladder is spaced uniformly in
+    log(resolution) by res_step; with the default of 2% the interpolated models are within ~1e-4 of the exact
+    convolution, which is the size of the jumps of conv_telluric itself where its kernel gains a pixel. Exact
+    evaluations (exact=True) are memoized in an LRU cache keyed on the parameters quantized to QUANTIZE_STEP
+    (see quantize_theta), so that the repeated evaluations of the best fit near convergence are cheap.
+
+    Args:
+        tell_dict (dict): Telluric grid, see read_telluric_grid.
+        res_min, res_max (float): Range of resolutions of the ladder. Resolutions outside of it are clipped
+            to its ends.
+        ind_lower, ind_upper (int): First and last (inclusive) pixels of the wavelength grid to evaluate.
+        res_step (float): Fractional spacing of the ladder.
+        cache_size (int): Number of exact evaluations to memoize.
+        max_bytes (float): Largest size of the convolved grids. ValueError is raised if the ladder would be
+            larger, e.g. for the full wavelength range of a high resolution grid.
+
+    Attributes:
+        res (ndarray): The resolutions of the ladder.
+        conv_grid (ndarray): The grid convolved at each of them, shape (nres, npres, ntemp, nhum, nam, nwin).
+    """
+    def __init__(self, tell_dict, res_min, res_max, ind_lower=None, ind_upper=None, res_step=RES_LADDER_STEP,
+                 cache_size=EXACT_CACHE_SIZE, max_bytes=LADDER_MAX_BYTES):
+        self.tell_dict = tell_dict
+        self.ind_lower, self.ind_upper = ind_lower, ind_upper
+        self.loglam_pad, ind_lower_pad, ind_upper_pad, self.trim = telluric_window(tell_dict, ind_lower, ind_upper)
+        self.dloglam = tell_dict['dloglam']
+        self.grids = [tell_dict['pressure_grid'], tell_dict['temp_grid'], tell_dict['h2o_grid'],
+                      tell_dict['airmass_grid']]
+
+        nres = int(np.ceil(np.log(res_max/res_min)/np.log(1.0 + res_step))) + 1
+        self.res = res_min*np.exp(np.linspace(0.0, np.log(res_max/res_min), nres))
+        tell_grid = np.asarray(tell_dict['tell_grid'][..., ind_lower_pad:ind_upper_pad + 1])
+        nbytes = nres*tell_grid.nbytes
+        if nbytes > max_bytes:
+            raise ValueError('The resolution ladder would need {:.1f} GB for {:d} resolutions; use a smaller '
+                             'wavelength window or a larger res_step'.format(nbytes/1e9, nres))
+        models = tell_grid.reshape(-1, tell_grid.shape[-1])
+        self.conv_grid = np.array([conv_telluric_batch(models, self.dloglam, res).reshape(tell_grid.shape)
+                                   for res in self.res])
+        # Quantization steps of (pressure, temperature, humidity, airmass, resolution); the resolution step is
+        # fixed by the finest spacing of the ladder, so that nearby resolutions share a key
+        self.quantize = np.array([QUANTIZE_STEP*(grid[1] - grid[0]) if len(grid) > 1 else QUANTIZE_STEP
+                                  for grid in self.grids + [self.res]])
+        self.cache_size = cache_size
+        self._eval_exact = lru_cache(maxsize=cache_size)(self._eval_exact_quantized)
+
+    def __getstate__(self):
+        # The memoized evaluations are not sent to other processes
+        state = self.__dict__.copy()
+        del state['_eval_exact']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._eval_exact = lru_cache(maxsize=self.cache_size)(self._eval_exact_quantized)
+
+    def eval(self, thetas, exact=False):
+        """
+        Evaluate the telluric model, as eval_telluric_batch.
+
+        Args:
+            thetas (ndarray): Shape (npop, ntheta) or (ntheta,), see eval_telluric_batch.
+            exact (bool): Convolve the model directly at the quantized parameters, rather than interpolating
+                between the resolutions of the ladder.
+
+        Returns:
+            ndarray: Models, shape (npop, nspec), or (nspec,) for a single theta.
+        """
+        thetas_2d = np.atleast_2d(thetas)
+        if thetas_2d.shape[1] not in [5, 6, 7]:
+            raise ValueError('Input model atmosphere parameters must have length 5, 6 or 7.')
+        if exact:
+            tell_models = np.array([self._eval_exact(self.quantize_theta(theta)) for theta in thetas_2d])
+        else:
+            values = np.column_stack([np.log(thetas_2d[:, 4]), thetas_2d[:, :4]])
+            tell_models = interp_grid(values, [np.log(self.res)] + self.grids, self.conv_grid)
+            tell_models = shift_telluric_batch(tell_models, self.loglam_pad, self.dloglam, thetas_2d)[:, self.trim]
+        return tell_models if np.ndim(thetas) > 1 else tell_models[0]
+
+    def quantize_theta(self, theta):
+        """
+        Round theta to QUANTIZE_STEP of the grid spacing in (pressure, temperature, humidity, airmass), of the
+        smallest spacing of the resolution ladder in resolution, and the shift and stretch to QUANTIZE_STEP pixels
+        (across the window for the stretch).
+        """
+        steps = np.concatenate([self.quantize, np.full(len(theta) - 5, QUANTIZE_STEP)])
+        steps[6:] *= 1.0/self.loglam_pad.size
+        return tuple(np.round(np.asarray(theta)/steps)*steps)
+
+    def _eval_exact_quantized(self, theta):
+        tell_model = eval_telluric_batch(np.array(theta)[None, :], self.tell_dict, self.ind_lower, self.ind_upper)[0]
+        # Shared by all of the callers of the cache
+        tell_model.flags.writeable = False
+        return tell_model
@@ -1,10 +1,39 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
+import scipy.interpolate
+import scipy.ndimage
+import scipy.optimize
+import scipy.special
+import matplotlib.pyplot as plt
+from astropy.io import fits
+from astropy.table import Table
 
-def sort_telluric(wave, wave_mask, tell_dict):
+from pypeit import utils
+from pypeit import msgs
+from pypeit.core import coadd1d
+
+# The telluric grids are memory-mapped, and only the wavelength windows that are used are read
+from telluric_grid import read_telluric_grid, eval_telluric_batch, TelluricConvolutionCache
+
+
+def eval_tell_model(theta, tell_dict, exact=False):
+    # The telluric model of one theta, or of a population of shape (npop, ntheta), interpolated
+    # linearly in the grid, so that the chi2 of single thetas and of populations and the final
+    # models all agree. With the resolution ladder of fit_joint_telluric(resln_ladder=True) it is
+    # interpolated from the convolved grids, or convolved directly and memoized with exact=True
+    if 'conv_cache' in tell_dict:
+        return tell_dict['conv_cache'].eval(theta, exact=exact)
+    tell_model = eval_telluric_batch(np.atleast_2d(theta), tell_dict)
+    return tell_model if np.ndim(theta) > 1 else tell_model[0]
+
+
+def telluric_strength(wave, wave_mask, tell_dict):
 
     norders = wave.shape[1]
     tell_med = np.zeros(norders)
-    # Do a quick loop over all the orders to sort them in order of strongest to weakest telluric absorption
+    # Mean transmission of the model in the middle of the grid over each order, i.e. low for strong absorption
     for iord in range(norders):
         ind_lower = np.argmin(np.abs(tell_dict['wave_grid'] - np.min(wave[wave_mask[:,iord],iord])))
         ind_upper = np.argmin(np.abs(tell_dict['wave_grid'] - np.max(wave[wave_mask[:,iord],iord])))
@@ -12,6 +41,12 @@ def sort_telluric(wave, wave_mask, tell_dict):
         tell_model_mid = tm_grid[tm_grid.shape[0]//2, tm_grid.shape[1]//2,tm_grid.shape[2]//2,tm_grid.shape[3]//2,:]
         tell_med[iord] = np.mean(tell_model_mid)
 
+    return tell_med
+
+
+def sort_telluric(wave, wave_mask, tell_dict):
+
+    tell_med = telluric_strength(wave, wave_mask, tell_dict)
     # Perform fits in order of telluric strength
     srt_order_tell = tell_med.argsort()
 
@@ -19,13 +54,18 @@ def sort_telluric(wave, wave_mask, tell_dict):
 
 
 def sensfunc_guess(wave, counts_ps, inmask, flam_true, tell_dict_now, resln_guess, airmass_guess, polyorder, func,
-                   ind_lower, ind_upper,
+                   ind_lower=None, ind_upper=None,
                    lower=3.0, upper=3.0, debug=False):
 
-    # Model parameter guess for starting the optimizations
+    # Model parameter guess for starting the optimizations. tell_dict_now is either the full grid and the data
+    # are its pixels ind_lower:ind_upper+1, or it is already trimmed to the data plus tell_pad pixels
     tell_guess = (np.median(tell_dict_now['pressure_grid']), np.median(tell_dict_now['temp_grid']),
                   np.median(tell_dict_now['h2o_grid']), airmass_guess, resln_guess, 0.0)
-    tell_model1 = eval_telluric(tell_guess, tell_dict_now, ind_lower, ind_upper)
+    if ind_lower is None:
+        tell_pad = tell_dict_now['tell_pad']
+        tell_model1 = eval_tell_model(tell_guess, tell_dict_now)[tell_pad[0]:-tell_pad[1]]
+    else:
+        tell_model1 = eval_telluric_batch(np.atleast_2d(tell_guess), tell_dict_now, ind_lower, ind_upper)[0]
     sensguess_arg = tell_model1 * flam_true/(counts_ps + (counts_ps < 0.0))
     sensguess = np.log(sensguess_arg)
     fitmask = inmask & np.isfinite(sensguess) & (sensguess_arg > 0.0)
@@ -129,15 +169,101 @@ def tellfit_chi2(theta, flux, thismask, arg_dict):
 
     return chi2
 
-def tellfit(flam, thismask, arg_dict, **kwargs_opt):
+def _init_chi2_worker(chi2_func, args):
+    # The data of the fit are sent to each worker process once, when the pool starts
+    global _worker_chi2
+    _worker_chi2 = (chi2_func, args)
+
+
+def _chi2_worker(thetas):
+    chi2_func, args = _worker_chi2
+    return chi2_func(thetas, *args)
+
+
+class PopulationChi2(object):
+    """
+    chi2 of a whole differential_evolution population, for vectorized=True, i.e. called with the parameters of
+    all of the members, shape (ntheta, npop). With nproc > 1 the population is split across a pool of worker
+    processes, which is started on entering the context.
+
+    Args:
+        chi2_func: Population chi2, e.g. tellfit_chi2_batch
+        args: Its other arguments, (flam, thismask, arg_dict)
+        nproc: Number of worker processes
+    """
+    def __init__(self, chi2_func, args, nproc=1):
+        self.chi2_func = chi2_func
+        self.args = args
+        self.nproc = nproc
+        self.executor = None
+
+    def __enter__(self):
+        if self.nproc > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.nproc, initializer=_init_chi2_worker,
+                                                initargs=(self.chi2_func, self.args))
+        return self
+
+    def __exit__(self, *exc):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __call__(self, thetas):
+        if self.executor is None or np.ndim(thetas) == 1 or np.shape(thetas)[1] < 2*self.nproc:
+            return self.chi2_func(thetas, *self.args)
+        # The chunks are concatenated in order, so the result does not depend on nproc
+        chunks = np.array_split(thetas, self.nproc, axis=1)
+        return np.concatenate(list(self.executor.map(_chi2_worker, chunks)))
+
+
+def optimize_population(chi2_func, flam, thismask, arg_dict, init_from_last=None, **kwargs_opt):
+    """
+    differential_evolution for the fitting functions of robust_optimize, whose last 6 parameters are the telluric ones.
+
+    With vectorized=True in kwargs_opt chi2_func is a population chi2 (e.g. tellfit_chi2_batch), and the population
+    is evaluated at once, by arg_dict['nproc'] worker processes if more than one. init_from_last is the result of
+    the previous rejection iteration, which robust_optimize passes: its final population, spread out by a Gaussian
+    ball of arg_dict['ballsize'] times the width of the bounds so that a converged population can still move, is the
+    initial population of this one. The ball is drawn from arg_dict['seed'], like the rest of the optimization, so
+    the fits stay deterministic. Otherwise the fit can be seeded with the telluric parameters arg_dict['tell_guess'] of
+    other orders.
+    """
+    bounds = arg_dict['bounds']
+    seed = arg_dict['seed']
+    if init_from_last is not None and getattr(init_from_last, 'population', None) is not None:
+        rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+        lower, upper = np.array(bounds).T
+        ball = arg_dict.get('ballsize', 5e-4)*(upper - lower)*rng.standard_normal(init_from_last.population.shape)
+        kwargs_opt['init'] = np.clip(init_from_last.population + ball, lower, upper)
+    elif arg_dict.get('tell_guess') is not None:
+        # Seeded by the fits of other orders (see fit_orders): the atmospheric parameters (pressure, temperature,
+        # humidity, airmass) start in a Gaussian ball of tell_ballsize times the width of the bounds about
+        # tell_guess, and the others uniformly within their bounds
+        rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+        lower, upper = np.array(bounds).T
+        npop = kwargs_opt.get('popsize', 15)*len(bounds)
+        init = rng.uniform(lower, upper, (npop, len(bounds)))
+        iatm = len(bounds) - 6 + np.arange(4)
+        ball = arg_dict.get('tell_ballsize', 0.05)*(upper[iatm] - lower[iatm])*rng.standard_normal((npop, 4))
+        init[:, iatm] = np.clip(np.asarray(arg_dict['tell_guess'])[:4] + ball, lower[iatm], upper[iatm])
+        kwargs_opt['init'] = init
+    if kwargs_opt.get('vectorized', False):
+        kwargs_opt['updating'] = 'deferred'
+        with PopulationChi2(chi2_func, (flam, thismask, arg_dict), nproc=arg_dict.get('nproc', 1)) as pop_chi2:
+            return scipy.optimize.differential_evolution(pop_chi2, bounds, seed=seed, **kwargs_opt)
+    return scipy.optimize.differential_evolution(chi2_func, bounds, args=(flam, thismask, arg_dict,), seed=seed,
+                                                 **kwargs_opt)
+
+
+def tellfit(flam, thismask, arg_dict, init_from_last=None, **kwargs_opt):
 
     # Function that we are optimizing
     chi2_func= arg_dict['chi2_func']
-    result = scipy.optimize.differential_evolution(chi2_func, args=(flam, thismask, arg_dict,), **kwargs_opt)
+    result = optimize_population(chi2_func, flam, thismask, arg_dict, init_from_last=init_from_last, **kwargs_opt)
     tell_out = result.x
-    tellfit_conv = eval_telluric(tell_out, arg_dict['tell_dict'])
+    tellfit_conv = eval_tell_model(tell_out, arg_dict['tell_dict'], exact=True)
     tell_pad = arg_dict['tell_dict']['tell_pad']
-    flam_model = tellfit_conv*arg_dict['flam_true']
+    flam_model = tellfit_conv[tell_pad[0]:-tell_pad[1]]*arg_dict['flam_true']
 
     return result, flam_model
 
@@ -148,7 +274,7 @@ def tell_qso_evalmodel(theta, arg_dict):
     ind = arg_dict['ind']
     theta_PCA = theta[:npca + 1]
     theta_tell = theta[-5:]
-    tell_model = eval_telluric(theta_tell, arg_dict['tell_dict'])
+    tell_model = eval_tell_model(theta_tell, arg_dict['tell_dict'])
     tell_model_orders = populate_orders(tell_model, ind)
     pca_model = pca_eval(theta_PCA, arg_dict['pca_dict'])
     pca_model_orders = populate_orders(pca_model, ind)
@@ -187,7 +313,7 @@ def sensfunc_tellfit(counts_ps, thismask, arg_dict, **kwargs_opt):
     order = arg_dict['order']
     coeff_out = result.x[:order+1]
     tell_out = result.x[order+1:]
-    tellfit_conv = eval_telluric(tell_out, arg_dict['tell_dict'])
+    tellfit_conv = eval_tell_model(tell_out, arg_dict['tell_dict'], exact=True)
     tell_pad = arg_dict['tell_dict']['tell_pad']
     sensfit = utils.func_val(coeff_out, wave_star, arg_dict['func'], minx=arg_dict['wave_min'], maxx=arg_dict['wave_max'])
     counts_model = tellfit_conv[tell_pad[0]:-tell_pad[1]]*arg_dict['flam_true']/(sensfit + (sensfit == 0.0))
@@ -201,13 +327,36 @@ def tellfit_chi2(theta, flam, thismask, arg_dict):
     flam_true = arg_dict['flam_true']
     tell_dict = arg_dict['tell_dict']
     tell_pad = tell_dict['tell_pad']
-    tellmodel_conv = eval_telluric(theta, tell_dict)
+    tellmodel_conv = eval_tell_model(theta, tell_dict)
     chi_vec = thismask*(tellmodel_conv[tell_pad[0]:-tell_pad[1]]*flam_true - flam)*np.sqrt(flam_ivar)
     chi2 = np.sum(np.square(chi_vec))
 
     return chi2
 
 
+def tellfit_chi2_batch(thetas, flam, thismask, arg_dict):
+    """
+    tellfit_chi2 of a whole population at once, for differential_evolution(vectorized=True, updating='deferred').
+
+    Args:
+        thetas: Shape (ntheta, npop) as passed by differential_evolution, or (ntheta,) for a single theta
+        flam, thismask, arg_dict: See tellfit_chi2
+
+    Returns:
+        chi2 of each member of the population, shape (npop,), or a float for a single theta
+    """
+    flam_ivar = arg_dict['ivar']
+    flam_true = arg_dict['flam_true']
+    tell_dict = arg_dict['tell_dict']
+    tell_pad = tell_dict['tell_pad']
+    thetas_2d = np.reshape(thetas, (np.shape(thetas)[0], -1))
+    tellmodel_conv = eval_tell_model(thetas_2d.T, tell_dict)
+    chi_vec = thismask*(tellmodel_conv[:, tell_pad[0]:-tell_pad[1]]*flam_true - flam)*np.sqrt(flam_ivar)
+    chi2 = np.sum(np.square(chi_vec), axis=1)
+
+    return chi2 if np.ndim(thetas) > 1 else chi2[0]
+
+
 
 
 def sensfunc_telluric_joint(wave, counts_ps, counts_ps_ivar, flam_true, tell_dict, inmask=None, sensfunc=True,
@@ -215,7 +364,7 @@ def sensfunc_telluric_joint(wave, counts_ps, counts_ps_ivar, flam_true, tell_dic
                             delta_coeff_bounds=(-20.0, 20.0), minmax_coeff_bounds=(-5.0, 5.0),
                             seed=None, polyorder=7, func='legendre', maxiter=3, sticky=True, use_mad=True,
                             lower=3.0, upper=3.0, tol=1e-4, popsize=30, recombination=0.7, disp=True, polish=True,
-                            debug=False):
+                            tell_guess=None, debug=False):
     """
     Jointly fit a sensitivity function and telluric correction for an input standart star spectrum.
 
@@ -243,6 +392,7 @@ def sensfunc_telluric_joint(wave, counts_ps, counts_ps_ivar, flam_true, tell_dic
         recombination:
         disp:
         polish:
+        tell_guess: Telluric parameters of other orders to seed the fit with, see fit_orders
         debug:
 
     Returns:
@@ -317,17 +467,19 @@ def sensfunc_telluric_joint(wave, counts_ps, counts_ps_ivar, flam_true, tell_dic
 
     arg_dict = dict(wave=wave, bounds=bounds, counts_ps=counts_ps, ivar=counts_ps_ivar,
                     wave_min=wave_min, wave_max=wave_max, flam_true=flam_true, tell_dict=tell_dict_now, order=polyorder,
-                    sensfunc = sensfunc, func=func, chi2_func=chi2_func)
-    result, ymodel, outmask = utils.robust_optimize(counts_ps, fitting_function, arg_dict, invvar=invvar, inmask=inmask,
-                                                    maxiter=maxiter,lower=lower, upper=upper, sticky=sticky,
-                                                    use_mad=use_mad, bounds = bounds, tol=tol, popsize=popsize,
-                                                    recombination=recombination, disp=disp, polish=polish, seed=seed)
-
-    sens_coeff = result.x[:polyorder + 1]
-    tell_params = result.x[polyorder + 1:]
+                    sensfunc = sensfunc, func=func, chi2_func=chi2_func, seed=seed, tell_guess=tell_guess)
+    # sensfunc_tellfit also returns the renormalized ivar, tellfit does not, so only the result is used
+    result = utils.robust_optimize(counts_ps, fitting_function, arg_dict, invvar=invvar, inmask=inmask,
+                                   maxiter=maxiter,lower=lower, upper=upper, sticky=sticky,
+                                   use_mad=use_mad, tol=tol, popsize=popsize,
+                                   recombination=recombination, disp=disp, polish=polish)[0]
+
+    sens_coeff = result.x[:len(bounds_coeff)]
+    tell_params = result.x[len(bounds_coeff):]
     tell_pad = arg_dict['tell_dict']['tell_pad']
-    telluric_fit = eval_telluric(tell_params, arg_dict['tell_dict'])[tell_pad[0]:-tell_pad[1]]
-    sensfit = utils.func_val(sens_coeff, wave, arg_dict['func'], minx=arg_dict['wave_min'], maxx=arg_dict['wave_max'])
+    telluric_fit = eval_tell_model(tell_params, arg_dict['tell_dict'], exact=True)[tell_pad[0]:-tell_pad[1]]
+    sensfit = np.exp(utils.func_val(sens_coeff, wave, arg_dict['func'], minx=arg_dict['wave_min'],
+                                    maxx=arg_dict['wave_max'])) if sensfunc else np.ones_like(wave)
     counts_model = telluric_fit*arg_dict['flam_true']/(sensfit + (sensfit == 0.0))
 
     if debug:
@@ -347,15 +499,95 @@ def sensfunc_telluric_joint(wave, counts_ps, counts_ps_ivar, flam_true, tell_dic
     return tell_params, telluric_fit, sens_coeff, sensfit
 
 
+def fit_order_joint(task, tell_dict, **kwargs):
+    """
+    sensfunc_telluric_joint of one order for fit_orders. task['data'] are the (wave, counts_ps, counts_ps_ivar,
+    flam_true) of the order and task['kwargs'] its own keyword arguments (inmask, seed, polyorder, tell_guess); kwargs
+    are the ones shared by all of the orders.
+    """
+    return sensfunc_telluric_joint(*task['data'], tell_dict, **task['kwargs'], **kwargs)
+
+
+def _init_order_worker(fit_order, shared):
+    # The telluric grid and the other arguments shared by the orders are sent to each worker process once, when the
+    # pool starts. The grid is memory-mapped, so the workers reopen the file rather than copying the models.
+    global _worker_order
+    _worker_order = (fit_order, shared)
+
+
+def _order_worker(task):
+    fit_order, shared = _worker_order
+    return fit_order(task, **shared)
+
+
+def fit_orders(fit_order, tasks, tell_strength, shared, nproc=1, weak_thresh=0.9):
+    """
+    Fit the orders of an echelle spectrum, in parallel over nproc worker processes if more than one.
+
+    The orders with weak telluric absorption, i.e. a mean transmission tell_strength >= weak_thresh (or the weakest
+    one if there are none), do not depend on each other and are fitted first. The median of their atmospheric
+    parameters (pressure, temperature, humidity, airmass) is then the tell_guess that the fits of the other orders,
+    with strong absorption, start from, since the atmosphere is the same for all of the orders while the absorption
+    bands alone constrain it poorly.
+
+    Args:
+        fit_order: Fit of one order, fit_order(task, **shared), returning the telluric parameters first, e.g.
+            fit_order_joint
+        tasks: One dict per order with its data for fit_order; the per-order seed must be in it so that the fits do
+            not depend on nproc
+        tell_strength: Mean telluric transmission of each order, see telluric_strength
+        shared: Arguments of fit_order shared by all of the orders, e.g. the telluric grid
+        nproc: Number of worker processes
+        weak_thresh: Transmission above which the absorption of an order is weak
+
+    Returns:
+        list: The results of fit_order, in the order of tasks
+    """
+    tell_strength = np.asarray(tell_strength)
+    weak = tell_strength >= weak_thresh
+    if not np.any(weak):
+        weak[np.argmax(tell_strength)] = True
+    # Weakest absorption first within each stage
+    srt = tell_strength.argsort()[::-1]
+    weak_orders = srt[weak[srt]]
+    strong_orders = srt[np.invert(weak[srt])]
+    msgs.info('Fitting {:d} orders with weak telluric absorption, then {:d} with strong absorption'.format(
+        weak_orders.size, strong_orders.size))
+
+    results = [None]*len(tasks)
+    executor = ProcessPoolExecutor(max_workers=nproc, initializer=_init_order_worker, initargs=(fit_order, shared)) \
+        if nproc > 1 else None
+    try:
+        for stage, orders in enumerate([weak_orders, strong_orders]):
+            if stage == 1 and orders.size > 0:
+                tell_guess = np.median(np.array([results[iord][0][:4] for iord in weak_orders]), axis=0)
+                msgs.info('Seeding the strong telluric orders with pressure={:5.3f}, temp={:5.3f}, h2o={:5.3f}, '
+                          'airmass={:5.3f}'.format(*tell_guess))
+                for iord in orders:
+                    tasks[iord]['kwargs']['tell_guess'] = tell_guess
+            stage_tasks = [tasks[iord] for iord in orders]
+            if executor is None:
+                stage_results = [fit_order(task, **shared) for task in stage_tasks]
+            else:
+                stage_results = executor.map(_order_worker, stage_tasks)
+            for iord, result in zip(orders, stage_results):
+                results[iord] = result
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return results
+
+
 
 def ech_sensfunc_telluric(spec1dfile, telgridfile, star_type=None, star_mag=None, ra=None, dec=None,
                           resln_guess=None, resln_frac_bounds=(0.5,1.5), delta_coeff_bounds=(-20.0, 20.0),
                           polyorder=7, func='legendre', maxiter=3, sticky=True, use_mad=True, lower=3.0, upper=3.0,
                           debug = False,
-                          seed=None, tol=1e-4, popsize=30, recombination=0.7, disp=True, polish=True):
+                          seed=None, tol=1e-4, popsize=30, recombination=0.7, disp=True, polish=True, nproc=1):
     """
     Loop over orders to jointly fit a sensitivity function and telluric correction for a standard star spectrum for each
-    order individua
+    order individua. The orders are fitted by fit_orders, nproc at a time
 
 
     Args:
@@ -382,6 +614,7 @@ def ech_sensfunc_telluric(spec1dfile, telgridfile, star_type=None, star_mag=None
         disp:
         polish:
         debug:
+        nproc: Number of orders fitted in parallel, see fit_orders
 
     Returns:
 
@@ -413,8 +646,31 @@ def ech_sensfunc_telluric(spec1dfile, telgridfile, star_type=None, star_mag=None
     else:
         polyorder_vec = np.full(norders, polyorder)
 
-    # Sort order by the strength of their telluric absorption
-    srt_order_tell = telluric_sort(wave, wave_mask, tell_model_dict)
+    # Strength of the telluric absorption of the orders, which sets the order of the fits
+    tell_strength = telluric_strength(wave, wave_mask, tell_model_dict)
+    # One seed per order, drawn up front so that the fits do not depend on the order they are done in. seed can
+    # also be an int, like for sensfunc_telluric_joint
+    rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+    order_seeds = rng.randint(0, 2**32 - 1, size=norders, dtype=np.int64)
+
+    tasks = []
+    for iord in range(norders):
+        wave_mask_iord = wave_mask[:,iord]
+        wave_iord = wave[wave_mask_iord, iord]
+        counts_ps = counts[wave_mask_iord, iord]/exptime
+        counts_ps_ivar = counts_ivar[wave_mask_iord,iord]*exptime ** 2
+        counts_ps_mask = counts_mask[wave_mask_iord,iord]
+        inmask = counts_ps_mask & (counts_ps_ivar > 0.0)
+        # Interpolate standard star spectrum onto the data wavelength grid
+        flam_true = scipy.interpolate.interp1d(std_dict['wave'], std_dict['flux'], bounds_error=False,
+                                               fill_value='extrapolate')(wave_iord)
+        tasks.append(dict(data=(wave_iord, counts_ps, counts_ps_ivar, flam_true),
+                          kwargs=dict(inmask=inmask, seed=order_seeds[iord], polyorder=polyorder_vec[iord])))
+    shared = dict(tell_dict=tell_model_dict, airmass=airmass, resln_guess=resln_guess,
+                  resln_frac_bounds=resln_frac_bounds, delta_coeff_bounds=delta_coeff_bounds, func=func,
+                  maxiter=maxiter, sticky=sticky, use_mad=use_mad, lower=lower, upper=upper, tol=tol, popsize=popsize,
+                  recombination=recombination, disp=disp, polish=polish, debug=debug)
+    results = fit_orders(fit_order_joint, tasks, tell_strength, shared, nproc=nproc)
 
     telluric_out = np.zeros((nspec, norders))
     sensfunc_out = np.zeros((nspec, norders))
@@ -422,26 +678,12 @@ def ech_sensfunc_telluric(spec1dfile, telgridfile, star_type=None, star_mag=None
     tell_dict = {}
     wave_all_min=np.inf
     wave_all_max=-np.inf
-    for iord in srt_order_tell:
-        IPython.embed()
-        msgs.info("Fitting sensitiity function for order: {:d}/{:d}".format(iord, norders))
-        # Interpolate the data onto the fixed telluric grid
+    for iord in range(norders):
         wave_mask_iord = wave_mask[:,iord]
         wave_iord = wave[wave_mask_iord, iord]
         wave_all_min = np.fmin(wave_iord.min(),wave_all_min)
         wave_all_max = np.fmax(wave_iord.max(),wave_all_max)
-        counts_ps = counts[wave_mask_iord, iord]/exptime
-        counts_ps_ivar = counts_ivar[wave_mask_iord,iord]*exptime ** 2
-        counts_ps_mask = counts_mask[wave_mask_iord,iord]
-        inmask = counts_ps_mask & (counts_ps_ivar > 0.0)
-        # Interpolate standard star spectrum onto the data wavelength grid
-        flam_true = scipy.interpolate.interp1d(std_dict['wave'], std_dict['flux'], bounds_error=False,
-                                               fill_value='extrapolate')(wave_iord)
-        tell_params, tellfit, sens_coeff, sensfit = sensfunc_telluric_joint(
-            wave_iord, counts_ps, counts_ps_ivar, flam_true, tell_model_dict, inmask=inmask, airmass=airmass,
-            resln_guess=resln_guess, resln_frac_bounds=resln_frac_bounds, delta_coeff_bounds=delta_coeff_bounds, seed=seed,
-            polyorder=polyorder_vec[iord], func=func, maxiter=maxiter, sticky=sticky, use_mad=use_mad, lower=lower, upper=upper,
-            tol=tol, popsize=popsize, recombination=recombination, disp=disp, polish=polish, debug=debug)
+        tell_params, tellfit, sens_coeff, sensfit = results[iord]
         telluric_out[wave_mask_iord,iord] = tellfit
         sensfunc_out[wave_mask_iord,iord] = sensfit
         sens_dict[str(iord)] = dict(polyorder=polyorder_vec[iord], wave_min=wave_iord.min(), wave_max=wave_iord.max(),
@@ -494,6 +736,27 @@ def populate_orders(quantity, ind):
     return quantity_orders
 
 
+def sensfunc_tellfit_eval(theta, arg_dict, exact=False):
+    """
+    Counts and sensitivity function models of the joint fits, see sensfunc_tellfit_chi2_batch.
+
+    Args:
+        theta: The order+1 coefficients of the sensitivity function followed by the telluric parameters
+        arg_dict: See sensfunc_tellfit_chi2_batch
+        exact: Passed to eval_tell_model
+
+    Returns:
+        counts_model, sensmodel
+    """
+    order = arg_dict['order']
+    tell_pad = arg_dict['tell_dict']['tell_pad']
+    tellmodel_conv = eval_tell_model(theta[order + 1:], arg_dict['tell_dict'], exact=exact)[tell_pad[0]:-tell_pad[1]]
+    sensmodel = np.exp(utils.func_val(theta[:order + 1], arg_dict['wave'], arg_dict['func'], minx=arg_dict['wave_min'],
+                                      maxx=arg_dict['wave_max']))
+    counts_model = tellmodel_conv*arg_dict['flam_true']/(sensmodel + (sensmodel == 0.0))
+    return counts_model, sensmodel
+
+
 # deprecated
 def sensfunc_tellfit_chi2(theta, counts_ps, thismask, arg_dict):
     """
@@ -524,6 +787,33 @@ def sensfunc_tellfit_chi2(theta, counts_ps, thismask, arg_dict):
         return loss_function
 
 
+def sensfunc_tellfit_chi2_batch(thetas, counts_ps, thismask, arg_dict):
+    """
+    sensfunc_tellfit_chi2 of a whole population at once, for differential_evolution(vectorized=True).
+
+    Args:
+        thetas: Shape (ntheta, npop) as passed by differential_evolution, or (ntheta,) for a single theta. The
+            first order+1 parameters are the coefficients of the sensitivity function, the rest the telluric ones
+        counts_ps, thismask, arg_dict: See sensfunc_tellfit_chi2
+
+    Returns:
+        Loss function of each member of the population, shape (npop,), or a float for a single theta
+    """
+    thetas_2d = np.reshape(thetas, (np.shape(thetas)[0], -1))
+    order = arg_dict['order']
+    tell_pad = arg_dict['tell_dict']['tell_pad']
+    tellmodel_conv = eval_tell_model(thetas_2d[order + 1:].T, arg_dict['tell_dict'])[:, tell_pad[0]:-tell_pad[1]]
+    sensmodel = np.exp(np.array([utils.func_val(coeff, arg_dict['wave'], arg_dict['func'], minx=arg_dict['wave_min'],
+                                                maxx=arg_dict['wave_max']) for coeff in thetas_2d[:order + 1].T]))
+    counts_model = tellmodel_conv*arg_dict['flam_true']/(sensmodel + (sensmodel == 0.0))
+    chi_vec = thismask*(sensmodel != 0.0)*(counts_model - counts_ps)*np.sqrt(arg_dict['ivar'])
+    robust_scale = 2.0
+    huber_vec = scipy.special.huber(robust_scale, chi_vec)
+    loss_function = np.sum(np.square(huber_vec*thismask), axis=1)
+    loss_function[np.sum(np.abs(sensmodel), axis=1) < 1e-6] = np.inf
+    return loss_function if np.ndim(thetas) > 1 else loss_function[0]
+
+
 # deprecated
 def qso_tellfit_chi2(theta, flux, thismask, arg_dict):
     tell_model, pca_model, ln_pca_pri = qso_tellfit_eval(theta, arg_dict)
@@ -704,9 +994,10 @@ def ech_telluric(wave, wave_mask, flam, flam_ivar, flam_mask, flam_true, airmass
                  inmask=None, wavegrid_inmask=None,
                  resln_guess=None, resln_frac_bounds=(0.5,1.5), maxiter=3, sticky=True, use_mad=True, lower=3.0, upper=3.0,
                  seed=None, tol=1e-4, popsize=30, recombination=0.7, disp=True, polish=True,
-                 debug=False):
+                 debug=False, nproc=1):
     """
-    Loop over orders to fit a telluric correction order by order given a known spectrum flam_true
+    Loop over orders to fit a telluric correction order by order given a known spectrum flam_true. The orders are
+    fitted by fit_orders, nproc at a time
 
 
     Args:
@@ -733,6 +1024,7 @@ def ech_telluric(wave, wave_mask, flam, flam_ivar, flam_mask, flam_true, airmass
         disp:
         polish:
         debug:
+        nproc: Number of orders fitted in parallel, see fit_orders
 
     Returns:
 
@@ -751,29 +1043,37 @@ def ech_telluric(wave, wave_mask, flam, flam_ivar, flam_mask, flam_true, airmass
 
     # Read in the telluric grid
     tell_model_dict = read_telluric_grid(telgridfile)
-    # Sort orders by the strength of their telluric absorption
-    srt_order_tell = telluric_sort(wave, wave_mask, tell_model_dict)
+    # Strength of the telluric absorption of the orders, which sets the order of the fits
+    tell_strength = telluric_strength(wave, wave_mask, tell_model_dict)
+    # One seed per order, drawn up front so that the fits do not depend on the order they are done in. seed can
+    # also be an int, like for sensfunc_telluric_joint
+    rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+    order_seeds = rng.randint(0, 2**32 - 1, size=norders, dtype=np.int64)
+
+    tasks = []
+    for iord in range(norders):
+        wave_mask_iord = wave_mask[:,iord]
+        flam_ivar_iord = flam_ivar[wave_mask_iord,iord]
+        inmask_tot = flam_mask[wave_mask_iord,iord] & (flam_ivar_iord > 0.0) & inmask_orders[wave_mask_iord, iord]
+        tasks.append(dict(data=(wave[wave_mask_iord, iord], flam[wave_mask_iord, iord], flam_ivar_iord,
+                                flam_true[wave_mask_iord, iord]),
+                          kwargs=dict(inmask=inmask_tot, seed=order_seeds[iord])))
+    shared = dict(tell_dict=tell_model_dict, sensfunc=False, airmass=airmass, resln_guess=resln_guess,
+                  resln_frac_bounds=resln_frac_bounds, maxiter=maxiter, sticky=sticky, use_mad=use_mad, lower=lower,
+                  upper=upper, tol=tol, popsize=popsize, recombination=recombination, disp=disp, polish=polish,
+                  debug=debug)
+    results = fit_orders(fit_order_joint, tasks, tell_strength, shared, nproc=nproc)
+
     telluric_out = np.zeros((nspec, norders))
     tell_dict = {}
     wave_all_min=np.inf
     wave_all_max=-np.inf
-    for iord in srt_order_tell:
-        msgs.info("Fitting telluric absorption for order: {:d}/{:d}".format(iord, norders))
+    for iord in range(norders):
         wave_mask_iord = wave_mask[:,iord]
         wave_iord = wave[wave_mask_iord, iord]
         wave_all_min = np.fmin(wave_iord.min(),wave_all_min)
         wave_all_max = np.fmax(wave_iord.max(),wave_all_max)
-        flam_iord = flam[wave_mask_iord, iord]
-        flam_ivar_iord = flam_ivar[wave_mask_iord,iord]
-        flam_mask_iord = flam_mask[wave_mask_iord,iord]
-        inmask_iord = inmask_orders[wave_mask_iord, iord]
-        inmask_tot = flam_mask_iord & (flam_ivar_iord > 0.0) & inmask_iord
-        flam_true_iord = flam_true[wave_mask_iord, iord]
-        tell_params, tellfit, sens_coeff, sensfit = sensfunc_telluric_joint(
-            wave_iord, flam_iord, flam_ivar_iord, flam_true_iord, tell_model_dict, inmask=inmask_tot, sensfunc=False,
-            airmass=airmass, resln_guess=resln_guess, resln_frac_bounds=resln_frac_bounds, seed=seed, maxiter=maxiter,
-            sticky=sticky, use_mad=use_mad, lower=lower, upper=upper,
-            tol=tol, popsize=popsize, recombination=recombination, disp=disp, polish=polish, debug=debug)
+        tell_params, tellfit, sens_coeff, sensfit = results[iord]
         telluric_out[wave_mask_iord,iord] = tellfit
         tell_dict[str(iord)] = dict(wave_min=wave_iord.min(), wave_max=wave_iord.max(),
                                     pressure=tell_params[0], temp=tell_params[1], h2o=tell_params[2],
@@ -787,17 +1087,15 @@ def ech_telluric(wave, wave_mask, flam, flam_ivar, flam_mask, flam_true, airmass
 
 
 
-def sensfunc_tellfit(counts_ps, thismask, arg_dict, **kwargs_opt):
+def sensfunc_tellfit(counts_ps, thismask, arg_dict, init_from_last=None, **kwargs_opt):
 
     # Function that we are optimizing
     chi2_func = arg_dict['chi2_func']
     counts_ps_ivar = arg_dict['ivar']
-    bounds = arg_dict['bounds']
-    seed = arg_dict['seed']
-    result = scipy.optimize.differential_evolution(chi2_func, bounds, args=(counts_ps, thismask, arg_dict,), seed=seed,
-                                                   **kwargs_opt)
+    result = optimize_population(chi2_func, counts_ps, thismask, arg_dict, init_from_last=init_from_last,
+                                 **kwargs_opt)
 
-    counts_model, sensmodel = sensfunc_tellfit_eval(result.x, arg_dict)
+    counts_model, sensmodel = sensfunc_tellfit_eval(result.x, arg_dict, exact=True)
     chi_vec = thismask * (sensmodel != 0.0) * (counts_model - counts_ps) * np.sqrt(counts_ps_ivar)
 
     try:
@@ -838,7 +1136,8 @@ def fit_joint_telluric(counts_ps_in, counts_ps_ivar_in, counts_ps_mask_in, flam_
                        airmass=None, resln_guess=None, pix_shift_bounds = (-2.0,2.0), resln_frac_bounds=(0.5,1.5),
                        delta_coeff_bounds=(-20.0, 20.0), minmax_coeff_bounds=(-5.0, 5.0),
                        polyorder=7, func='legendre', maxiter=3, sticky=True, use_mad=False,
-                       lower=3.0, upper=3.0, seed=None, debug=False, **kwargs_opt):
+                       lower=3.0, upper=3.0, seed=None, resln_ladder=False, nproc=1, ballsize=5e-4,
+                       debug=False, **kwargs_opt):
     """
     Jointly fit a sensitivity function and telluric correction for an input standart star spectrum.
 
@@ -866,6 +1165,11 @@ def fit_joint_telluric(counts_ps_in, counts_ps_ivar_in, counts_ps_mask_in, flam_
         recombination:
         disp:
         polish:
+        resln_ladder: If True, convolve the telluric grid once at a ladder of resolutions spanning the resolution
+            bounds, and interpolate the models of the fit from it rather than convolving each of them
+        nproc: With vectorized=True in kwargs_opt, the number of processes evaluating each population
+        ballsize: Size of the Gaussian ball, relative to the bounds, spreading out the population of the previous
+            rejection iteration that the next one starts from
         debug:
 
     Returns:
@@ -911,10 +1215,14 @@ def fit_joint_telluric(counts_ps_in, counts_ps_ivar_in, counts_ps_mask_in, flam_
                          h2o_grid=tell_dict['h2o_grid'], airmass_grid=tell_dict['airmass_grid'],
                          tell_grid=tell_model_grid, tell_pad=tell_pad_tuple, dloglam=dloglam,
                          loglam = np.log10(tell_wave_grid))
+    if resln_ladder:
+        tell_dict_now['conv_cache'] = TelluricConvolutionCache(tell_dict_now, resln_guess*resln_frac_bounds[0],
+                                                               resln_guess*resln_frac_bounds[1])
 
     if sensfunc:
-        # Joint sensitivity function and telluric fits
-        chi2_func = sensfunc_tellfit_chi2
+        # Joint sensitivity function and telluric fits. With vectorized=True differential_evolution evaluates
+        # the whole population in one call
+        chi2_func = sensfunc_tellfit_chi2_batch if kwargs_opt.get('vectorized', False) else sensfunc_tellfit_chi2
         fitting_function=sensfunc_tellfit
         # Guess the coefficients by doing a fit to the sensitivity function with the average telluric behavior
         guess_coeff = sensfunc_guess(wave, counts_ps, counts_ps_mask, flam_true, tell_dict_now, resln_guess, airmass_guess,
@@ -922,14 +1230,12 @@ def fit_joint_telluric(counts_ps_in, counts_ps_ivar_in, counts_ps_mask_in, flam_
         # Polynomial coefficient bounds
         bounds_coeff = [(np.fmin(np.abs(this_coeff)*delta_coeff_bounds[0], minmax_coeff_bounds[0]),
                          np.fmax(np.abs(this_coeff)*delta_coeff_bounds[1], minmax_coeff_bounds[1])) for this_coeff in guess_coeff]
-    elif qso:
-        pass
     else:
-        # Telluric only fits
-        chi2_func = tellfit_chi2
+        # Telluric only fits. With vectorized=True differential_evolution evaluates the whole population in one call
+        chi2_func = tellfit_chi2_batch if kwargs_opt.get('vectorized', False) else tellfit_chi2
         fitting_function=tellfit
         bounds_coeff = []
-        guess_coeff = [] ## TODO this will break
+        guess_coeff = []
 
     # Set the bounds for the optimization
     bounds_tell = [(tell_dict_now['pressure_grid'].min(), tell_dict_now['pressure_grid'].max()),
@@ -946,23 +1252,26 @@ def fit_joint_telluric(counts_ps_in, counts_ps_ivar_in, counts_ps_mask_in, flam_
                   airmass_guess,
                   resln_guess,
                   0.0]
-    guess = guess_coeff.tolist() + guess_tell
+    guess = list(guess_coeff) + guess_tell
 
     arg_dict = dict(wave=wave, bounds=bounds, guess=guess, counts_ps=counts_ps, ivar=counts_ps_ivar,
                     wave_min=wave_min, wave_max=wave_max, flam_true=flam_true, tell_dict=tell_dict_now, order=polyorder,
-                    sensfunc = sensfunc, func=func, chi2_func=chi2_func, seed=seed, debug=debug)
-    result, ymodel, ivartot, outmask = utils.robust_optimize(counts_ps, fitting_function, arg_dict, inmask=counts_ps_mask,
-                                                             maxiter=maxiter,lower=lower, upper=upper, sticky=sticky,
-                                                             use_mad=use_mad, **kwargs_opt)
+                    sensfunc = sensfunc, func=func, chi2_func=chi2_func, seed=seed, nproc=nproc, ballsize=ballsize,
+                    debug=debug)
+    # sensfunc_tellfit also returns the renormalized ivar, tellfit does not, so only the result is used
+    result = utils.robust_optimize(counts_ps, fitting_function, arg_dict, inmask=counts_ps_mask,
+                                   maxiter=maxiter,lower=lower, upper=upper, sticky=sticky,
+                                   use_mad=use_mad, **kwargs_opt)[0]
     #bounds = bounds, tol=tol, popsize=popsize,
     #recombination=recombination, disp=disp, polish=polish, seed=seed)
 
     # TODO move to sensfunc_telluric and individual routines
-    sens_coeff = result.x[:polyorder + 1]
-    tell_params = result.x[polyorder + 1:]
+    sens_coeff = result.x[:len(bounds_coeff)]
+    tell_params = result.x[len(bounds_coeff):]
     tell_pad = arg_dict['tell_dict']['tell_pad']
-    telluric_fit = eval_telluric(tell_params, arg_dict['tell_dict'])[tell_pad[0]:-tell_pad[1]]
-    sensfit = np.exp(utils.func_val(sens_coeff, wave, arg_dict['func'], minx=wave_min, maxx=wave_max))
+    telluric_fit = eval_tell_model(tell_params, arg_dict['tell_dict'], exact=True)[tell_pad[0]:-tell_pad[1]]
+    sensfit = np.exp(utils.func_val(sens_coeff, wave, arg_dict['func'], minx=wave_min, maxx=wave_max)) if sensfunc \
+        else np.ones_like(wave)
     counts_model = telluric_fit*arg_dict['flam_true']/(sensfit + (sensfit == 0.0))
     if debug:
         plt.plot(wave,counts_ps*sensfit, drawstyle='steps-mid')
@@ -0,0 +1,53 @@
+"""
+Tests of the memory-mapped telluric grids of telluric_grid.py, on a small synthetic grid.
+
+Run from this directory with pytest test_telluric_grid.py
+"""
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import telluric_grid
+import use_tel_grid
+
+
+@pytest.fixture
+def grid_file(tmp_path):
+    shape = (3, 4, 5, 2, 200)
+    model_grid = np.random.default_rng(1234).uniform(0.5, 1.0, shape)
+    header = fits.Header()
+    for key, (start, step, n) in dict(PRES=(700.0, 10.0, 3), TEMP=(270.0, 5.0, 4), HUM=(0.0, 20.0, 5),
+                                      AM=(1.0, 0.5, 2)).items():
+        header[key + '0'], header['D' + key], header['N' + key] = start, step, n
+    filename = str(tmp_path / 'telluric_grid.fits')
+    fits.HDUList([fits.PrimaryHDU(model_grid, header=header),
+                  fits.ImageHDU(np.linspace(900.0, 1000.0, shape[-1]))]).writeto(filename)
+    return filename, model_grid
+
+
+def test_single_lookup_reads_one_model(grid_file):
+    filename, model_grid = grid_file
+    wave_grid, tell_grid, pg, tg, hg, ag = use_tel_grid.read_telluric_grid(filename)
+    tell_grid.gridfile.window.cache_clear()
+
+    model = use_tel_grid.interp_telluric_grid(np.array([pg[1], tg[2], hg[3], ag[1]]), pg, tg, hg, ag, tell_grid)
+    assert np.array_equal(model, model_grid[1, 2, 3, 1])
+    # The full grid is not read into the window cache
+    assert tell_grid.gridfile.window.cache_info().currsize == 0
+
+
+def test_batch_matches_full_grid(grid_file):
+    filename, model_grid = grid_file
+    wave_grid, tell_grid, pg, tg, hg, ag = use_tel_grid.read_telluric_grid(filename)
+    tell_grid.gridfile.window.cache_clear()
+
+    rng = np.random.default_rng(5678)
+    thetas = np.column_stack([rng.uniform(grid[0], grid[-1], 20) for grid in [pg, tg, hg, ag]])
+    tell_dict = dict(pressure_grid=pg, temp_grid=tg, h2o_grid=hg, airmass_grid=ag)
+    for method in ['linear', 'nearest']:
+        models = telluric_grid.interp_telluric_grid_batch(thetas, dict(tell_dict, tell_grid=tell_grid),
+                                                          method=method)
+        expected = telluric_grid.interp_telluric_grid_batch(thetas, dict(tell_dict, tell_grid=model_grid),
+                                                            method=method)
+        assert np.allclose(models, expected, rtol=0.0, atol=1e-14)
+    assert tell_grid.gridfile.window.cache_info().currsize == 0
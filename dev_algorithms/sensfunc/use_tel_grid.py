@@ -1,42 +1,28 @@
 import numpy as np
-from astropy.io import fits
 
-def read_telluric_grid(filename):
-    hdul = fits.open(filename)
-    wave_grid = hdul[1].data
-    model_grid = hdul[0].data
+from telluric_grid import open_telluric_grid, TelluricGridArray, interp_telluric_grid_batch
 
-    pg = hdul[0].header['PRES0']+hdul[0].header['DPRES']*np.arange(0,hdul[0].header['NPRES'])
-    tg = hdul[0].header['TEMP0']+hdul[0].header['DTEMP']*np.arange(0,hdul[0].header['NTEMP'])
-    hg = hdul[0].header['HUM0']+hdul[0].header['DHUM']*np.arange(0,hdul[0].header['NHUM'])
-    if hdul[0].header['NAM'] > 1:
-        ag = hdul[0].header['AM0']+hdul[0].header['DAM']*np.arange(0,hdul[0].header['NAM'])
-    else:
-        ag = hdul[0].header['AM0']+1*np.arange(0,1)
-
-    return wave_grid, model_grid, pg, tg, hg, ag
-
-def interp_telluric_grid(theta,pg,tg,hg,ag,model_grid):
-
-    press,temp,hum,airmass = theta
-    if len(pg) > 1:
-        p_ind = int(np.round((press-pg[0])/(pg[1]-pg[0])))
-    else:
-        p_ind = 0
-    if len(tg) > 1:
-        t_ind = int(np.round((temp-tg[0])/(tg[1]-tg[0])))
-    else:
-        t_ind = 0
-    if len(hg) > 1:
-        h_ind = int(np.round((hum-hg[0])/(hg[1]-hg[0])))
-    else:
-        h_ind = 0
-    if len(ag) > 1:
-        a_ind = int(np.round((airmass-ag[0])/(ag[1]-ag[0])))
-    else:
-        a_ind = 0
-
-    return model_grid[p_ind,t_ind,h_ind,a_ind]
+def read_telluric_grid(filename, wave_min=None, wave_max=None, pad=0):
+    # The model grid is memory-mapped, and only read from the file for the
+    # models and wavelengths that are used. wave_min/wave_max (in the units
+    # of the file) trim it to the closest pixels, plus pad pixels
+    gridfile = open_telluric_grid(filename)
+    ind_lower, ind_upper = gridfile.window_indices(wave_min, wave_max, pad=pad)
+    wave_grid = gridfile.wave[ind_lower:ind_upper]
+    model_grid = TelluricGridArray(gridfile, ind_lower, ind_upper)
 
+    pg = gridfile.pressure_grid
+    tg = gridfile.temp_grid
+    hg = gridfile.h2o_grid
+    ag = gridfile.airmass_grid
 
+    return wave_grid, model_grid, pg, tg, hg, ag
 
+def interp_telluric_grid(theta,pg,tg,hg,ag,model_grid,method='nearest'):
+    # theta is one (pressure, temperature, humidity, airmass), or an array
+    # of shape (npop, 4) to interpolate a whole population in one call.
+    # method='linear' interpolates between the grid points rather than
+    # taking the nearest one
+    tell_dict = dict(pressure_grid=pg, temp_grid=tg, h2o_grid=hg, airmass_grid=ag, tell_grid=model_grid)
+    models = interp_telluric_grid_batch(theta, tell_dict, method=method)
+    return models[0] if np.ndim(theta) == 1 else models
@@ -0,0 +1,213 @@
+"""
+Persistent index of the archived arc spectra used by reidentify.
+
+Reidentifying an arc cross-correlates it against every spectrum of a wavelength solution archive. Everything
+about the archive that does not depend on the input arc is computed once and saved with the archive: the
+smoothed and normalized archive spectra and their FFTs, the archive wavelength solutions, and the archive line
+lists with their wavelengths. The index is a directory of .npy files that are memory-mapped when loaded, so
+that e.g. the 100+ slits of a DEIMOS mask or the orders of an echelle spectrograph can rank the archive spectra
+with one batched FFT cross-correlation per slit, and only run the expensive shift and stretch matching against
+the best few.
+"""
+import os
+import json
+
+import numpy as np
+import scipy
+import scipy.fft
+import scipy.ndimage
+
+from pypeit import msgs
+from pypeit import utils
+
+INDEX_VERSION = 1
+
+
+class ArxivIndex(object):
+    """
+    Precomputed quantities for the spectra of a wavelength solution archive.
+
+    Attributes:
+        spec (ndarray): Archive arc spectra, shape (narxiv, nspec).
+        spec_norm (ndarray): Smoothed spectra, normalized to unit norm, shape (narxiv, nspec).
+        fft_conj (ndarray): Complex conjugate of the FFT of spec_norm zero padded to nfft, shape (narxiv, nfft//2+1).
+        wave_soln (ndarray): Archive wavelength solutions, shape (narxiv, nspec).
+        wvc (ndarray): Central wavelength of each archive spectrum, shape (narxiv,).
+        disp (ndarray): Median dispersion of each archive spectrum, shape (narxiv,).
+        line_pix, line_wave (ndarray): Pixel positions and wavelengths of the lines of all of the archive spectra,
+            concatenated. The lines of archive spectrum iarxiv are line_start[iarxiv]:line_start[iarxiv+1].
+        meta (dict): nspec, narxiv, nfft, smooth and the archive file the index was built from.
+    """
+    array_names = ['spec', 'spec_norm', 'fft_conj', 'wave_soln', 'wvc', 'disp', 'line_pix', 'line_wave',
+                   'line_start']
+
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        for name in self.array_names:
+            setattr(self, name, arrays[name])
+
+    @property
+    def narxiv(self):
+        return self.meta['narxiv']
+
+    @property
+    def nspec(self):
+        return self.meta['nspec']
+
+    @classmethod
+    def build(cls, wv_calib_arxiv, smooth=5.0, source=None):
+        """
+        Compute the index of a wavelength solution archive.
+
+        Args:
+            wv_calib_arxiv (dict): Archive wavelength solutions, in the standard PypeIt format, with keys '0', '1', ...
+            smooth (float): Sigma in pixels of the Gaussian used to smooth the spectra for the global cross-correlation.
+            source (dict): Description of the archive file, stored in the metadata. See load_arxiv_index.
+
+        Returns:
+            ArxivIndex
+        """
+        narxiv = len(wv_calib_arxiv)
+        nspec = wv_calib_arxiv['0']['spec'].size
+        xrng = np.arange(nspec)
+
+        spec = np.zeros((narxiv, nspec))
+        wave_soln = np.zeros((narxiv, nspec))
+        line_pix, line_wave = [], []
+        for iarxiv in range(narxiv):
+            calib = wv_calib_arxiv[str(iarxiv)]
+            if calib['spec'].size != nspec:
+                msgs.error('All of the archive spectra must have the same number of pixels')
+            spec[iarxiv, :] = calib['spec']
+            wave_soln[iarxiv, :] = utils.func_val(calib['fitc'], xrng, calib['function'], minv=calib['fmin'],
+                                                  maxv=calib['fmax'])
+            line_pix.append(np.asarray(calib['xfit'], dtype=float))
+            line_wave.append(utils.func_val(calib['fitc'], line_pix[-1], calib['function'], minv=calib['fmin'],
+                                            maxv=calib['fmax']))
+        wvc = wave_soln[:, nspec//2].copy()
+        disp = np.median(wave_soln - np.roll(wave_soln, 1, axis=1), axis=1)
+
+        # Zero padded so that the FFT cross-correlation is not circular
+        nfft = scipy.fft.next_fast_len(2*nspec - 1)
+        spec_norm = _normalize(spec, smooth)
+        arrays = dict(spec=spec, spec_norm=spec_norm, fft_conj=np.conj(scipy.fft.rfft(spec_norm, nfft, axis=1)),
+                      wave_soln=wave_soln, wvc=wvc, disp=disp, line_pix=np.concatenate(line_pix),
+                      line_wave=np.concatenate(line_wave),
+                      line_start=np.cumsum([0] + [pix.size for pix in line_pix]))
+        meta = dict(version=INDEX_VERSION, nspec=nspec, narxiv=narxiv, nfft=nfft, smooth=smooth, source=source)
+        return cls(meta, arrays)
+
+    def save(self, index_dir):
+        """
+        Save the index as .npy files and a meta.json in index_dir. The meta.json of an index already in index_dir
+        is removed first and the new one is written last, so that the index is only valid once it is complete.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        meta_file = os.path.join(index_dir, 'meta.json')
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+        # Each file is written under a temporary name and renamed, so that processes that have the old arrays
+        # memory-mapped keep reading them
+        tmp_suffix = '.{:d}.tmp'.format(os.getpid())
+        for name in self.array_names:
+            array_file = os.path.join(index_dir, name + '.npy')
+            with open(array_file + tmp_suffix, 'wb') as f:
+                np.save(f, getattr(self, name))
+            os.replace(array_file + tmp_suffix, array_file)
+        with open(meta_file + tmp_suffix, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(meta_file + tmp_suffix, meta_file)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        """Load an index saved by save, memory-mapping its arrays."""
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(index_dir, name + '.npy'), mmap_mode=mmap_mode)
+                  for name in cls.array_names}
+        return cls(meta, arrays)
+
+    def lines(self, iarxiv):
+        """Return the pixel positions and wavelengths of the lines of archive spectrum iarxiv."""
+        sl = slice(self.line_start[iarxiv], self.line_start[iarxiv + 1])
+        return self.line_pix[sl], self.line_wave[sl]
+
+    def global_xcorr(self, spec):
+        """
+        Cross-correlate a spectrum with all of the archive spectra at once.
+
+        Args:
+            spec (ndarray): Arc spectrum, shape (nspec,).
+
+        Returns:
+            ccorr, lag: The peak normalized cross-correlation with each archive spectrum, and the shift in pixels of
+            the archive spectrum at the peak, each of shape (narxiv,).
+        """
+        nspec, nfft = self.nspec, self.meta['nfft']
+        if spec.size != nspec:
+            msgs.error('Different spectral binning is not supported yet but it will be soon')
+        spec_fft = scipy.fft.rfft(_normalize(spec, self.meta['smooth']), nfft)
+        corr = scipy.fft.irfft(spec_fft[None, :]*self.fft_conj, nfft, axis=1)
+        # Lags 0 to nspec-1 are at the start and negative lags wrap around to the end
+        lags = np.concatenate((np.arange(nspec), np.arange(-(nspec - 1), 0)))
+        corr = np.concatenate((corr[:, :nspec], corr[:, nfft - nspec + 1:]), axis=1)
+        imax = np.argmax(corr, axis=1)
+        return corr[np.arange(self.narxiv), imax], lags[imax]
+
+    def top_candidates(self, spec, ntop=None):
+        """
+        Return the indices, in increasing order, of the ntop archive spectra that best cross-correlate with spec.
+        All of the archive spectra are returned if ntop is None.
+        """
+        if ntop is None or ntop >= self.narxiv:
+            return np.arange(self.narxiv)
+        ccorr, _ = self.global_xcorr(spec)
+        return np.sort(np.argsort(-ccorr, kind='stable')[:ntop])
+
+
+def _normalize(spec, smooth):
+    """Smooth spectra (along the last axis) and normalize them to unit norm."""
+    spec_smooth = scipy.ndimage.gaussian_filter1d(np.asarray(spec, dtype=float), smooth, axis=-1)
+    norm = np.sqrt(np.sum(spec_smooth**2, axis=-1, keepdims=True))
+    return spec_smooth/np.where(norm > 0.0, norm, 1.0)
+
+
+def _source_info(arxiv_file):
+    stat = os.stat(arxiv_file)
+    return dict(file=os.path.abspath(arxiv_file), size=stat.st_size, mtime=stat.st_mtime)
+
+
+def load_arxiv_index(arxiv_file, wv_calib_arxiv=None, index_dir=None, smooth=5.0, rebuild=False):
+    """
+    Load the index of a wavelength solution archive file, building it first if it does not exist or is out of date.
+
+    Args:
+        arxiv_file (str): The archive file, e.g. a MasterWaveCalib json file.
+        wv_calib_arxiv (dict): The archive wavelength solutions. Only needed if the index has to be built; if None
+            they are read from arxiv_file with wavecalib.load_wv_calib.
+        index_dir (str): Directory of the index. Defaults to arxiv_file + '.index'.
+        smooth (float): Smoothing used for the global cross-correlation. See ArxivIndex.build.
+        rebuild (bool): Rebuild the index even if it is up to date.
+
+    Returns:
+        ArxivIndex, with memory-mapped arrays.
+    """
+    if index_dir is None:
+        index_dir = arxiv_file + '.index'
+    source = _source_info(arxiv_file)
+
+    meta_file = os.path.join(index_dir, 'meta.json')
+    if not rebuild and os.path.isfile(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta['version'] == INDEX_VERSION and meta['smooth'] == smooth and meta['source'] == source:
+            return ArxivIndex.load(index_dir)
+        msgs.info('Archive index {:} is out of date'.format(index_dir))
+
+    msgs.info('Building archive index {:}'.format(index_dir))
+    if wv_calib_arxiv is None:
+        from pypeit import wavecalib
+        wv_calib_arxiv, _ = wavecalib.load_wv_calib(arxiv_file)
+        wv_calib_arxiv = {key: value for key, value in wv_calib_arxiv.items() if key not in ['steps', 'par']}
+    ArxivIndex.build(wv_calib_arxiv, smooth=smooth, source=source).save(index_dir)
+    return ArxivIndex.load(index_dir)
@@ -1,18 +1,29 @@
 
 
+import copy
+import time
+import itertools
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import scipy
+from matplotlib import pyplot as plt
+from astropy import table
 # Read in a wavelength solution and compute
 from pypeit import wavecalib
-from pypeit.core.wavecal import autoid, waveio
+from pypeit import msgs
+from pypeit.core.wavecal import autoid, waveio, wvutils, patterns, fitting, qa
 from pypeit import utils
 
+from arxiv_index import load_arxiv_index
+
 
 
 
 def reidentify_old(spec, wv_calib_arxiv, lamps, nreid_min, detections=None, cc_thresh=0.8,cc_local_thresh = 0.8,
                line_pix_tol=2.0, nlocal_cc=11, rms_threshold=0.15, nonlinear_counts=1e10,sigdetect = 5.0,
                use_unknowns=True,match_toler=3.0,func='legendre',n_first=2,sigrej_first=3.0,n_final=4, sigrej_final=2.0,
-               seed=None, debug_xcorr=False, debug_reid=False):
+               seed=None, arxiv_index=None, ntop=None, nproc=1, debug_xcorr=False, debug_reid=False):
 
     """ Determine  a wavelength solution for a set of spectra based on archival wavelength solutions
 
@@ -95,7 +106,20 @@ def reidentify_old(spec, wv_calib_arxiv, lamps, nreid_min, detections=None, cc_t
 
     seed: int or np.random.RandomState, optional, default = None
        Seed for scipy.optimize.differential_evolution optimizer. If not specified, the calculation will be seeded
-       in a deterministic way from the input arc spectrum spec.
+       in a deterministic way from the input arc spectrum spec. The optimizer for each slit is seeded with
+       (seed, islit), so the results do not depend on nproc.
+
+    arxiv_index: ArxivIndex, default = None
+       Precomputed index of wv_calib_arxiv (see arxiv_index.load_arxiv_index). If given, the archive spectra,
+       wavelength solutions and line lists are taken from the index rather than recomputed.
+
+    ntop: int, default = None
+       If given (with arxiv_index), only the ntop archive spectra with the largest global cross-correlation with
+       each slit are matched to it with the shift/stretch fit. All of the archive spectra are used if None.
+
+    nproc: int, default = 1
+       Number of processes to reidentify the slits with. The archive spectra are shared with the processes
+       through shared memory. Debugging plots are only shown if nproc = 1.
 
     debug_xcorr: bool, default = False
        Show plots useful for debugging the cross-correlation used for shift/stretch computation
@@ -118,22 +142,21 @@ def reidentify_old(spec, wv_calib_arxiv, lamps, nreid_min, detections=None, cc_t
     bad_slits: ndarray, int
        Numpy array with the indices of the bad slits. These are the indices in the input arc spectrum array spec[:,islit]
 
+    The time taken and RMS of each slit are reported at the end.
+
 
     Revision History
     ----------------
     November 2018 by J.F. Hennawi. Based on an initial version of this code written by Ryan Cooke.
     """
 
+
     # Determine the seed for scipy.optimize.differential_evolution optimizer
     if seed is None:
         # If no seed is specified just take the sum of all the elements and round that to an integer
         seed = np.fmin(int(np.sum(spec)),2**32-1)
-
-    random_state = np.random.RandomState(seed = seed)
-
-
-    nlocal_cc_odd = nlocal_cc + 1 if nlocal_cc % 2 == 0 else nlocal_cc
-    window = 1.0/nlocal_cc_odd* np.ones(nlocal_cc_odd)
+    elif isinstance(seed, np.random.RandomState):
+        seed = seed.randint(2**32 - 1)
 
     # Generate the line list
     line_lists = waveio.load_line_lists(lamps)
@@ -163,295 +186,414 @@ def reidentify_old(spec, wv_calib_arxiv, lamps, nreid_min, detections=None, cc_t
             msgs.error('Detections must be a dictionary with nslit elements')
 
     # For convenience pull out all the spectra from the wv_calib_arxiv archive
-    spec_arxiv = np.zeros((nspec, narxiv))
-    wave_soln_arxiv = np.zeros((nspec, narxiv))
-    wvc_arxiv = np.zeros(narxiv, dtype=float)
-    disp_arxiv = np.zeros(narxiv, dtype=float)
     xrng = np.arange(nspec_arxiv)
-    for iarxiv in range(narxiv):
-        spec_arxiv[:,iarxiv] = wv_calib_arxiv[str(iarxiv)]['spec']
-        fitc = wv_calib_arxiv[str(iarxiv)]['fitc']
-        fitfunc = wv_calib_arxiv[str(iarxiv)]['function']
-        fmin, fmax = wv_calib_arxiv[str(iarxiv)]['fmin'],wv_calib_arxiv[str(iarxiv)]['fmax']
-        wave_soln_arxiv[:,iarxiv] = utils.func_val(fitc, xrng, fitfunc, minv=fmin, maxv=fmax)
-        wvc_arxiv[iarxiv] = wave_soln_arxiv[nspec_arxiv//2, iarxiv]
-        disp_arxiv[iarxiv] = np.median(wave_soln_arxiv[:,iarxiv] - np.roll(wave_soln_arxiv[:,iarxiv], 1))
+    if arxiv_index is not None:
+        if arxiv_index.narxiv != narxiv:
+            msgs.error('The archive index does not match wv_calib_arxiv')
+        spec_arxiv = arxiv_index.spec.T
+        wvc_arxiv = np.asarray(arxiv_index.wvc)
+        disp_arxiv = np.asarray(arxiv_index.disp)
+        arxiv_lines = [tuple(np.asarray(x) for x in arxiv_index.lines(iarxiv)) for iarxiv in range(narxiv)]
+    else:
+        spec_arxiv = np.zeros((nspec, narxiv))
+        wave_soln_arxiv = np.zeros((nspec, narxiv))
+        wvc_arxiv = np.zeros(narxiv, dtype=float)
+        disp_arxiv = np.zeros(narxiv, dtype=float)
+        arxiv_lines = []
+        for iarxiv in range(narxiv):
+            spec_arxiv[:,iarxiv] = wv_calib_arxiv[str(iarxiv)]['spec']
+            fitc = wv_calib_arxiv[str(iarxiv)]['fitc']
+            fitfunc = wv_calib_arxiv[str(iarxiv)]['function']
+            fmin, fmax = wv_calib_arxiv[str(iarxiv)]['fmin'],wv_calib_arxiv[str(iarxiv)]['fmax']
+            wave_soln_arxiv[:,iarxiv] = utils.func_val(fitc, xrng, fitfunc, minv=fmin, maxv=fmax)
+            wvc_arxiv[iarxiv] = wave_soln_arxiv[nspec_arxiv//2, iarxiv]
+            disp_arxiv[iarxiv] = np.median(wave_soln_arxiv[:,iarxiv] - np.roll(wave_soln_arxiv[:,iarxiv], 1))
+            # Calculate wavelengths for all of the arxiv line detections
+            arxiv_det = wv_calib_arxiv[str(iarxiv)]['xfit']
+            arxiv_lines.append((arxiv_det, utils.func_val(fitc, arxiv_det, fitfunc, minv=fmin, maxv=fmax)))
+
+    if nproc > 1 and (debug_xcorr or debug_reid):
+        msgs.warn('Debugging plots are not shown when running in parallel')
+        debug_xcorr, debug_reid = False, False
+
+    # Everything but the slit spectrum, its detections and random state is the same for all slits
+    slit_kwargs = dict(wvc_arxiv=wvc_arxiv, disp_arxiv=disp_arxiv, arxiv_lines=arxiv_lines, wvdata=wvdata,
+                       line_lists=line_lists, unknwns=unknwns, nreid_min=nreid_min, cc_thresh=cc_thresh,
+                       cc_local_thresh=cc_local_thresh, line_pix_tol=line_pix_tol, nlocal_cc=nlocal_cc,
+                       rms_threshold=rms_threshold, sigdetect=sigdetect, match_toler=match_toler, func=func,
+                       n_first=n_first, sigrej_first=sigrej_first, n_final=n_final, sigrej_final=sigrej_final,
+                       nslits=nslits, debug_xcorr=debug_xcorr, debug_reid=debug_reid)
+    # Each slit gets its own random state derived from the seed, so that the result for a slit does not depend on
+    # which slits were processed before it, or in which process
+    slit_args = []
+    for islit in range(nslits):
+        # Only match the archive spectra that best correlate globally with this slit
+        iarxiv_use = None if arxiv_index is None else arxiv_index.top_candidates(spec[:, islit], ntop=ntop)
+        slit_args.append((islit, spec[:, islit], detections[str(islit)][0], [seed, islit], iarxiv_use))
+
+    # Loop over the slits in the spectrum and cross-correlate each with each arxiv spectrum to identify lines
+    if nproc == 1:
+        results = [_reidentify_slit_timed(args, spec_arxiv, slit_kwargs) for args in slit_args]
+    else:
+        # Share the archive spectra with the worker processes
+        shm = shared_memory.SharedMemory(create=True, size=spec_arxiv.nbytes)
+        try:
+            np.ndarray(spec_arxiv.shape, dtype=float, buffer=shm.buf)[...] = spec_arxiv
+            with ProcessPoolExecutor(max_workers=nproc, initializer=_reidentify_init,
+                                     initargs=(shm.name, spec_arxiv.shape, slit_kwargs)) as executor:
+                results = list(executor.map(_reidentify_slit_worker, slit_args))
+        finally:
+            shm.close()
+            shm.unlink()
 
     wv_calib = {}
     patt_dict = {}
     bad_slits = np.array([], dtype=np.int)
+    report = ''
+    for islit, (wv_calib_slit, patt_dict_slit, bad, slit_time) in enumerate(results):
+        wv_calib[str(islit)] = wv_calib_slit
+        patt_dict[str(islit)] = patt_dict_slit
+        if bad:
+            bad_slits = np.append(bad_slits, islit)
+        rms = '{:7.4f}'.format(wv_calib_slit['rms']) if 'rms' in wv_calib_slit else '   None'
+        report += msgs.newline() + 'slit {:4d}: {:7.2f}s  rms = {:s}{:s}'.format(islit + 1, slit_time, rms,
+                                                                                 '  BAD' if bad else '')
+    msgs.info('Reidentify report:' + report)
+
+    return wv_calib, patt_dict, bad_slits
+
+
+# The read-only state shared by the slits of reidentify_old, set up in each worker process by _reidentify_init
+_reid_worker = {}
+
+
+def _reidentify_init(shm_name, shape, slit_kwargs):
+    """ Attach a worker process to the shared archive spectra. """
+    # Keep a reference to the shared memory, so that it stays attached
+    _reid_worker['shm'] = shared_memory.SharedMemory(name=shm_name)
+    _reid_worker['spec_arxiv'] = np.ndarray(shape, dtype=float, buffer=_reid_worker['shm'].buf)
+    _reid_worker['slit_kwargs'] = slit_kwargs
+
+
+def _reidentify_slit_timed(args, spec_arxiv, slit_kwargs):
+    """ Run reidentify_slit for one slit of reidentify_old, returning its outputs and run time. """
+    islit, spec_slit, slit_det, slit_seed, iarxiv_use = args
+    t0 = time.perf_counter()
+    wv_calib_slit, patt_dict_slit, bad = reidentify_slit(
+        islit, spec_slit, slit_det, spec_arxiv, random_state=np.random.RandomState(seed=slit_seed),
+        iarxiv_use=iarxiv_use, **slit_kwargs)
+    return wv_calib_slit, patt_dict_slit, bad, time.perf_counter() - t0
+
+
+def _reidentify_slit_worker(args):
+    return _reidentify_slit_timed(args, _reid_worker['spec_arxiv'], _reid_worker['slit_kwargs'])
+
+
+def reidentify_slit(islit, spec_slit, slit_det, spec_arxiv, wvc_arxiv, disp_arxiv, arxiv_lines, wvdata, line_lists,
+                    unknwns, nreid_min, random_state, iarxiv_use=None, cc_thresh=0.8, cc_local_thresh=0.8,
+                    line_pix_tol=2.0, nlocal_cc=11, rms_threshold=0.15, sigdetect=5.0, match_toler=3.0,
+                    func='legendre', n_first=2, sigrej_first=3.0, n_final=4, sigrej_final=2.0, nslits=None,
+                    debug_xcorr=False, debug_reid=False):
+    """ Determine the wavelength solution of a single slit of reidentify_old.
+
+    Parameters
+    ----------
+    islit: int
+       Index of the slit, for messages and plots
+    spec_slit: float ndarray (nspec,)
+       Arc spectrum of the slit
+    slit_det: float ndarray
+       Pixel centroids of the lines detected in spec_slit
+    spec_arxiv: float ndarray (nspec, narxiv)
+       Archive arc spectra
+    wvc_arxiv, disp_arxiv: float ndarray (narxiv,)
+       Central wavelength and dispersion of each archive spectrum
+    arxiv_lines: list
+       (pixel, wavelength) arrays of the lines of each archive spectrum
+    wvdata: float ndarray
+       Sorted wavelengths of the line list
+    line_lists, unknwns: astropy Table
+       Line list and unknown lines of the lamps
+    random_state: np.random.RandomState
+       Random state for the scipy.optimize.differential_evolution optimizer
+    iarxiv_use: int ndarray, default = None
+       Indices of the archive spectra to match the slit to. All of them if None.
+    nslits: int, default = None
+       Total number of slits, for messages
+
+    The other parameters are as for reidentify_old.
+
+    Returns
+    -------
+    (wv_calib_slit, patt_dict_slit, bad)
+
+    The final_fit and patterns dictionaries of the slit (empty if no solution was found), and whether it is a
+    bad slit. Solutions with an RMS above rms_threshold are returned but flagged as bad.
+    """
+
+    narxiv = spec_arxiv.shape[1]
+    xrng = np.arange(spec_slit.size)
+    nlocal_cc_odd = nlocal_cc + 1 if nlocal_cc % 2 == 0 else nlocal_cc
+    window = 1.0/nlocal_cc_odd* np.ones(nlocal_cc_odd)
 
     marker_tuple = ('o','v','<','>','8','s','p','P','*','X','D','d','x')
     color_tuple = ('black','green','red','cyan','magenta','blue','darkorange','yellow','dodgerblue','purple','lightgreen','cornflowerblue')
     marker = itertools.cycle(marker_tuple)
     colors = itertools.cycle(color_tuple)
 
-    # Loop over the slits in the spectrum and cross-correlate each with each arxiv spectrum to identify lines
-    for islit in range(nslits):
-        slit_det = detections[str(islit)][0]
-        line_indx = np.array([], dtype=np.int)
-        det_indx = np.array([], dtype=np.int)
-        line_cc = np.array([], dtype=float)
-        line_iarxiv = np.array([], dtype=np.int)
-        wcen = np.zeros(narxiv)
-        disp = np.zeros(narxiv)
-        shift_vec = np.zeros(narxiv)
-        stretch_vec = np.zeros(narxiv)
-        ccorr_vec = np.zeros(narxiv)
-        for iarxiv in range(narxiv):
-            msgs.info('Cross-correlating slit # {:d}'.format(islit + 1) + ' with arxiv slit # {:d}'.format(iarxiv + 1))
-            # Match the peaks between the two spectra. This code attempts to compute the stretch if cc > cc_thresh
-            success, shift_vec[iarxiv], stretch_vec[iarxiv], ccorr_vec[iarxiv], _, _ = \
-                wvutils.xcorr_shift_stretch(spec[:, islit], spec_arxiv[:, iarxiv], cc_thresh=cc_thresh, seed = random_state,
-                                            debug=debug_xcorr)
-            # If cc < cc_thresh or if this optimization failed, don't reidentify from this arxiv spectrum
-            if success != 1:
-                continue
-            # Estimate wcen and disp for this slit based on its shift/stretch relative to the archive slit
-            disp[iarxiv] = disp_arxiv[iarxiv] / stretch_vec[iarxiv]
-            wcen[iarxiv] = wvc_arxiv[iarxiv] - shift_vec[iarxiv]*disp[iarxiv]
-            # For each peak in the arxiv spectrum, identify the corresponding peaks in the input islit spectrum. Do this by
-            # transforming these arxiv slit line pixel locations into the (shifted and stretched) input islit spectrum frame
-            arxiv_det = wv_calib_arxiv[str(iarxiv)]['xfit']
-            arxiv_det_ss = arxiv_det*stretch_vec[iarxiv] + shift_vec[iarxiv]
-            spec_arxiv_ss = wvutils.shift_and_stretch(spec_arxiv[:, iarxiv], shift_vec[iarxiv], stretch_vec[iarxiv])
-
-            if debug_xcorr:
-                plt.figure(figsize=(14, 6))
-                tampl_slit = np.interp(slit_det, xrng, spec[:, islit])
-                plt.plot(xrng, spec[:, islit], color='red', drawstyle='steps-mid', label='input arc',linewidth=1.0, zorder=10)
-                plt.plot(slit_det, tampl_slit, 'r.', markersize=10.0, label='input arc lines', zorder=10)
-                tampl_arxiv = np.interp(arxiv_det, xrng, spec_arxiv[:, iarxiv])
-                plt.plot(xrng, spec_arxiv[:, iarxiv], color='black', drawstyle='steps-mid', linestyle=':',
-                         label='arxiv arc', linewidth=0.5)
-                plt.plot(arxiv_det, tampl_arxiv, 'k+', markersize=8.0, label='arxiv arc lines')
-                # tampl_ss = np.interp(gsdet_ss, xrng, gdarc_ss)
-                for iline in range(arxiv_det_ss.size):
-                    plt.plot([arxiv_det[iline], arxiv_det_ss[iline]], [tampl_arxiv[iline], tampl_arxiv[iline]],
-                             color='cornflowerblue', linewidth=1.0)
-                plt.plot(xrng, spec_arxiv_ss, color='black', drawstyle='steps-mid', label='arxiv arc shift/stretch',linewidth=1.0)
-                plt.plot(arxiv_det_ss, tampl_arxiv, 'k.', markersize=10.0, label='predicted arxiv arc lines')
-                plt.title(
-                    'Cross-correlation of input slit # {:d}'.format(islit + 1) + ' and arxiv slit # {:d}'.format(iarxiv + 1) +
-                    ': ccor = {:5.3f}'.format(ccorr_vec[iarxiv]) +
-                    ', shift = {:6.1f}'.format(shift_vec[iarxiv]) +
-                    ', stretch = {:5.4f}'.format(stretch_vec[iarxiv]) +
-                    ', wv_cen = {:7.1f}'.format(wcen[iarxiv]) +
-                    ', disp = {:5.3f}'.format(disp[iarxiv]))
-                plt.ylim(1.2*spec[:, islit].min(), 1.5 *spec[:, islit].max())
-                plt.legend()
-                plt.show()
-
-            # Calculate wavelengths for all of the gsdet detections
-            wvval_arxiv= utils.func_val(wv_calib_arxiv[str(iarxiv)]['fitc'], arxiv_det,wv_calib_arxiv[str(iarxiv)]['function'],
-                                        minv=wv_calib_arxiv[str(iarxiv)]['fmin'], maxv=wv_calib_arxiv[str(iarxiv)]['fmax'])
-            # Compute a "local" zero lag correlation of the slit spectrum and the shifted and stretch arxiv spectrum over a
-            # a nlocal_cc_odd long segment of spectrum. We will then uses spectral similarity as a further criteria to
-            # decide which lines are good matches
-            prod_smooth = scipy.ndimage.filters.convolve1d(spec[:, islit]*spec_arxiv_ss, window)
-            spec2_smooth = scipy.ndimage.filters.convolve1d(spec[:, islit]**2, window)
-            arxiv2_smooth = scipy.ndimage.filters.convolve1d(spec_arxiv_ss**2, window)
-            denom = np.sqrt(spec2_smooth*arxiv2_smooth)
-            corr_local = np.zeros_like(denom)
-            corr_local[denom > 0] = prod_smooth[denom > 0]/denom[denom > 0]
-            corr_local[denom == 0.0] = -1.0
-
-            # Loop over the current slit line pixel detections and find the nearest arxiv spectrum line
-            for iline in range(slit_det.size):
-                # match to pixel in shifted/stretch arxiv spectrum
-                pdiff = np.abs(slit_det[iline] - arxiv_det_ss)
-                bstpx = np.argmin(pdiff)
-                # If a match is found within 2 pixels, consider this a successful match
-                if pdiff[bstpx] < line_pix_tol:
-                    # Using the arxiv arc wavelength solution, search for the nearest line in the line list
-                    bstwv = np.abs(wvdata - wvval_arxiv[bstpx])
-                    # This is a good wavelength match if it is within line_pix_tol disperion elements
-                    if bstwv[np.argmin(bstwv)] < line_pix_tol*disp_arxiv[iarxiv]:
-                        line_indx = np.append(line_indx, np.argmin(bstwv))  # index in the line list array wvdata of this match
-                        det_indx = np.append(det_indx, iline)             # index of this line in the detected line array slit_det
-                        line_cc = np.append(line_cc,np.interp(slit_det[iline],xrng,corr_local)) # local cross-correlation at this match
-                        line_iarxiv = np.append(line_iarxiv,iarxiv)
-
-        narxiv_used = np.sum(wcen != 0.0)
-        if (narxiv_used == 0) or (len(np.unique(line_indx)) < 3):
-            wv_calib[str(islit)] = {}
-            patt_dict[str(islit)] = {}
-            bad_slits = np.append(bad_slits,islit)
+    line_indx = np.array([], dtype=np.int)
+    det_indx = np.array([], dtype=np.int)
+    line_cc = np.array([], dtype=float)
+    line_iarxiv = np.array([], dtype=np.int)
+    wcen = np.zeros(narxiv)
+    disp = np.zeros(narxiv)
+    shift_vec = np.zeros(narxiv)
+    stretch_vec = np.zeros(narxiv)
+    ccorr_vec = np.zeros(narxiv)
+    for iarxiv in (range(narxiv) if iarxiv_use is None else iarxiv_use):
+        msgs.info('Cross-correlating slit # {:d}'.format(islit + 1) + ' with arxiv slit # {:d}'.format(iarxiv + 1))
+        # Match the peaks between the two spectra. This code attempts to compute the stretch if cc > cc_thresh
+        success, shift_vec[iarxiv], stretch_vec[iarxiv], ccorr_vec[iarxiv], _, _ = \
+            wvutils.xcorr_shift_stretch(spec_slit, spec_arxiv[:, iarxiv], cc_thresh=cc_thresh, seed = random_state,
+                                        debug=debug_xcorr)
+        # If cc < cc_thresh or if this optimization failed, don't reidentify from this arxiv spectrum
+        if success != 1:
             continue
-
-        if debug_reid:
+        # Estimate wcen and disp for this slit based on its shift/stretch relative to the archive slit
+        disp[iarxiv] = disp_arxiv[iarxiv] / stretch_vec[iarxiv]
+        wcen[iarxiv] = wvc_arxiv[iarxiv] - shift_vec[iarxiv]*disp[iarxiv]
+        # For each peak in the arxiv spectrum, identify the corresponding peaks in the input islit spectrum. Do this by
+        # transforming these arxiv slit line pixel locations into the (shifted and stretched) input islit spectrum frame
+        arxiv_det, wvval_arxiv = arxiv_lines[iarxiv]
+        arxiv_det_ss = arxiv_det*stretch_vec[iarxiv] + shift_vec[iarxiv]
+        spec_arxiv_ss = wvutils.shift_and_stretch(spec_arxiv[:, iarxiv], shift_vec[iarxiv], stretch_vec[iarxiv])
+
+        if debug_xcorr:
             plt.figure(figsize=(14, 6))
-            # Plot a summary of the local x-correlation values for each line on each slit
-            for iarxiv in range(narxiv):
-                # Only plot those that we actually tried to reidentify (i.e. above cc_thresh)
-                if wcen[iarxiv] != 0.0:
-                    this_iarxiv = line_iarxiv == iarxiv
-                    plt.plot(wvdata[line_indx[this_iarxiv]],line_cc[this_iarxiv],marker=next(marker),color=next(colors),
-                             linestyle='',markersize=5.0,label='arxiv slit={:d}'.format(iarxiv))
-
-            plt.hlines(cc_local_thresh, wvdata[line_indx].min(), wvdata[line_indx].max(), color='red', linestyle='--',label='Local xcorr threshhold')
-            plt.title('slit={:d}'.format(islit + 1) + ': Local x-correlation for reidentified lines from narxiv_used={:d}'.format(narxiv_used) +
-                      ' arxiv slits. Requirement: nreid_min={:d}'.format(nreid_min) + ' matches > threshold')
-            plt.xlabel('wavelength from line list')
-            plt.ylabel('Local x-correlation coefficient')
-            #plt.ylim((0.0, 1.2))
+            tampl_slit = np.interp(slit_det, xrng, spec_slit)
+            plt.plot(xrng, spec_slit, color='red', drawstyle='steps-mid', label='input arc',linewidth=1.0, zorder=10)
+            plt.plot(slit_det, tampl_slit, 'r.', markersize=10.0, label='input arc lines', zorder=10)
+            tampl_arxiv = np.interp(arxiv_det, xrng, spec_arxiv[:, iarxiv])
+            plt.plot(xrng, spec_arxiv[:, iarxiv], color='black', drawstyle='steps-mid', linestyle=':',
+                     label='arxiv arc', linewidth=0.5)
+            plt.plot(arxiv_det, tampl_arxiv, 'k+', markersize=8.0, label='arxiv arc lines')
+            # tampl_ss = np.interp(gsdet_ss, xrng, gdarc_ss)
+            for iline in range(arxiv_det_ss.size):
+                plt.plot([arxiv_det[iline], arxiv_det_ss[iline]], [tampl_arxiv[iline], tampl_arxiv[iline]],
+                         color='cornflowerblue', linewidth=1.0)
+            plt.plot(xrng, spec_arxiv_ss, color='black', drawstyle='steps-mid', label='arxiv arc shift/stretch',linewidth=1.0)
+            plt.plot(arxiv_det_ss, tampl_arxiv, 'k.', markersize=10.0, label='predicted arxiv arc lines')
+            plt.title(
+                'Cross-correlation of input slit # {:d}'.format(islit + 1) + ' and arxiv slit # {:d}'.format(iarxiv + 1) +
+                ': ccor = {:5.3f}'.format(ccorr_vec[iarxiv]) +
+                ', shift = {:6.1f}'.format(shift_vec[iarxiv]) +
+                ', stretch = {:5.4f}'.format(stretch_vec[iarxiv]) +
+                ', wv_cen = {:7.1f}'.format(wcen[iarxiv]) +
+                ', disp = {:5.3f}'.format(disp[iarxiv]))
+            plt.ylim(1.2*spec_slit.min(), 1.5 *spec_slit.max())
             plt.legend()
             plt.show()
 
-        # Finalize the best guess of each line
-        # Initialise the patterns dictionary, min_nsig not used anywhere
-        patt_dict_slit = dict(acceptable=False, nmatch=0, ibest=-1, bwv=0., min_nsig=sigdetect,mask=np.zeros(slit_det.size, dtype=np.bool))
-        patt_dict_slit['sign'] = 1 # This is not used anywhere
-        patt_dict_slit['bwv'] = np.median(wcen[wcen != 0.0])
-        patt_dict_slit['bdisp'] = np.median(disp[disp != 0.0])
-        patterns.solve_xcorr(slit_det, wvdata, det_indx, line_indx, line_cc, patt_dict=patt_dict_slit,nreid_min=nreid_min,
-                             cc_local_thresh=cc_local_thresh)
-
-        if debug_reid:
-            tmp_list = table.vstack([line_lists, unknwns])
-            qa.match_qa(spec[:, islit], slit_det, tmp_list, patt_dict_slit['IDs'], patt_dict_slit['scores'])
-
-        # Use only the perfect IDs
-        iperfect = np.array(patt_dict_slit['scores']) != 'Perfect'
-        patt_dict_slit['mask'][iperfect] = False
-        patt_dict_slit['nmatch'] = np.sum(patt_dict_slit['mask'])
-        if patt_dict_slit['nmatch'] < 3:
-            patt_dict_slit['acceptable'] = False
-
-        # Check if an acceptable reidentification solution was found
-        if not patt_dict_slit['acceptable']:
-            wv_calib[str(islit)] = {}
-            patt_dict[str(islit)] = copy.deepcopy(patt_dict_slit)
-            bad_slits = np.append(bad_slits,islit)
-            continue
-        # Perform the fit
-        final_fit = fitting.fit_slit(spec[:,islit], patt_dict_slit, slit_det, line_lists, match_toler=match_toler,
-                             func=func, n_first=n_first,sigrej_first=sigrej_first,n_final=n_final,
-                             sigrej_final=sigrej_final)
-
-        # Did the fit succeed?
-        if final_fit is None:
-            # This pattern wasn't good enough
-            wv_calib[str(islit)] = {}
-            patt_dict[str(islit)] = copy.deepcopy(patt_dict_slit)
-            bad_slits = np.append(bad_slits, islit)
-            continue
-        # Is the RMS below the threshold?
-        if final_fit['rms'] > rms_threshold:
-            msgs.warn('---------------------------------------------------' + msgs.newline() +
-                      'Reidentify report for slit {0:d}/{1:d}:'.format(islit + 1, nslits) + msgs.newline() +
-                      '  Poor RMS ({0:.3f})! Need to add additional spectra to arxiv to improve fits'.format(final_fit['rms']) + msgs.newline() +
-                      '---------------------------------------------------')
-            bad_slits = np.append(bad_slits, islit)
-            # Note this result in new_bad_slits, but store the solution since this might be the best possible
-
-        # Add the patt_dict and wv_calib to the output dicts
-        patt_dict[str(islit)] = copy.deepcopy(patt_dict_slit)
-        wv_calib[str(islit)] = copy.deepcopy(final_fit)
-        if debug_reid:
-            qa.arc_fit_qa(wv_calib[str(islit)])
-            #yplt = utils.func_val(final_fit['fitc'], xrng, final_fit['function'], minv=final_fit['fmin'], maxv=final_fit['fmax'])
-            #plt.plot(final_fit['xfit'], final_fit['yfit'], 'bx')
-            #plt.plot(xrng, yplt, 'r-')
-            #plt.show()
+        # Compute a "local" zero lag correlation of the slit spectrum and the shifted and stretch arxiv spectrum over a
+        # a nlocal_cc_odd long segment of spectrum. We will then uses spectral similarity as a further criteria to
+        # decide which lines are good matches
+        prod_smooth = scipy.ndimage.filters.convolve1d(spec_slit*spec_arxiv_ss, window)
+        spec2_smooth = scipy.ndimage.filters.convolve1d(spec_slit**2, window)
+        arxiv2_smooth = scipy.ndimage.filters.convolve1d(spec_arxiv_ss**2, window)
+        denom = np.sqrt(spec2_smooth*arxiv2_smooth)
+        corr_local = np.zeros_like(denom)
+        corr_local[denom > 0] = prod_smooth[denom > 0]/denom[denom > 0]
+        corr_local[denom == 0.0] = -1.0
+
+        # Loop over the current slit line pixel detections and find the nearest arxiv spectrum line
+        for iline in range(slit_det.size):
+            # match to pixel in shifted/stretch arxiv spectrum
+            pdiff = np.abs(slit_det[iline] - arxiv_det_ss)
+            bstpx = np.argmin(pdiff)
+            # If a match is found within 2 pixels, consider this a successful match
+            if pdiff[bstpx] < line_pix_tol:
+                # Using the arxiv arc wavelength solution, search for the nearest line in the line list
+                bstwv = np.abs(wvdata - wvval_arxiv[bstpx])
+                # This is a good wavelength match if it is within line_pix_tol disperion elements
+                if bstwv[np.argmin(bstwv)] < line_pix_tol*disp_arxiv[iarxiv]:
+                    line_indx = np.append(line_indx, np.argmin(bstwv))  # index in the line list array wvdata of this match
+                    det_indx = np.append(det_indx, iline)             # index of this line in the detected line array slit_det
+                    line_cc = np.append(line_cc,np.interp(slit_det[iline],xrng,corr_local)) # local cross-correlation at this match
+                    line_iarxiv = np.append(line_iarxiv,iarxiv)
+
+    narxiv_used = np.sum(wcen != 0.0)
+    if (narxiv_used == 0) or (len(np.unique(line_indx)) < 3):
+        return {}, {}, True
+
+    if debug_reid:
+        plt.figure(figsize=(14, 6))
+        # Plot a summary of the local x-correlation values for each line on each slit
+        for iarxiv in range(narxiv):
+            # Only plot those that we actually tried to reidentify (i.e. above cc_thresh)
+            if wcen[iarxiv] != 0.0:
+                this_iarxiv = line_iarxiv == iarxiv
+                plt.plot(wvdata[line_indx[this_iarxiv]],line_cc[this_iarxiv],marker=next(marker),color=next(colors),
+                         linestyle='',markersize=5.0,label='arxiv slit={:d}'.format(iarxiv))
+
+        plt.hlines(cc_local_thresh, wvdata[line_indx].min(), wvdata[line_indx].max(), color='red', linestyle='--',label='Local xcorr threshhold')
+        plt.title('slit={:d}'.format(islit + 1) + ': Local x-correlation for reidentified lines from narxiv_used={:d}'.format(narxiv_used) +
+                  ' arxiv slits. Requirement: nreid_min={:d}'.format(nreid_min) + ' matches > threshold')
+        plt.xlabel('wavelength from line list')
+        plt.ylabel('Local x-correlation coefficient')
+        #plt.ylim((0.0, 1.2))
+        plt.legend()
+        plt.show()
+
+    # Finalize the best guess of each line
+    # Initialise the patterns dictionary, min_nsig not used anywhere
+    patt_dict_slit = dict(acceptable=False, nmatch=0, ibest=-1, bwv=0., min_nsig=sigdetect,mask=np.zeros(slit_det.size, dtype=np.bool))
+    patt_dict_slit['sign'] = 1 # This is not used anywhere
+    patt_dict_slit['bwv'] = np.median(wcen[wcen != 0.0])
+    patt_dict_slit['bdisp'] = np.median(disp[disp != 0.0])
+    patterns.solve_xcorr(slit_det, wvdata, det_indx, line_indx, line_cc, patt_dict=patt_dict_slit,nreid_min=nreid_min,
+                         cc_local_thresh=cc_local_thresh)
+
+    if debug_reid:
+        tmp_list = table.vstack([line_lists, unknwns])
+        qa.match_qa(spec_slit, slit_det, tmp_list, patt_dict_slit['IDs'], patt_dict_slit['scores'])
+
+    # Use only the perfect IDs
+    iperfect = np.array(patt_dict_slit['scores']) != 'Perfect'
+    patt_dict_slit['mask'][iperfect] = False
+    patt_dict_slit['nmatch'] = np.sum(patt_dict_slit['mask'])
+    if patt_dict_slit['nmatch'] < 3:
+        patt_dict_slit['acceptable'] = False
+
+    # Check if an acceptable reidentification solution was found
+    if not patt_dict_slit['acceptable']:
+        return {}, copy.deepcopy(patt_dict_slit), True
+    # Perform the fit
+    final_fit = fitting.fit_slit(spec_slit, patt_dict_slit, slit_det, line_lists, match_toler=match_toler,
+                         func=func, n_first=n_first,sigrej_first=sigrej_first,n_final=n_final,
+                         sigrej_final=sigrej_final)
+
+    # Did the fit succeed?
+    if final_fit is None:
+        # This pattern wasn't good enough
+        return {}, copy.deepcopy(patt_dict_slit), True
+    # Is the RMS below the threshold?
+    bad = final_fit['rms'] > rms_threshold
+    if bad:
+        msgs.warn('---------------------------------------------------' + msgs.newline() +
+                  'Reidentify report for slit {0:d}/{1:d}:'.format(islit + 1, nslits) + msgs.newline() +
+                  '  Poor RMS ({0:.3f})! Need to add additional spectra to arxiv to improve fits'.format(final_fit['rms']) + msgs.newline() +
+                  '---------------------------------------------------')
+        # Note this result in new_bad_slits, but store the solution since this might be the best possible
+
+    if debug_reid:
+        qa.arc_fit_qa(final_fit)
+        #yplt = utils.func_val(final_fit['fitc'], xrng, final_fit['function'], minv=final_fit['fmin'], maxv=final_fit['fmax'])
+        #plt.plot(final_fit['xfit'], final_fit['yfit'], 'bx')
+        #plt.plot(xrng, yplt, 'r-')
+        #plt.show()
+
+    return copy.deepcopy(final_fit), copy.deepcopy(patt_dict_slit), bad
+
+
+# The driver below only runs as a script, so that the worker processes of reidentify_old, which import this
+# module when they are spawned, do not run it
+if __name__ == '__main__':
+    instrument = 'NIRES'
+    if instrument == 'NIRES':
+        calibfile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_NIRES/NIRES/MF_keck_nires/MasterWaveCalib_A_01_aa.json'
+        wv_calib_arxiv, par = wavecalib.load_wv_calib(calibfile)
+        steps= wv_calib_arxiv.pop('steps')
+        par_dum = wv_calib_arxiv.pop('par')
+
+        datafile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_NIRES/NIRES/MF_keck_nires/MasterWaveCalib_A_01_ac.json'
+        wv_calib_data, par = wavecalib.load_wv_calib(datafile)
+        steps= wv_calib_data.pop('steps')
+        par_dum = wv_calib_data.pop('par')
+    elif instrument == 'LRIS-R':
+        # Use one detector as the arxiv the other as the data
+        calibfile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_LRIS_red/multi_400_8500_d560/MF_keck_lris_red/MasterWaveCalib_A_01_aa.json'
+        wv_calib_arxiv, par = wavecalib.load_wv_calib(calibfile)
+        steps= wv_calib_arxiv.pop('steps')
+        par_dum = wv_calib_arxiv.pop('par')
+
+        datafile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_LRIS_red/multi_400_8500_d560/MF_keck_lris_red/MasterWaveCalib_A_02_aa.json'
+        wv_calib_data, par = wavecalib.load_wv_calib(datafile)
+        steps= wv_calib_data.pop('steps')
+        par_dum = wv_calib_data.pop('par')
+    elif instrument == 'LRIS-B':
+        # Use one detector as the arxiv the other as the data
+        calibfile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_LRIS_blue/multi_600_4000_d560/MF_keck_lris_blue/MasterWaveCalib_A_02_aa.json'
+        wv_calib_arxiv, par = wavecalib.load_wv_calib(calibfile)
+        steps= wv_calib_arxiv.pop('steps')
+        par_dum = wv_calib_arxiv.pop('par')
+
+        datafile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_LRIS_blue/multi_600_4000_d560/MF_keck_lris_blue/MasterWaveCalib_A_01_aa.json'
+        wv_calib_data, par = wavecalib.load_wv_calib(datafile)
+        steps= wv_calib_data.pop('steps')
+        par_dum = wv_calib_data.pop('par')
+
+    nslits = len(wv_calib_data)
+    # assignments
+    spec = np.zeros((wv_calib_data['0']['spec'].size, nslits))
+    for slit in range(nslits):
+        spec[:,slit] = wv_calib_data[str(slit)]['spec']
 
-    return wv_calib, patt_dict, bad_slits
+    narxiv = len(wv_calib_arxiv)
+    nspec = wv_calib_arxiv['0']['spec'].size
+    # assignments
+    spec_arxiv = np.zeros((nspec, narxiv))
+    for iarxiv in range(narxiv):
+        spec_arxiv[:,iarxiv] = wv_calib_arxiv[str(iarxiv)]['spec']
 
+    det_arxiv = {}
+    wave_soln_arxiv = np.zeros((nspec, narxiv))
+    xrng = np.arange(nspec)
+    for iarxiv in range(narxiv):
+        spec_arxiv[:, iarxiv] = wv_calib_arxiv[str(iarxiv)]['spec']
+        fitc = wv_calib_arxiv[str(iarxiv)]['fitc']
+        fitfunc = wv_calib_arxiv[str(iarxiv)]['function']
+        fmin, fmax = wv_calib_arxiv[str(iarxiv)]['fmin'], wv_calib_arxiv[str(iarxiv)]['fmax']
+        wave_soln_arxiv[:, iarxiv] = utils.func_val(fitc, xrng, fitfunc, minv=fmin, maxv=fmax)
+        det_arxiv[str(iarxiv)] = wv_calib_arxiv[str(iarxiv)]['xfit']
 
 
-instrument = 'NIRES'
-if instrument == 'NIRES':
-    calibfile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_NIRES/NIRES/MF_keck_nires/MasterWaveCalib_A_01_aa.json'
-    wv_calib_arxiv, par = wavecalib.load_wv_calib(calibfile)
-    steps= wv_calib_arxiv.pop('steps')
-    par_dum = wv_calib_arxiv.pop('par')
-
-    datafile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_NIRES/NIRES/MF_keck_nires/MasterWaveCalib_A_01_ac.json'
-    wv_calib_data, par = wavecalib.load_wv_calib(datafile)
-    steps= wv_calib_data.pop('steps')
-    par_dum = wv_calib_data.pop('par')
-elif instrument == 'LRIS-R':
-    # Use one detector as the arxiv the other as the data
-    calibfile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_LRIS_red/multi_400_8500_d560/MF_keck_lris_red/MasterWaveCalib_A_01_aa.json'
-    wv_calib_arxiv, par = wavecalib.load_wv_calib(calibfile)
-    steps= wv_calib_arxiv.pop('steps')
-    par_dum = wv_calib_arxiv.pop('par')
-
-    datafile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_LRIS_red/multi_400_8500_d560/MF_keck_lris_red/MasterWaveCalib_A_02_aa.json'
-    wv_calib_data, par = wavecalib.load_wv_calib(datafile)
-    steps= wv_calib_data.pop('steps')
-    par_dum = wv_calib_data.pop('par')
-elif instrument == 'LRIS-B':
-    # Use one detector as the arxiv the other as the data
-    calibfile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_LRIS_blue/multi_600_4000_d560/MF_keck_lris_blue/MasterWaveCalib_A_02_aa.json'
-    wv_calib_arxiv, par = wavecalib.load_wv_calib(calibfile)
-    steps= wv_calib_arxiv.pop('steps')
-    par_dum = wv_calib_arxiv.pop('par')
-
-    datafile ='/Users/joe/python/PypeIt-development-suite/REDUX_OUT/Keck_LRIS_blue/multi_600_4000_d560/MF_keck_lris_blue/MasterWaveCalib_A_01_aa.json'
-    wv_calib_data, par = wavecalib.load_wv_calib(datafile)
-    steps= wv_calib_data.pop('steps')
-    par_dum = wv_calib_data.pop('par')
-
-nslits = len(wv_calib_data)
-# assignments
-spec = np.zeros((wv_calib_data['0']['spec'].size, nslits))
-for slit in range(nslits):
-    spec[:,slit] = wv_calib_data[str(slit)]['spec']
-
-narxiv = len(wv_calib_arxiv)
-nspec = wv_calib_arxiv['0']['spec'].size
-# assignments
-spec_arxiv = np.zeros((nspec, narxiv))
-for iarxiv in range(narxiv):
-    spec_arxiv[:,iarxiv] = wv_calib_arxiv[str(iarxiv)]['spec']
-
-det_arxiv = {}
-wave_soln_arxiv = np.zeros((nspec, narxiv))
-xrng = np.arange(nspec)
-for iarxiv in range(narxiv):
-    spec_arxiv[:, iarxiv] = wv_calib_arxiv[str(iarxiv)]['spec']
-    fitc = wv_calib_arxiv[str(iarxiv)]['fitc']
-    fitfunc = wv_calib_arxiv[str(iarxiv)]['function']
-    fmin, fmax = wv_calib_arxiv[str(iarxiv)]['fmin'], wv_calib_arxiv[str(iarxiv)]['fmax']
-    wave_soln_arxiv[:, iarxiv] = utils.func_val(fitc, xrng, fitfunc, minv=fmin, maxv=fmax)
-    det_arxiv[str(iarxiv)] = wv_calib_arxiv[str(iarxiv)]['xfit']
-
-
-
-match_toler = 2.0 #par['match_toler']
-n_first = par['n_first']
-sigrej_first = par['sigrej_first']
-n_final = par['n_final']
-sigrej_final = par['sigrej_final']
-func = par['func']
-nonlinear_counts=par['nonlinear_counts']
-sigdetect = par['lowest_nsig']
-rms_threshold = par['rms_threshold']
-lamps = par['lamps']
-
-line_list = waveio.load_line_lists(lamps)
-
-
-cc_thresh =0.8
-cc_local_thresh = 0.8
-n_local_cc =11
-
-
-nreid_min = 1
-
-new = False
-if new:
-    all_patt_dict={}
-    all_detections = {}
-    for islit in range(nslits):
-        all_detections[str(islit)], all_patt_dict[str(islit)] = autoid.reidentify(spec[:,islit], spec_arxiv, wave_soln_arxiv, det_arxiv, line_list, nreid_min,
-                                                                                  detections=None, cc_thresh=cc_thresh,cc_local_thresh=cc_local_thresh,
-                                                                                  match_toler=match_toler, nlocal_cc=11, nonlinear_counts=nonlinear_counts,sigdetect=sigdetect,
-                                                                                  debug_xcorr=True, debug_reid=True)
-else:
-    wv_calib_out, patt_dict, bad_slits = autoid.reidentify_old(spec, wv_calib_arxiv, lamps, nreid_min, rms_threshold=rms_threshold,
-                                                               nonlinear_counts=nonlinear_counts,sigdetect=sigdetect,use_unknowns=True,
-                                                               match_toler=match_toler,func='legendre',n_first=n_first,
-                                                               sigrej_first=sigrej_first,n_final=n_final, sigrej_final=sigrej_final,
-                                                               debug_xcorr=True, debug_reid=True)
\ No newline at end of file
+
+    match_toler = 2.0 #par['match_toler']
+    n_first = par['n_first']
+    sigrej_first = par['sigrej_first']
+    n_final = par['n_final']
+    sigrej_final = par['sigrej_final']
+    func = par['func']
+    nonlinear_counts=par['nonlinear_counts']
+    sigdetect = par['lowest_nsig']
+    rms_threshold = par['rms_threshold']
+    lamps = par['lamps']
+
+    line_list = waveio.load_line_lists(lamps)
+
+
+    cc_thresh =0.8
+    cc_local_thresh = 0.8
+    n_local_cc =11
+
+
+    nreid_min = 1
+
+    new = False
+    if new:
+        all_patt_dict={}
+        all_detections = {}
+        for islit in range(nslits):
+            all_detections[str(islit)], all_patt_dict[str(islit)] = autoid.reidentify(spec[:,islit], spec_arxiv, wave_soln_arxiv, det_arxiv, line_list, nreid_min,
+                                                                                      detections=None, cc_thresh=cc_thresh,cc_local_thresh=cc_local_thresh,
+                                                                                      match_toler=match_toler, nlocal_cc=11, nonlinear_counts=nonlinear_counts,sigdetect=sigdetect,
+                                                                                      debug_xcorr=True, debug_reid=True)
+    else:
+        # Built on the first run and memory-mapped afterwards
+        arxiv_index = load_arxiv_index(calibfile, wv_calib_arxiv=wv_calib_arxiv)
+        wv_calib_out, patt_dict, bad_slits = reidentify_old(spec, wv_calib_arxiv, lamps, nreid_min, rms_threshold=rms_threshold,
+                                                            nonlinear_counts=nonlinear_counts,sigdetect=sigdetect,use_unknowns=True,
+                                                            match_toler=match_toler,func='legendre',n_first=n_first,
+                                                            sigrej_first=sigrej_first,n_final=n_final, sigrej_final=sigrej_final,
+                                                            arxiv_index=arxiv_index, ntop=5,
+                                                            debug_xcorr=True, debug_reid=True)
@@ -5,6 +5,7 @@
 """
 from __future__ import (print_function, absolute_import, division, unicode_literals)
 
+import time
 import numpy as np
 import numba as nb
 
@@ -144,6 +145,97 @@ def xcorr_shift_stretch(inspec1, inspec2, smooth = 5.0, shift_mnmx = (-0.05,0.05
 
     return result.success, result.x[0], result.x[1], -result.fun, shift_cc, cc_val
 
+def stretch_spec(spline, nspec, stretch):
+    """ Stretch a spectrum as in shift_and_stretch, without the shift. The stretched spectrum has
+    int(nspec*stretch) pixels.
+
+    spline is the quadratic interpolating spline of the spectrum that interp1d would build, i.e.
+    scipy.interpolate.make_interp_spline(np.arange(nspec)/float(nspec), spec, k=2), so that it can be
+    shared by all of the stretches.
+    """
+    nspec_stretch = int(nspec*stretch)
+    x2 = np.arange(nspec_stretch)/float(nspec_stretch)
+    return np.where(x2 <= (nspec - 1)/float(nspec), spline(x2), 0.0)
+
+
+def xcorr_shift_stretch_fft(inspec1, inspec2, smooth = 5.0, shift_mnmx = (-0.05,0.05), stretch_mnmx = (0.9,1.1),
+                            debug = True):
+    """ Same as xcorr_shift_stretch, but the correlation is maximized by a coarse-to-fine grid search
+    rather than by differential evolution.
+
+    The zero lag correlation of shift_and_stretch at every integer shift is a single FFT cross-correlation of
+    the stretched spectrum, so each trial stretch costs one resampling and one FFT. The stretches are first
+    searched on a grid coarse enough that the features at the ends of the spectrum move by one smoothing
+    width per step, then every distinct stretch (shift_and_stretch stretches to int(nspec*stretch) pixels)
+    around the best one is tried, and finally the shift is refined to sub-pixel precision.
+
+    Returns the same values as xcorr_shift_stretch.
+    """
+
+    nspec = inspec1.size
+    y1 = scipy.ndimage.filters.gaussian_filter(inspec1, smooth)
+    y2 = scipy.ndimage.filters.gaussian_filter(inspec2, smooth)
+    corr_denom = np.sqrt(np.sum(y1*y1)*np.sum(y2*y2))
+
+    # The cross-correlation determines the range of shifts searched, as for xcorr_shift_stretch
+    shift_cc, cc_val = xcorr_shift(y1, y2, debug = debug)
+    shift_min, shift_max = shift_cc + nspec*shift_mnmx[0], shift_cc + nspec*shift_mnmx[1]
+    spline = scipy.interpolate.make_interp_spline(np.arange(nspec)/float(nspec), y2, k=2)
+
+    def best_shift(nspec_stretch):
+        # Correlation at all integer shifts of the spectrum stretched to nspec_stretch pixels. The stretch is
+        # taken from the middle of the range of stretches that give nspec_stretch pixels.
+        y2_str = stretch_spec(spline, nspec, (nspec_stretch + 0.5)/nspec)
+        # shift_and_stretch zeros the pixels beyond the end of the stretched spectrum
+        y1_str = y1[:nspec_stretch]
+        corr = scipy.signal.correlate(y1_str, y2_str, mode='full', method='fft')/corr_denom
+        lags = np.arange(-y2_str.size + 1, y1_str.size)
+        inside = (lags >= np.ceil(shift_min)) & (lags <= np.floor(shift_max))
+        if not np.any(inside):
+            return -np.inf, np.round(0.5*(shift_min + shift_max))
+        imax = np.argmax(np.where(inside, corr, -np.inf))
+        if imax == 0 or imax == corr.size - 1:
+            return corr[imax], lags[imax]
+        # Interpolate the peak with a parabola, so that stretches are compared at their best sub-pixel shift
+        c0, c1, c2 = corr[imax - 1:imax + 2]
+        denom = c0 - 2.0*c1 + c2
+        dlag = np.clip(0.5*(c0 - c2)/denom, -0.5, 0.5) if denom < 0.0 else 0.0
+        return c1 - 0.25*(c0 - c2)*dlag, lags[imax] + dlag
+
+    # Coarse grid of stretches
+    nstr_min, nstr_max = int(nspec*stretch_mnmx[0]), int(nspec*stretch_mnmx[1]) - 1
+    step = max(int(2*smooth), 1)
+    nstr_coarse = np.unique(np.append(np.arange(nstr_min, nstr_max + 1, step), nstr_max))
+    corr_coarse = np.array([best_shift(nstr)[0] for nstr in nstr_coarse])
+    nstr_best = nstr_coarse[np.argmax(corr_coarse)]
+
+    # Every stretch within one coarse step of the best one
+    nstr_fine = np.arange(max(nstr_best - step, nstr_min), min(nstr_best + step, nstr_max) + 1)
+    fine = [best_shift(nstr) for nstr in nstr_fine]
+    ibest = np.argmax([corr for corr, lag in fine])
+    stretch = (nstr_fine[ibest] + 0.5)/nspec
+    lag = np.clip(fine[ibest][1], shift_min, shift_max)
+
+    # Refine the shift around the interpolated peak
+    result = scipy.optimize.minimize_scalar(lambda shift: zerolag_shift_stretch((shift, stretch), y1, y2),
+                                            bounds=(max(lag - 1.0, shift_min), min(lag + 1.0, shift_max)),
+                                            method='bounded', options={'xatol': 1e-3})
+    success = result.success and np.isfinite(result.fun)
+    if not success:
+        msgs.warn('Fit for shift and stretch did not converge!')
+
+    if debug:
+        x1 = np.arange(nspec)
+        inspec2_trans = shift_and_stretch(inspec2, result.x, stretch)
+        plt.plot(x1,inspec1, 'k-', drawstyle='steps', label ='inspec1')
+        plt.plot(x1,inspec2_trans, 'r-', drawstyle='steps', label = 'inspec2')
+        plt.title('shift= {:5.3f}'.format(result.x) +
+                  ',  stretch = {:7.5f}'.format(stretch) + ', corr = {:5.3f}'.format(-result.fun))
+        plt.legend()
+        plt.show()
+
+    return success, result.x, stretch, -result.fun, shift_cc, cc_val
+
 # There is a bug somewhere here, but I'm moving on because I don't need this routine.
 def fit_shift_stretch_iter(inspec1, inspec2, smooth = 5.0, shift_mnmx = (-1.0,1.0), stretch_mnmx = (0.8,1.2), debug = True):
 
@@ -233,7 +325,15 @@ smooth = 5.0
 
 y1 = scipy.ndimage.filters.gaussian_filter(inspec1, smooth)
 
+# Compare the grid search with the differential evolution fit
 for islit in range(nslits):
-    output = fit_shift_stretch(inspec1,spec[:,islit], debug = True)
+    t0 = time.perf_counter()
+    output_de = xcorr_shift_stretch(inspec1,spec[:,islit], debug = False)
+    t1 = time.perf_counter()
+    output = xcorr_shift_stretch_fft(inspec1,spec[:,islit], debug = False)
+    t2 = time.perf_counter()
     success[islit], shift[islit], stretch[islit], xcorr[islit], shift_cc[islit], xcorr_cc[islit] = output
+    print('slit {:d}: DE shift = {:7.3f}, stretch = {:7.5f}, corr = {:6.4f} in {:6.3f}s; '
+          'FFT shift = {:7.3f}, stretch = {:7.5f}, corr = {:6.4f} in {:6.3f}s'.format(
+          islit, output_de[1], output_de[2], output_de[3], t1 - t0, shift[islit], stretch[islit], xcorr[islit], t2 - t1))
 
@@ -60,6 +60,9 @@ class PypeItTest(ABC):
         self.pid = None
         """ int: The process id of the child process than ran the test"""
 
+        self.working_dir = None
+        """ str: The directory the child process was run in. Coverage data files are written here."""
+
         self.start_time = None
         """ :obj:`datetime.datetime`: The date and time the test started."""
 
@@ -111,7 +114,8 @@ class PypeItTest(ABC):
                         # (see deimos QL) use the first value as the start rather than overwriting it.
                         self.start_time = datetime.datetime.now()
                         
-                    child = subprocess.Popen(self.command_line, stdout=f, stderr=f, env=self.env, cwd=self.setup.rdxdir)
+                    self.working_dir = self.setup.rdxdir
+                    child = subprocess.Popen(self.command_line, stdout=f, stderr=f, env=self.env, cwd=self.working_dir)
                     self.pid = child.pid
                     child.wait()
                     self.end_time = datetime.datetime.now()
@@ -485,15 +489,17 @@ class PypeItQuickLookTest(PypeItTest):
     def run(self):
         """Generate any required quick look masters before running the quick look test"""
 
-        if self.setup.instr == 'keck_nires' or (self.setup.instr == 'keck_mosfire' and self.setup.name == 'Y_long') or \
-                (self.setup.instr == 'keck_lris_red_mark4' and self.setup.name == 'long_600_10000_d680'):
+        # Imported here to avoid a circular import with test_setups
+        from .test_setups import ql_masters_manifest
+
+        if self.setup.key in ql_masters_manifest:
             try:
 
                 # Build the masters with the output going to a log file
                 logfile = get_unique_file(os.path.join(self.setup.rdxdir, "build_ql_masters_output.log"))
                 with open(logfile, "w") as log:
                     result = subprocess.run([os.path.join(self.setup.dev_path, 'build_ql_masters'),
-                                             self.setup.instr, "-s", self.setup.name, '--output_dir', self.output_dir, '--redux_dir', self.redux_dir, '--force_copy'],
+                                             self.setup.instr, "-s", self.setup.name, '--output_dir', self.output_dir, '--redux_dir', self.redux_dir],
                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
                     print(result.stdout if isinstance(result.stdout, str) else result.stdout.decode(errors='replace'), file=log)
@@ -12,12 +12,15 @@ import sys
 import os
 import os.path
 import subprocess
-from queue import PriorityQueue, Empty
+from queue import PriorityQueue, Queue, Empty
 from threading import Thread, Lock
 import traceback
 import datetime
 from pathlib import Path
 import textwrap
+import importlib.util
+import re
+import sqlite3
 
 import numpy as np
 import pypeit 
@@ -108,6 +111,100 @@ class TestPriorityList(object):
             self.updated = False
 
 
+class TestTimingDatabase(object):
+    """A database of how long each test took to run, used to track test durations across runs.
+
+    The durations are stored in a SQLite database with two tables. The "runs" table has a row for each run of
+    pypeit_test, giving its start time and the PypeIt version tested. The "durations" table has a row for each
+    test phase run, giving the run, the test suite (the test setup for reductions, or the pytest test suite
+    description), the test, the phase (e.g. "setup", "call", or "teardown" for pytest tests) and its duration in
+    seconds.
+
+    Attributes:
+        run_id (int): The id of the current run in the "runs" table.
+
+        _file (str): The file name of the SQLite database.
+        _conn (:obj:`sqlite3.Connection`): The connection to the database.
+        _lock (:obj:`threading.Lock`): Lock used to serialize access to the database from multiple threads.
+    """
+
+    def __init__(self, file):
+        """Open or create the database and add a row for the current run."""
+        self._file = file
+        self._lock = Lock()
+        self._conn = sqlite3.connect(file, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "start_time TEXT, pypeit_version TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS durations (run_id INTEGER, suite TEXT, test TEXT, "
+                               "phase TEXT, duration REAL)")
+            cursor = self._conn.execute("INSERT INTO runs (start_time, pypeit_version) VALUES (?, ?)",
+                                        (datetime.datetime.now().isoformat(), pypeit.__version__))
+            self.run_id = cursor.lastrowid
+
+    def add_durations(self, suite, durations):
+        """Record test durations for the current run.
+
+        Args:
+            suite (str): The test suite or test setup the tests belong to.
+            durations (list of tuple): A list of (test, phase, duration in seconds) tuples.
+        """
+        with self._lock:
+            with self._conn:
+                self._conn.executemany("INSERT INTO durations VALUES (?, ?, ?, ?, ?)",
+                                       [(self.run_id, suite, test, phase, duration)
+                                        for (test, phase, duration) in durations])
+
+    def slowest_tests(self, num, suites):
+        """Return the slowest tests in the current run.
+
+        Args:
+            num (int): The number of tests to return.
+            suites (list of str): The test suites to include.
+
+        Returns:
+            list of tuple: A list of (suite, test, duration) tuples sorted from slowest to fastest. The duration
+            is the total of all of the test's phases.
+        """
+        if len(suites) == 0:
+            return []
+        with self._lock:
+            return self._conn.execute("SELECT suite, test, SUM(duration) AS total FROM durations "
+                                      f"WHERE run_id = ? AND suite IN ({','.join(['?'] * len(suites))}) "
+                                      "GROUP BY suite, test ORDER BY total DESC LIMIT ?",
+                                      [self.run_id] + list(suites) + [num]).fetchall()
+
+    def previous_durations(self, suite, test, num_runs=5):
+        """Return the durations of a test in previous runs.
+
+        Args:
+            suite (str): The test suite the test belongs to.
+            test (str): The test.
+            num_runs (int): The maximum number of previous runs to return.
+
+        Returns:
+            list of float: The total duration of the test in each previous run it was run in,
+            most recent first.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT SUM(duration) FROM durations "
+                                      "WHERE suite = ? AND test = ? AND run_id < ? "
+                                      "GROUP BY run_id ORDER BY run_id DESC LIMIT ?",
+                                      (suite, test, self.run_id, num_runs)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        """Close the connection to the database."""
+        with self._lock:
+            self._conn.close()
+
+
+_PYTEST_DURATION_RE = re.compile(r'^(\d+\.\d+)s (setup|call|teardown)\s+(\S+)$')
+"""Regular expression matching a line in the pytest --durations report"""
+
+_ANSI_ESCAPE_RE = re.compile(r'\x1B\[[0-9;]*m')
+"""Regular expression matching terminal color escape sequences"""
+
 class TestSetup(object):
     """Representation of a test setup within the pypeit development suite.
 
@@ -192,6 +289,12 @@ class TestReport(object):
     failed_tests (:obj:`list` of str):  List of names of tests that have failed
     skipped_tests (:obj:`list` of str): List of names of tests that have been skipped
 
+    pytest_results (:obj:`dict`):   Maps pytest test suite descriptions to the summary line of the pytest run.
+    pytest_durations (:obj:`dict`): Maps pytest test suite descriptions to a list of (test, phase, duration)
+                                    tuples parsed from the pytest durations report.
+    timing_db (:obj:`TestTimingDatabase`): Database the test durations are recorded in. None if the
+                                           durations aren't being recorded.
+
     testing_complete (bool): Whether testing has completed.
     lock (:obj:`threading.Lock`): Lock used to synchronize access when multiple threads are reporting status. This
                                   prevents scrambled output being sent to stdout.
@@ -213,6 +316,10 @@ class TestReport(object):
         self.start_time = datetime.datetime.now()
 
         self.pytest_results=dict()
+        self.pytest_durations=dict()
+
+        timing_db = getattr(pargs, 'timing_db', None)
+        self.timing_db = TestTimingDatabase(timing_db) if timing_db is not None else None
 
         if pargs.report is not None and os.path.exists(pargs.report):
             # Remove any old report files if we've been asked to overwrite it
@@ -283,6 +390,10 @@ class TestReport(object):
                 self.num_failed += 1
                 self.failed_tests.append(test)
 
+            if self.timing_db is not None and test.start_time is not None and test.end_time is not None:
+                self.timing_db.add_durations(str(test.setup), [(test.description, 'run',
+                                                               (test.end_time - test.start_time).total_seconds())])
+
             if not self.pargs.quiet:
                 verbose_info = ''
                 if self.pargs.verbose:
@@ -351,10 +462,29 @@ class TestReport(object):
             with open(self.pargs.report, "a") as report_file:
                 print(line, file=report_file)
         
+        # Save the test durations
+        match = _PYTEST_DURATION_RE.match(_ANSI_ESCAPE_RE.sub('', line))
+        if match is not None:
+            self.pytest_durations.setdefault(test_descr, []).append((match.group(3), match.group(2),
+                                                                     float(match.group(1))))
+            return
+
         # Save any summary lines found for reporting later.
         if "warnings" in line or "passed" in line or "failed" in line:
             self.pytest_results[test_descr] = line.replace("=", "")
 
+    def pytest_completed(self, test_descr):
+        """Called when a set of pytest tests have completed. Records the test durations.
+
+        Args:
+            test_descr (str): A short description of the pytest test suite that
+                              will be displayed in the test report and uniquely
+                              identify the test suite. For example:
+                              "Unit Tests".
+        """
+        if self.timing_db is not None and test_descr in self.pytest_durations:
+            self.timing_db.add_durations(test_descr, self.pytest_durations[test_descr])
+
 
     def detailed_report(self, output=sys.stdout):
         """Display a detailed report on testing to the given output stream"""
@@ -412,6 +542,26 @@ class TestReport(object):
             print("\x1B[" + "1;32m" + f"--- PYTEST {test_descr.upper()} PASSED " + "\x1B[" + "0m"
                   + results +  "\x1B[" + "1;32m" + "---" + "\x1B[" + "0m" + "\r", file=output)
 
+    def summarize_slowest_pytest_tests(self, output=sys.stdout):
+        """Display the slowest pytest tests, compared with their durations in previous runs."""
+        if self.timing_db is None or self.pargs.slowest <= 0:
+            return
+
+        slowest = self.timing_db.slowest_tests(self.pargs.slowest, list(self.pytest_durations.keys()))
+        if len(slowest) == 0:
+            return
+
+        print(f"Slowest {len(slowest)} pytest tests:", file=output)
+        for (suite, test, duration) in slowest:
+            previous = self.timing_db.previous_durations(suite, test)
+            if len(previous) > 0:
+                average = np.mean(previous)
+                change = f'{100.0 * (duration - average) / average:+.0f}%' if average > 0 else 'n/a'
+                trend = f'(average of last {len(previous)} runs {average:.2f}s, {change})'
+            else:
+                trend = '(no previous runs)'
+            print(f'    {duration:9.2f}s {suite}: {test} {trend}', file=output)
+
     def print_tail(self, file, num_lines, output=sys.stdout, flush=False):
         """Print the last num_lines of a file."""
         result = subprocess.run(['tail', f'-{num_lines}', file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -425,6 +575,7 @@ class TestReport(object):
         self.summarize_pytest_results("PypeIt Unit Tests", output)
         self.summarize_pytest_results("Unit Tests", output)
         self.summarize_pytest_results("Vet Tests", output)
+        self.summarize_slowest_pytest_tests(output)
         self.summarize_setup_tests(output)
 
         if self.pargs.coverage is not None:
@@ -496,7 +647,93 @@ def clear_coverage_data(redux_out):
     for file in path.rglob(".coverage*"):
         file.unlink(missing_ok = True)
 
-def run_pytest(pargs, test_descr, test_dir, test_report, redux_out=None):
+class CoverageCombiner(object):
+    """Combines coverage data into a single coverage database as tests complete.
+
+    When running with coverage, each child process writes a ``.coverage.*`` data file into the directory
+    it was run from. Rather than combining all of these at the end of testing, directories are passed to
+    this class as tests complete and a background thread folds any data files in them into the
+    ``.coverage`` database in the output directory. This keeps the final report fast, and leaves a usable
+    partial coverage database behind if testing is interrupted.
+
+    Attributes:
+        pargs (:obj:`argparse.Namespace`): The arguments to pypeit_test, as returned by argparse.
+        directories (set of str): The directories that have been searched for coverage data.
+        num_combined (int): The number of coverage data files combined so far.
+        errors (:obj:`list` of str): The output of any failed ``coverage combine`` commands.
+    """
+
+    def __init__(self, pargs):
+        self.pargs = pargs
+        self.directories = set()
+        self.num_combined = 0
+        self.errors = []
+        self._queue = Queue()
+        # This is a daemon thread so that an early exit from main() doesn't hang waiting for it.
+        # The combined database is updated atomically by coverage, so it stays usable.
+        self._thread = Thread(target=self._combine_target, daemon=True)
+        self._thread.start()
+
+    def add_directory(self, directory):
+        """Queue a directory to have its coverage data files combined.
+
+        Args:
+            directory (str): A directory that a test or pytest run was run from.
+        """
+        if directory is not None:
+            self._queue.put(directory)
+
+    def stop(self):
+        """Combine any remaining coverage data and stop the background thread.
+
+        Every directory seen is checked one last time, in case a data file was written after the
+        directory was queued.
+        """
+        for directory in list(self.directories):
+            self._queue.put(directory)
+        self._queue.put(None)
+        self._thread.join()
+
+    def _combine_target(self):
+        """Thread target method for combining coverage data."""
+        while True:
+            directory = self._queue.get()
+            if directory is None:
+                break
+            self.directories.add(directory)
+            try:
+                # Subprocesses may write their data files into subdirectories, as found by clear_coverage_data
+                self.combine([str(path) for path in Path(directory).rglob(".coverage.*")])
+            except Exception:
+                self.errors.append(traceback.format_exc())
+
+    def combine(self, coverage_files):
+        """Append coverage data files to the combined coverage database.
+
+        The data files are removed by ``coverage combine`` once they have been combined.
+
+        Args:
+            coverage_files (list of str): The coverage data files to combine.
+
+        Returns:
+            bool: True if the files were combined, False if the combine failed.
+        """
+        if len(coverage_files) == 0:
+            return True
+
+        # Run from the output dir to keep the combined coverage database there
+        process = subprocess.run(["coverage", "combine", "--append"] + coverage_files,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=self.pargs.outputdir)
+        if process.returncode != 0:
+            output = process.stdout.decode(errors='replace') if isinstance(process.stdout, bytes) else str(process.stdout)
+            self.errors.append(output)
+            return False
+
+        self.num_combined += len(coverage_files)
+        return True
+
+
+def run_pytest(pargs, test_descr, test_dir, test_report, redux_out=None, coverage_combiner=None, parallel=False):
     """Run pytest on a directory of test files.
     
     Args:
@@ -517,22 +754,34 @@ def run_pytest(pargs, test_descr, test_dir, test_report, redux_out=None):
         redux_out (str):
             The location of the output of this dev-suite run. Optional, only required
             if the pytest suite requires the output from the dev-suite (i.e vet_tests).
+
+        coverage_combiner (:obj:`CoverageCombiner`):
+            Used to combine the coverage data from the pytest run. Optional, only required
+            when collecting coverage data.
+
+        parallel (bool):
+            Whether the tests support running in parallel with pytest-xdist. If True, and
+            pytest-xdist is installed, the tests are run in ``pargs.threads`` processes,
+            with tests in the same xdist group (see unit_tests/conftest.py) run in the same process.
+            Coverage runs are always serial.
     """
     abs_test_dir = os.path.abspath(test_dir)
 
     test_report.pytest_started(test_descr)
 
-    # Tests not written to run in parallel yet
-    #args = ["pytest", "-v", "--color=yes", "-n", str(pargs.threads)]
-
     # Run pytest using coverage if requested
     if pargs.coverage is not None:
         args = ["coverage", "run"] + _COVERAGE_ARGS + ["-m", "pytest", "-v", "--color=yes"]
     else:
         args = ["pytest", "-v", "--color=yes"]
+        if parallel and pargs.threads > 1 and importlib.util.find_spec("xdist") is not None:
+            args += ["-n", str(pargs.threads), "--dist", "loadgroup"]
 
     if not pargs.show_warnings:
         args.append("--disable-warnings")
+
+    # Report the duration of every test phase so they can be recorded
+    args += ["--durations=0", "--durations-min=0"]
     
     if redux_out is not None:
         args += ["--redux_out", redux_out]
@@ -544,29 +793,42 @@ def run_pytest(pargs, test_descr, test_dir, test_report, redux_out=None):
     with subprocess.Popen(args,stderr=subprocess.STDOUT, stdout=subprocess.PIPE,cwd=pargs.outputdir) as p:
         while(p.poll() is None):
             test_report.pytest_line(test_descr, p.stdout.readline().decode().strip())
+        # pytest may exit with output still in the pipe, such as the durations report and the summary
+        for line in p.stdout:
+            test_report.pytest_line(test_descr, line.decode().strip())
 
-def generate_coverage_report(pargs):
+    test_report.pytest_completed(test_descr)
 
-    # Find the coverage files
-    coverage_files = [str(path) for path in Path(pargs.outputdir).rglob(".coverage.*")]
-    
-    if len(coverage_files) > 0:
-        if not pargs.quiet:
-            print("Combining coverage files...", flush=True)
-    else:
-        with open(pargs.coverage, "w") as f:
-            print("Couldn't find coverage files to combine.", file=f)
-        return
+    if coverage_combiner is not None:
+        coverage_combiner.add_directory(pargs.outputdir)
+
+def generate_coverage_report(pargs, coverage_combiner):
+    """Generate the coverage report from the combined coverage data.
+
+    Args:
+        pargs (:obj:`argparse.Namespace`): The arguments to pypeit_test, as returned by argparse.
 
-    # Combine them, changing to the output dir to keep the coverage 
-    # data files there
-    process = subprocess.run(["coverage", "combine"] + coverage_files, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=pargs.outputdir)
-    if process.returncode != 0:
+        coverage_combiner (:obj:`CoverageCombiner`):
+            The object that has been combining coverage data as tests completed.
+    """
+
+    # Finish combining any outstanding coverage data
+    if not pargs.quiet:
+        print("Combining remaining coverage files...", flush=True)
+    coverage_combiner.stop()
+
+    if len(coverage_combiner.errors) > 0:
         if not pargs.quiet:
             print("Failed to combine coverage data.", flush=True)
         with open(pargs.coverage, "w") as f:
             print("Failed to combine coverage files. Output:", file=f)
-            print(process.stdout, file=f)
+            for error in coverage_combiner.errors:
+                print(error, file=f)
+        return
+
+    if coverage_combiner.num_combined == 0:
+        with open(pargs.coverage, "w") as f:
+            print("Couldn't find coverage files to combine.", file=f)
         return
 
     # Generate the report.
@@ -636,6 +898,11 @@ def parser(options=None):
                         help='Write a detailed test report to REPORT.')
     parser.add_argument('-w', '--show_warnings', default=False, action='store_true',
                         help='Show warnings when running unit tests and vet tests.')
+    parser.add_argument('--timing_db', default=None, type=str,
+                        help='SQLite database to record test durations in, so they can be compared across runs. '
+                             'Defaults to test_timings.db in the output directory.')
+    parser.add_argument('--slowest', default=10, type=int,
+                        help='Number of the slowest unit and vet tests to show in the test summary.')
     return parser.parse_args() if options is None else parser.parse_args(options)
 
 def show_setup_list():
@@ -651,7 +918,7 @@ def show_setup_list():
                                   subsequent_indent="    ", break_long_words=False):
             print(line)
 
-def thread_target(test_report):
+def thread_target(test_report, coverage_combiner=None):
     """Thread target method for running tests."""
     while not test_report.testing_complete:
         try:
@@ -669,6 +936,8 @@ def thread_target(test_report):
                 test_report.test_started(test)
                 passed = test.run()
                 test_report.test_completed(test)
+                if coverage_combiner is not None:
+                    coverage_combiner.add_directory(test.working_dir)
 
         test_report.test_setup_completed(test_setup)
 
@@ -677,6 +946,53 @@ def thread_target(test_report):
         test_run_queue.task_done()
 
 
+def run_test_setups(setups, test_report, threads, coverage_combiner=None):
+    """Run the tests in a list of test setups using a pool of threads.
+
+    Each test setup is placed on the test_run_queue according to its priority, and the tests
+    within a setup are run sequentially by whichever thread picks it up. This is used both by
+    the dev suite itself and by scripts that need to run dev suite tests, such as build_ql_masters.
+
+    Args:
+        setups (list of :obj:`TestSetup`):
+            The test setups to run.
+        test_report (:obj:`TestReport`):
+            The test report used to track the status of testing. It is marked as complete
+            once all test setups have finished.
+        threads (int):
+            The number of test setups to run in parallel.
+        coverage_combiner (:obj:`CoverageCombiner`):
+            Used to combine the coverage data of each test as it completes. Optional, only
+            required when collecting coverage data.
+    """
+    test_report.setup_testing_started(setups)
+    # Add tests to the test_run_queue
+    for setup in setups:
+        if len(setup.tests) == 0:
+            continue
+        test_run_queue.put(setup)
+
+    # Start threads to run the tests
+    if not test_report.pargs.quiet and threads > 1:
+        print(f'Running tests in {threads} parallel processes')
+
+    thread_pool = []
+    for i in range(threads):
+        new_thread = Thread(target=thread_target, args=[test_report, coverage_combiner])
+        thread_pool.append(new_thread)
+        new_thread.start()
+
+    # Wait for the tests to finish
+    test_run_queue.join()
+
+    # Set the test status to complete and then wait for the threads to finish.
+    # We don't run the threads as daemon threads so that main() can be called multiple times
+    # in unit tests
+    test_report.testing_complete = True
+    for thread in thread_pool:
+        thread.join()
+
+
 def main():
 
     # ---------------------------------------------------------------------------
@@ -703,6 +1019,9 @@ def main():
         os.mkdir(pargs.outputdir)
     pargs.outputdir = os.path.abspath(pargs.outputdir)
 
+    if pargs.timing_db is None:
+        pargs.timing_db = os.path.join(pargs.outputdir, 'test_timings.db')
+
     # Make sure we can create a writable report file (if needed) before starting the tests
     if pargs.report is None and pargs.quiet:
         # If there's no report file specified in the command line, but we're in quiet mode,
@@ -811,8 +1130,10 @@ def main():
 
     # Clean up prior coverage results that could be left over from an
     # interrupted dev suite run
+    coverage_combiner = None
     if pargs.coverage is not None:
         clear_coverage_data(pargs.outputdir)
+        coverage_combiner = CoverageCombiner(pargs)
  
     # Start Unit Tests
     test_report = TestReport(pargs)
@@ -820,11 +1141,13 @@ def main():
     # For coverage testing, run the PypeIt unit tests too
     if flg_pypeit_tests and not pargs.prep_only:
         pypeit_tests_dir = Path(pypeit.__file__).parent.joinpath("tests")
-        run_pytest(pargs, "PypeIt Unit Tests", str(pypeit_tests_dir), test_report)
+        run_pytest(pargs, "PypeIt Unit Tests", str(pypeit_tests_dir), test_report,
+                   coverage_combiner=coverage_combiner)
 
     dev_path = os.getenv('PYPEIT_DEV')
     if flg_unit is True and not pargs.prep_only:
-        run_pytest(pargs, "Unit Tests", os.path.join(dev_path, "unit_tests"), test_report)
+        run_pytest(pargs, "Unit Tests", os.path.join(dev_path, "unit_tests"), test_report,
+                   coverage_combiner=coverage_combiner, parallel=True)
 
 
     if flg_reduce or flg_after or flg_ql:
@@ -889,39 +1212,15 @@ def main():
 
         # ---------------------------------------------------------------------------
         # Run the tests
-        test_report.setup_testing_started(setups)
-        # Add tests to the test_run_queue
-        for setup in setups:
-            if len(setup.tests) == 0:
-                continue
-            test_run_queue.put(setup)
-
-        # Start threads to run the tests
-        if not pargs.quiet and pargs.threads > 1:
-            print(f'Running tests in {pargs.threads} parallel processes')
-
-        thread_pool = []
-        for i in range(pargs.threads):
-            new_thread = Thread(target=thread_target, args=[test_report])
-            thread_pool.append(new_thread)
-            new_thread.start()
-
-        # Wait for the tests to finish
-        test_run_queue.join()
-
-        # Set the test status to complete and then wait for the threads to finish.
-        # We don't run the threads as daemon threads so that main() can be called multiple times
-        # in unit tests
-        test_report.testing_complete = True
-        for thread in thread_pool:
-            thread.join()
+        run_test_setups(setups, test_report, pargs.threads, coverage_combiner)
 
         if not pargs.quiet:
             test_report.summarize_setup_tests()
 
     # Run the vet tests
     if flg_vet is True:
-        run_pytest(pargs, "Vet Tests", os.path.join(dev_path, "vet_tests"), test_report, redux_out=pargs.outputdir)
+        run_pytest(pargs, "Vet Tests", os.path.join(dev_path, "vet_tests"), test_report, redux_out=pargs.outputdir,
+                   coverage_combiner=coverage_combiner)
 
 
     # ---------------------------------------------------------------------------
@@ -934,7 +1233,7 @@ def main():
             print(f'Wrote {len(priority_list)} setup priorities')
 
     if pargs.coverage is not None:
-        generate_coverage_report(pargs)
+        generate_coverage_report(pargs, coverage_combiner)
 
     # ---------------------------------------------------------------------------
     # Finish up the report on the test results
@@ -946,6 +1245,9 @@ def main():
         else:
             test_report.summary_report()
 
+    if test_report.timing_db is not None:
+        test_report.timing_db.close()
+
     return test_report.num_failed
 
 
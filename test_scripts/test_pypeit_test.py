@@ -28,7 +28,8 @@ import pytest
 import subprocess
 import sys
 import os
-from io import BytesIO
+import sqlite3
+from io import BytesIO, StringIO
 import random
 from test_scripts import test_main
 from test_scripts.pypeit_tests import PypeItReduceTest
@@ -467,3 +468,135 @@ def test_quick_look_masters_env(monkeypatch, tmp_path):
         monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-i', 'keck_nires', 'reduce', 'ql'])
 
         assert test_main.main() == 0
+
+def load_build_ql_masters():
+    """
+    Load the build_ql_masters script as a module. It doesn't have a .py extension so it can't be
+    imported normally.
+    """
+    from importlib.machinery import SourceFileLoader
+    from importlib.util import spec_from_loader, module_from_spec
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'build_ql_masters')
+    loader = SourceFileLoader('build_ql_masters', script)
+    module = module_from_spec(spec_from_loader('build_ql_masters', loader))
+    loader.exec_module(module)
+    return module
+
+def test_build_ql_masters_copy(tmp_path):
+    """
+    Test that build_ql_masters finds the files in its manifest and only replaces destination files whose
+    contents have changed.
+    """
+    build_ql_masters = load_build_ql_masters()
+
+    redux_dir = tmp_path / 'REDUX_OUT'
+    nires_files = ['keck_nires/NIRES/Masters/MasterArc_A_2_DET01.fits',
+                   'keck_nires/NIRES/Masters/MasterTilts_A_2_DET01.fits',
+                   'keck_nires/NIRES/Masters/MasterFlat_A_7_DET01.fits']
+
+    # Missing the MasterSlits file
+    create_dummy_files(redux_dir, nires_files)
+    assert build_ql_masters.find_source_files(str(redux_dir), 'keck_nires/NIRES') is None
+
+    create_dummy_files(redux_dir, ['keck_nires/NIRES/Masters/MasterSlits_A_7_DET01.fits.gz'])
+    found_files = build_ql_masters.find_source_files(str(redux_dir), 'keck_nires/NIRES')
+    assert len(found_files) == 4
+
+    # Copy a file, and make sure an identical file isn't replaced
+    source = found_files[0]
+    dest = tmp_path / 'MasterArc_A_1_DET01.fits'
+    build_ql_masters.copy_me(source, str(dest), False, link=False)
+    assert build_ql_masters.is_up_to_date(source, str(dest))
+    first_stat = dest.stat()
+    build_ql_masters.copy_me(source, str(dest), False, link=False)
+    assert dest.stat().st_ino == first_stat.st_ino
+
+    # Change the source contents, this should be detected even if the size is the same
+    with open(source, 'w') as f:
+        print("dummy CONTENT", file=f)
+    assert not build_ql_masters.is_up_to_date(source, str(dest))
+
+    # Linking should replace the file with a link to the source
+    build_ql_masters.copy_me(source, str(dest), False, link=True)
+    assert build_ql_masters.is_up_to_date(source, str(dest))
+    assert os.path.samefile(source, str(dest))
+
+def test_coverage_combiner(monkeypatch, tmp_path):
+    """
+    Test that coverage data is combined as directories are added, and that failures are recorded.
+    """
+    commands = []
+    def mock_combine_run(args, **kwargs):
+        commands.append(args)
+        # Simulate coverage combine removing the files it combines
+        for file in args[3:]:
+            os.unlink(file)
+        return MockCompletedProcess()
+
+    with monkeypatch.context() as m:
+        monkeypatch.setattr(subprocess, "run", mock_combine_run)
+
+        pargs = test_main.parser(['-o', str(tmp_path), '--coverage', str(tmp_path / 'coverage.report'), 'reduce'])
+        combiner = test_main.CoverageCombiner(pargs)
+        create_dummy_files(tmp_path, ['setup1/.coverage.host.pid1.1', 'setup1/.coverage.host.pid2.1',
+                                      'setup2/.coverage.host.pid3.1', 'setup2/Science/.coverage.host.pid5.1'])
+        combiner.add_directory(str(tmp_path / 'setup1'))
+        combiner.add_directory(str(tmp_path / 'setup2'))
+        # Directories without data shouldn't run coverage
+        combiner.add_directory(str(tmp_path / 'setup3'))
+        combiner.add_directory(None)
+        combiner.stop()
+
+        assert combiner.num_combined == 4
+        assert len(commands) == 2
+        assert not (tmp_path / 'setup2' / 'Science' / '.coverage.host.pid5.1').exists()
+        assert all([command[:3] == ["coverage", "combine", "--append"] for command in commands])
+        assert len(combiner.errors) == 0
+
+    with monkeypatch.context() as m:
+        monkeypatch.setattr(subprocess, "run", mock_failed_run)
+
+        combiner = test_main.CoverageCombiner(pargs)
+        create_dummy_files(tmp_path, ['setup1/.coverage.host.pid4.1'])
+        combiner.add_directory(str(tmp_path / 'setup1'))
+        combiner.stop()
+        assert combiner.num_combined == 0
+        assert len(combiner.errors) > 0
+
+def test_timing_database(tmp_path):
+    """
+    Test that pytest durations are recorded and the slowest tests are compared with previous runs.
+    """
+    timing_db = str(tmp_path / 'timings.db')
+    pargs = test_main.parser(['-o', str(tmp_path), '--timing_db', timing_db, '--slowest', '2', 'unit'])
+
+    for call_duration in [10.0, 20.0]:
+        test_report = test_main.TestReport(pargs)
+        test_report.pytest_started("Unit Tests")
+        for line in [f"{call_duration:.2f}s call     unit_tests/test_scripts.py::test_collate_1d",
+                     "0.50s setup    unit_tests/test_scripts.py::test_collate_1d",
+                     "\x1b[1m2.00s call     unit_tests/test_slitmask.py::test_assign_maskinfo_add_missing\x1b[0m",
+                     "0.01s teardown unit_tests/test_wavecalib.py::test_user_redo",
+                     "=== 3 passed in 30.00s ==="]:
+            test_report.pytest_line("Unit Tests", line)
+        test_report.pytest_completed("Unit Tests")
+
+    assert test_report.pytest_results["Unit Tests"].strip() == "3 passed in 30.00s"
+    assert len(test_report.pytest_durations["Unit Tests"]) == 4
+
+    slowest = test_report.timing_db.slowest_tests(2, ["Unit Tests"])
+    assert [test for (suite, test, duration) in slowest] == ["unit_tests/test_scripts.py::test_collate_1d",
+                                                             "unit_tests/test_slitmask.py::test_assign_maskinfo_add_missing"]
+    assert slowest[0][2] == pytest.approx(20.5)
+    assert test_report.timing_db.previous_durations("Unit Tests", slowest[0][1]) == pytest.approx([10.5])
+
+    output = StringIO()
+    test_report.summarize_slowest_pytest_tests(output)
+    lines = output.getvalue().splitlines()
+    assert lines[0] == "Slowest 2 pytest tests:"
+    assert "test_collate_1d" in lines[1] and "+95%" in lines[1]
+    assert "test_assign_maskinfo_add_missing" in lines[2] and "+0%" in lines[2]
+
+    test_report.timing_db.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        test_report.timing_db.slowest_tests(2, ["Unit Tests"])
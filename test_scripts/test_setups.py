@@ -76,6 +76,21 @@ Attributes:
                             _quick_look:        Test setups that run quick look script. The actual script run is chosen
                                                 based on the instrument.
 
+    ql_masters_manifest:     The quick look masters built by build_ql_masters before running the quick look tests.
+                             A dict mapping 'instrument/setup' to a dict with the following keys:
+
+                             'sources': File patterns, relative to the dev suite output directory of the setup, for
+                             the files the quick look scripts need. Each pattern must match at least one file.
+
+                             'rename': Optional. (old, new) substring replacements applied to the base name of each
+                             file when it's placed in the destination directory.
+
+                             'dest_dir': Optional. The destination directory relative to the QL masters directory.
+                             If not given the spectrograph's get_ql_master_dir method is used on a spec2d file from
+                             the dev suite output.
+
+                             'single_match': Optional. If True, only the first file matching each pattern is used.
+
 """
 
 from . import pypeit_tests
@@ -229,6 +244,28 @@ _quick_look = {'shane_kast_blue/600_4310_d55':
                    {'files': ['r220127_00123.fits', 'r220127_00124.fits'],
                     '--spec_samp_fact': 2.0, '--spat_samp_fact': 2.0, '--flux': None}}
 
+ql_masters_manifest = {'keck_nires/NIRES':
+                            {'sources': ['Masters/*2_DET01*',
+                                         'Masters/MasterFlat_A_7_DET01.fits',
+                                         'Masters/MasterSlits_A_7_DET01.fits.gz'],
+                             'rename': [('_2_', '_1_'), ('_7_', '_1_')],
+                             'dest_dir': 'NIRES_MASTERS'},
+                       'keck_mosfire/Y_long':
+                            {'sources': ['Masters/MasterSlits_A_15_DET01.fits.gz',
+                                         'Masters/MasterTilts_A_4_DET01.fits',
+                                         'Masters/MasterWaveCalib_A_4_DET01.fits',
+                                         'Science/spec1d_m191118_0064-GD71_MOSFIRE_20191118T104704.507.fits',
+                                         'sens_m191118_0064-GD71_MOSFIRE_20191118T104704.507.fits']},
+                       'keck_lris_red_mark4/long_600_10000_d680':
+                            {'sources': ['Masters/MasterBias*',
+                                         'Masters/MasterSlits*',
+                                         'Masters/MasterTilts*',
+                                         'Masters/MasterWaveCalib*',
+                                         'Science/spec1d_*00127-GD153*.fits',
+                                         'sens_*.fits'],
+                             'single_match': True},
+                       }
+
 
 # The order of these tests in all_tests determine the order they run
 # in for the setup. So that tests that depend on previous tests must
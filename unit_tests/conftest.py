@@ -0,0 +1,196 @@
+# Local pytest plugin providing session-scoped, cached dev-suite data to the unit tests.
+#
+# Reading and processing the raw frames in $PYPEIT_DEV/RAW_DATA is the slowest part of
+# the unit tests, and several test modules use the same frames. The fixtures below load
+# each spectrograph, raw image and processed image once per session (i.e. once per worker
+# when running in parallel with pytest-xdist). Spectrographs and processed images are shared
+# between tests and their arrays are read-only; raw images are copied for each test because
+# most tests process them in place.
+#
+# Tests declare the RAW_DATA setups they read with the "raw_data" marker, e.g.
+#
+#     @pytest.mark.raw_data('shane_kast_blue', '600_4310_d55')
+#
+# When run with "pytest -n N --dist loadgroup", tests are grouped by the setup they declare,
+# so that all of the tests using a set of raw frames run in the same worker. With several
+# stacked raw_data markers, the one closest to the function (i.e. the last decorator) sets
+# the group.
+#
+# The workers share the working directory, so modules that write into it (e.g.
+# setup_files/ or output/) or chdir put all of their tests in the CWD_GROUP with
+#
+#     pytestmark = pytest.mark.xdist_group(CWD_GROUP)
+#
+# which runs them one after the other in a single worker. A test that is already in an
+# xdist group keeps it.
+
+import os
+import copy
+import glob
+from functools import lru_cache
+
+import numpy as np
+import pytest
+
+from pypeit.spectrographs.util import load_spectrograph
+from pypeit.images import rawimage
+from pypeit.images import buildimage
+from pypeit import flatfield
+
+
+# The xdist group of the tests that write into the working directory
+CWD_GROUP = 'cwd'
+
+
+def raw_data_path(instr, setup, *files):
+    """Return the path to a setup directory, or to files within it, in RAW_DATA."""
+    return os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', instr, setup, *files)
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "raw_data(instr, setup): A RAW_DATA setup used by the test. "
+                                       "Tests are grouped by setup when run in parallel.")
+    # Registered here as well in case pytest-xdist isn't installed
+    config.addinivalue_line("markers", "xdist_group(name): The pytest-xdist group to run the test in.")
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(config, items):
+    """Place each test in an xdist group based on the RAW_DATA setup it reads.
+
+    Tests without a raw_data marker are grouped by module. Tests that already are in an
+    xdist group, e.g. the CWD_GROUP, are left in it.
+    """
+    for item in items:
+        if item.get_closest_marker('xdist_group') is not None:
+            continue
+        marker = item.get_closest_marker('raw_data')
+        group = '/'.join(marker.args[:2]) if marker is not None else item.module.__name__
+        item.add_marker(pytest.mark.xdist_group(group))
+
+
+def read_only(obj):
+    """Mark all of the numpy arrays held by an object as read-only, and return the object."""
+    items = [obj[key] for key in obj.keys()] if hasattr(obj, 'keys') else vars(obj).values()
+    for value in items:
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+    return obj
+
+
+@lru_cache(maxsize=None)
+def cached_spectrograph(spec_name):
+    """Load a spectrograph once per session."""
+    return load_spectrograph(spec_name)
+
+
+@lru_cache(maxsize=None)
+def _cached_raw_image(spec_name, file, det):
+    return rawimage.RawImage(file, cached_spectrograph(spec_name), det)
+
+
+@pytest.fixture(scope='session')
+def spectrograph():
+    """
+    Function that returns a cached spectrograph object given its name. The objects are
+    shared by all tests, so they must not be modified.
+    """
+    return cached_spectrograph
+
+
+@pytest.fixture(scope='session')
+def raw_image():
+    """
+    Function that returns a copy of a cached :class:`~pypeit.images.rawimage.RawImage`
+    given the spectrograph name, raw file, and detector. The copy can be processed in place.
+    """
+    def _raw_image(spec_name, file, det=1):
+        img = _cached_raw_image(spec_name, file, det)
+        # Share the spectrograph rather than copying it
+        return copy.deepcopy(img, memo={id(img.spectrograph): img.spectrograph})
+    return _raw_image
+
+
+@pytest.fixture(scope='session')
+def kast_blue_bias_files():
+    kast_blue_files = sorted(glob.glob(raw_data_path('shane_kast_blue', '600_4310_d55', 'b1?.fits*')))
+    # Trim to bias
+    return kast_blue_files[5:]
+
+
+@pytest.fixture(scope='session')
+def kast_blue_arc_file():
+    return glob.glob(raw_data_path('shane_kast_blue', '600_4310_d55', 'b1.fits*'))
+
+
+@pytest.fixture(scope='session')
+def deimos_flat_files():
+    # Longslit in dets 3,7
+    return [raw_data_path('keck_deimos', '830G_L_8400', ifile)
+                for ifile in ['d0914_0014.fits.gz', 'd0914_0015.fits.gz']]
+
+
+@pytest.fixture(scope='session')
+def gmos_north_bias_files():
+    return sorted(glob.glob(raw_data_path('gemini_gmos', 'GN_HAM_R400_885', 'N20190205S024*.fits')))
+
+
+@pytest.fixture(scope='session')
+def nires_sci_files():
+    return [raw_data_path('keck_nires', 'NIRES', ifile)
+                for ifile in ['s180604_0089.fits.gz', 's180604_0092.fits.gz']]
+
+
+@pytest.fixture(scope='session')
+def nires_bg_files():
+    return [raw_data_path('keck_nires', 'NIRES', ifile)
+                for ifile in ['s180604_0090.fits.gz', 's180604_0091.fits.gz']]
+
+
+@pytest.fixture(scope='session')
+def kast_blue_bias(kast_blue_bias_files):
+    """Read-only processed bias image for shane_kast_blue/600_4310_d55."""
+    spec = cached_spectrograph('shane_kast_blue')
+    frame_par = spec.default_pypeit_par()['calibrations']['biasframe']
+    return read_only(buildimage.buildimage_fromlist(spec, 1, frame_par, kast_blue_bias_files))
+
+
+@pytest.fixture(scope='session')
+def gmos_north_bias_mosaic(gmos_north_bias_files):
+    """Read-only processed bias mosaic of all three detectors for gemini_gmos/GN_HAM_R400_885."""
+    spec = cached_spectrograph('gemini_gmos_north_ham')
+    frame_par = spec.default_pypeit_par()['calibrations']['biasframe']
+    return read_only(buildimage.buildimage_fromlist(spec, (1,2,3), frame_par, gmos_north_bias_files))
+
+
+def _nires_science_par():
+    par = cached_spectrograph('keck_nires').default_pypeit_par()
+    par['scienceframe']['process']['use_illumflat'] = False
+    par['scienceframe']['process']['use_specillum'] = False
+    return par
+
+
+def _build_nires_image(files):
+    bpm = np.zeros((2048,1024), dtype=int)
+    flatImages = flatfield.FlatImages(pixelflat_norm=np.ones(bpm.shape, dtype=float))
+    return buildimage.buildimage_fromlist(cached_spectrograph('keck_nires'), 1,
+                                          _nires_science_par()['scienceframe'], files, bias=None,
+                                          bpm=bpm, flatimages=flatImages)
+
+
+@pytest.fixture(scope='session')
+def nires_science_par():
+    """keck_nires parameters used to process the cached NIRES science images."""
+    return _nires_science_par()
+
+
+@pytest.fixture(scope='session')
+def nires_sci_image(nires_sci_files):
+    """Read-only processed keck_nires/NIRES science image."""
+    return read_only(_build_nires_image(nires_sci_files))
+
+
+@pytest.fixture(scope='session')
+def nires_bg_image(nires_bg_files):
+    """Read-only processed keck_nires/NIRES background image."""
+    return read_only(_build_nires_image(nires_bg_files))
@@ -5,14 +5,12 @@ Requires files in Development suite and an Environmental variable
 import os
 
 import pytest
-import glob
 import shutil
 
 import numpy as np
 
 from pypeit import calibrations
 from pypeit.par import pypeitpar
-from pypeit.spectrographs.util import load_spectrograph
 from pypeit import wavecalib
 from IPython import embed
 
@@ -45,14 +43,14 @@ def fitstbl():
 
 
 @pytest.fixture
-def multi_caliBrate(fitstbl):
+def multi_caliBrate(fitstbl, spectrograph):
     # Grab a science file for configuration specific parameters
     for idx, row in enumerate(fitstbl):
         if 'science' in row['frametype']:
             sci_file = os.path.join(row['directory'], row['filename'])
             break
     # Par
-    spectrograph = load_spectrograph('shane_kast_blue')
+    spectrograph = spectrograph('shane_kast_blue')
     par = spectrograph.config_specific_par(sci_file)
     turn_off = dict(use_biasimage=False)
     par.reset_all_processimages_par(**turn_off)
@@ -80,6 +78,7 @@ def reset_calib(calib):
 # TESTS BEGIN HERE
 
 
+@pytest.mark.raw_data('shane_kast_blue', '600_4310_d55')
 def test_it_all(multi_caliBrate):
     # Setup
     multi_caliBrate.shape = (2048,350)
@@ -115,7 +114,8 @@ def test_it_all(multi_caliBrate):
     mswave = wv_calib.build_waveimg(tilts, slits)
     assert mswave.shape == (2048,350)
 
-def test_reuse(multi_caliBrate, fitstbl):
+@pytest.mark.raw_data('shane_kast_blue', '600_4310_d55')
+def test_reuse(multi_caliBrate, fitstbl, spectrograph):
     """
     Test that Calibrations appropriately reuses existing calibrations frames.
     """
@@ -159,7 +159,7 @@ def test_reuse(multi_caliBrate, fitstbl):
 
     # Reset
     #reset_calib(multi_caliBrate_reuse)
-    spectrograph = load_spectrograph('shane_kast_blue')
+    spectrograph = spectrograph('shane_kast_blue')
     par = spectrograph.default_pypeit_par()
     multi_caliBrate_reuse = calibrations.MultiSlitCalibrations(fitstbl, par['calibrations'],
                                                                spectrograph, data_path('Masters'))
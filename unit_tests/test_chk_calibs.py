@@ -15,8 +15,12 @@ matplotlib.use('agg')  # For Travis
 from pypeit.scripts.chk_for_calibs import ChkForCalibs
 from pypeit.tests.tstutils import data_path
 
-def test_chk_calibs_not():
-    os.chdir(data_path(''))
+# Writes into (or changes) the working directory, which the pytest-xdist workers share
+pytestmark = pytest.mark.xdist_group('cwd')
+
+
+def test_chk_calibs_not(monkeypatch):
+    monkeypatch.chdir(data_path(''))
     droot = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA/not_alfosc/grism4')
     droot += '/ALD'
 
@@ -26,8 +30,8 @@ def test_chk_calibs_not():
     assert answers['pass'][0], 'One or more failures!'
 
 
-def test_chk_calibs_deimos():
-    os.chdir(data_path(''))
+def test_chk_calibs_deimos(monkeypatch):
+    monkeypatch.chdir(data_path(''))
     # 830G
     droot = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA/keck_deimos/830G_M_8600/')
     pargs = ChkForCalibs.parse_args([droot, '-s', 'keck_deimos'])
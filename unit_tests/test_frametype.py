@@ -12,6 +12,10 @@ import pytest
 from pypeit.pypeitsetup import PypeItSetup
 from pypeit.inputfiles import PypeItFile
 
+# Writes into (or changes) the working directory, which the pytest-xdist workers share
+pytestmark = pytest.mark.xdist_group('cwd')
+
+
 def test_deimos():
     # Raw DEIMOS directory
     raw_dir = os.path.join(os.getenv('PYPEIT_DEV'), 
@@ -6,75 +6,76 @@ import os
 
 import pytest
 
-from pypeit.images.rawimage import RawImage
 from pypeit.par import pypeitpar
-from pypeit.spectrographs.util import load_spectrograph
 
 par = pypeitpar.ProcessImagesPar()
 
 
-def grab_img(specstr, rawfile, det=1):
-    spec = load_spectrograph(specstr)
-    rawImage = RawImage(rawfile, spec, det)
-    return rawImage
-
-
-def test_load_deimos():
+@pytest.mark.raw_data('keck_deimos', '830G_L_8400')
+def test_load_deimos(raw_image):
     ifile = os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 'keck_deimos', '830G_L_8400',
                          'd0914_0014.fits.gz')
     try:
         # First amplifier
-        data_img = grab_img('keck_deimos', ifile)
+        data_img = raw_image('keck_deimos', ifile)
     except:
         pytest.fail('DEIMOS test data section failed.')
 
-def test_load_lris():
+@pytest.mark.raw_data('keck_lris_blue', 'long_400_3400_d560')
+def test_load_lris(raw_image):
     ifile = os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 'keck_lris_blue',
                          'long_400_3400_d560', 'LB.20160109.14149.fits.gz')
     try:
         # First amplifier
-        data_img = grab_img('keck_lris_blue', ifile)
+        data_img = raw_image('keck_lris_blue', ifile)
     except:
         pytest.fail('LRIS test data section failed.')
 
-def test_load_nires():
+@pytest.mark.raw_data('keck_nires', 'NIRES')
+def test_load_nires(raw_image):
     ifile = os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 'keck_nires', 'NIRES',
                          's180604_0004.fits.gz')
     try:
         # First amplifier
-        data_img = grab_img('keck_nires', ifile)
+        data_img = raw_image('keck_nires', ifile)
     except:
         pytest.fail('NIRES test data section failed.')
 
-def test_load_nirspec():
+@pytest.mark.raw_data('keck_nirspec', 'LOW_NIRSPEC-1')
+def test_load_nirspec(raw_image):
     ifile = os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 'keck_nirspec', 'LOW_NIRSPEC-1',
                          'NS.20160414.02604.fits.gz')
     try:
         # First amplifier
-        data_img = grab_img('keck_nirspec_low', ifile)
+        data_img = raw_image('keck_nirspec_low', ifile)
     except:
         pytest.fail('NIRSPEC test data section failed.')
 
-def test_load_kast():
+@pytest.mark.raw_data('shane_kast_blue', '600_4310_d55')
+def test_load_kast(raw_image):
     ifile = os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 'shane_kast_blue', '600_4310_d55',
                          'b1.fits.gz')
     try:
         # First amplifier
-        data_img = grab_img('shane_kast_blue', ifile)
+        data_img = raw_image('shane_kast_blue', ifile)
     except:
         pytest.fail('Shane Kast test data section failed.')
 
 
-def test_load_vlt_xshooter_uvb():
+@pytest.mark.raw_data('vlt_xshooter', 'UVB_1x1')
+def test_load_vlt_xshooter_uvb(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','vlt_xshooter',
                          'UVB_1x1','XSHOO.2010-04-28T05:34:32.723.fits.gz')
     try:
-        data_img = grab_img('vlt_xshooter_uvb', ifile)
+        data_img = raw_image('vlt_xshooter_uvb', ifile)
     except:
         pytest.fail('VLT XSHOOTER UVB test data section failed: {0}'.format(ifile))
 
 
-def test_load_vlt_xshooter_vis():
+@pytest.mark.raw_data('vlt_xshooter', 'VIS_1x1')
+@pytest.mark.raw_data('vlt_xshooter', 'VIS_2x1')
+@pytest.mark.raw_data('vlt_xshooter', 'VIS_2x2')
+def test_load_vlt_xshooter_vis(raw_image):
 
     root = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','vlt_xshooter')
     files = [ os.path.join(root, 'VIS_1x1','XSHOO.2010-04-28T05:34:37.853.fits.gz'),
@@ -83,88 +84,98 @@ def test_load_vlt_xshooter_vis():
 
     for f in files:
         try:
-            data_img = grab_img('vlt_xshooter_vis', f)
+            data_img = raw_image('vlt_xshooter_vis', f)
         except:
             pytest.fail('VLT XSHOOTER VIS test data section failed: {0}'.format(f))
 
-def test_load_vlt_xshooter_nir():
+@pytest.mark.raw_data('vlt_xshooter', 'NIR')
+def test_load_vlt_xshooter_nir(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','vlt_xshooter',
                          'NIR','XSHOO.2016-08-02T08:45:49.494.fits.gz')
     try:
-        data_img = grab_img('vlt_xshooter_nir', ifile)
+        data_img = raw_image('vlt_xshooter_nir', ifile)
     except:
         pytest.fail('VLT XSHOOTER NIR test data section failed: {0}'.format(ifile))
 
-def test_load_gnirs():
+@pytest.mark.raw_data('gemini_gnirs', '32_SB_SXD')
+def test_load_gnirs(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','gemini_gnirs','32_SB_SXD',
                          'cN20170331S0206.fits')
     try:
-        data_img = grab_img('gemini_gnirs', ifile)
+        data_img = raw_image('gemini_gnirs', ifile)
     except:
         pytest.fail('Gemini GNIRS test data section failed: {0}'.format(ifile))
 
-def test_load_mage():
+@pytest.mark.raw_data('magellan_mage', '1x1')
+def test_load_mage(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','magellan_mage','1x1',
                          'mage0050.fits')
     try:
-        data_img = grab_img('magellan_mage', ifile)
+        data_img = raw_image('magellan_mage', ifile)
     except:
         pytest.fail('Magellan MAGE test data section failed: {0}'.format(ifile))
 
-def test_load_gmos():
+@pytest.mark.raw_data('gemini_gmos', 'GS_HAM_R400_700')
+def test_load_gmos(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','gemini_gmos','GS_HAM_R400_700',
                          'S20181005S0086.fits.gz')
     try:
-        data_img = grab_img('gemini_gmos_south_ham', ifile)
+        data_img = raw_image('gemini_gmos_south_ham', ifile)
     except:
         pytest.fail('Gemini GMOS test data section failed: {0}'.format(ifile))
 
-def test_load_osiris():
+@pytest.mark.raw_data('gtc_osiris', 'R2500R')
+def test_load_osiris(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','gtc_osiris','R2500R',
                          '0002851159-20210217-OSIRIS-OsirisBias.fits')
     try:
-        data_img = grab_img('gtc_osiris', ifile)
+        data_img = raw_image('gtc_osiris', ifile)
     except:
         pytest.fail('GTC OSIRIS test data section failed: {0}'.format(ifile))
 
-def test_load_bok():
+@pytest.mark.raw_data('bok_bc', '600')
+def test_load_bok(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','bok_bc','600',
                          'g0005.fits')
     try:
-        data_img = grab_img('bok_bc', ifile)
+        data_img = raw_image('bok_bc', ifile)
     except:
         pytest.fail('Bok BC test data section failed: {0}'.format(ifile))
 
-def test_load_efosc2():
+@pytest.mark.raw_data('ntt_efosc2', 'gr6')
+def test_load_efosc2(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','ntt_efosc2','gr6',
                          'EFOSC.2020-02-12T02:03:38.359.fits')
     try:
-        data_img = grab_img('ntt_efosc2', ifile)
+        data_img = raw_image('ntt_efosc2', ifile)
     except:
         pytest.fail('NTT/EFOSC2 test data section failed: {0}'.format(ifile))
 
-def test_load_goodman():
+@pytest.mark.raw_data('soar_goodman_red', 'M2')
+def test_load_goodman(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','soar_goodman_red','M2',
                          '0320_FRB210320_host_05-04-2021.fits.fz')
     try:
-        data_img = grab_img('soar_goodman_red', ifile)
+        data_img = raw_image('soar_goodman_red', ifile)
     except:
         pytest.fail('Bok BC test data section failed: {0}'.format(ifile))
 
-def test_load_deveny():
+@pytest.mark.raw_data('ldt_deveny', 'DV2')
+def test_load_deveny(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA','ldt_deveny','DV2',
                          '20210522.0001.fits')
     try:
-        data_img = grab_img('ldt_deveny', ifile)
+        data_img = raw_image('ldt_deveny', ifile)
     except:
         pytest.fail('LDT DeVeny test data section failed: {0}'.format(ifile))
 
-def test_load_fire():
+@pytest.mark.raw_data('magellan_fire', 'FIRE')
+def test_load_fire(raw_image):
     ifile = os.path.join(os.environ['PYPEIT_DEV'], 
                          'RAW_DATA', 'magellan_fire', 'FIRE',
                          'fire_0029.fits.gz')
     try:
-        data_img = grab_img('magellan_fire', ifile)
+        data_img = raw_image('magellan_fire', ifile)
     except:
         pytest.fail('Magellan/FIRE test data section failed: {0}'.format(ifile))
 
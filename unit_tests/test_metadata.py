@@ -14,6 +14,9 @@ from pypeit.metadata import PypeItMetaData
 from pypeit.spectrographs.util import load_spectrograph
 from pypeit import inputfiles
 
+# Writes into (or changes) the working directory, which the pytest-xdist workers share
+pytestmark = pytest.mark.xdist_group('cwd')
+
 
 def test_lris_red_multi_400():
     file_list = glob.glob(os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA', 'keck_lris_red',
@@ -5,61 +5,41 @@ Requires files in Development suite and an Environmental variable
 import os
 
 import pytest
-import glob
 
 from IPython import embed
 
 import numpy as np
 
 from pypeit.images import rawimage
-from pypeit.spectrographs.util import load_spectrograph
 from pypeit.core import procimg
 from pypeit.par.pypeitpar import ProcessImagesPar
 from pypeit import utils
 
 
-@pytest.fixture
-def deimos_flat_files():
-    # Longslit in dets 3,7
-    deimos_flat_files = [os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 'keck_deimos',
-                                      '830G_L_8400', ifile) 
-                            for ifile in ['d0914_0014.fits.gz', 'd0914_0015.fits.gz']]
-    assert len(deimos_flat_files) == 2
-    return deimos_flat_files
-
-@pytest.fixture
-def kast_blue_bias_files():
-    return glob.glob(os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 'shane_kast_blue',
-                                  '600_4310_d55', 'b1?.fits*'))
-
-@pytest.fixture
-def kast_blue_arc_file():
-    return glob.glob(os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 'shane_kast_blue',
-                                  '600_4310_d55', 'b1.fits*'))
-
-def test_instantiate(deimos_flat_files, kast_blue_bias_files):
+@pytest.mark.raw_data('keck_deimos', '830G_L_8400')
+@pytest.mark.raw_data('shane_kast_blue', '600_4310_d55')
+def test_instantiate(raw_image, deimos_flat_files, kast_blue_bias_files):
     one_file = deimos_flat_files[0]
-    spectograph = load_spectrograph('keck_deimos')
     # DEIMOS
     det = 3
-    rawImage = rawimage.RawImage(one_file, spectograph, det)
+    rawImage = raw_image('keck_deimos', one_file, det)
     # Test
     assert rawImage.datasec_img.shape == (1, 4096, 2128), 'Wrong shape'
 
     # Kast blue
     det2 = 1
     one_file = kast_blue_bias_files[0]
-    spectograph2 = load_spectrograph('shane_kast_blue')
-    rawImage2 = rawimage.RawImage(one_file, spectograph2, det2)
+    rawImage2 = raw_image('shane_kast_blue', one_file, det2)
     assert rawImage2.image.shape == (1, 350, 2112), 'Wrong shape'
 
 
-def test_overscan_subtract(deimos_flat_files):
+@pytest.mark.raw_data('keck_deimos', '830G_L_8400')
+def test_overscan_subtract(spectrograph, raw_image, deimos_flat_files):
     one_file = deimos_flat_files[0]
-    spectograph = load_spectrograph('keck_deimos')
+    spectograph = spectrograph('keck_deimos')
     # DEIMOS
     det = 3
-    rawImage = rawimage.RawImage(one_file, spectograph, det)
+    rawImage = raw_image('keck_deimos', one_file, det)
     rawImage.par = spectograph.default_pypeit_par()['scienceframe']['process']
     # Bias subtract
     pre_sub = rawImage.image.copy()
@@ -74,12 +54,13 @@ def test_overscan_subtract(deimos_flat_files):
     assert rawImage.image.shape == (1,4096,2048)
 
 
-def test_continuum_subtraction(kast_blue_arc_file):
+@pytest.mark.raw_data('shane_kast_blue', '600_4310_d55')
+def test_continuum_subtraction(spectrograph, raw_image, kast_blue_arc_file):
     one_file = kast_blue_arc_file[0]
-    spectograph = load_spectrograph('shane_kast_blue')
+    spectograph = spectrograph('shane_kast_blue')
     # Kast
     det = 1
-    rawImage = rawimage.RawImage(one_file, spectograph, det)
+    rawImage = raw_image('shane_kast_blue', one_file, det)
     defpar = spectograph.default_pypeit_par()['calibrations']['arcframe']['process']
     defpar['subtract_continuum'] = True
     rawImage.par = defpar
@@ -88,8 +69,9 @@ def test_continuum_subtraction(kast_blue_arc_file):
     # Test
     assert rawImage.steps['subtract_continuum']
 
-def test_lacosmic():
-    spec = load_spectrograph('keck_deimos')
+@pytest.mark.raw_data('keck_deimos', '1200G_M_5500')
+def test_lacosmic(spectrograph):
+    spec = spectrograph('keck_deimos')
     file = os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA', 'keck_deimos', '1200G_M_5500',
                         'd0315_45929.fits')
     par = ProcessImagesPar(use_biasimage=False, use_pixelflat=False, use_illumflat=False)
@@ -3,12 +3,12 @@ Module to run tests on SciImgStack class
 Requires files in Development suite
 """
 import os
+import copy
 
 import pytest
 import glob
 import numpy as np
 
-from pypeit.spectrographs.util import load_spectrograph
 from pypeit.images import buildimage
 from pypeit.images import pypeitimage
 from pypeit import flatfield
@@ -18,11 +18,6 @@ def data_path(filename):
     data_dir = os.path.join(os.path.dirname(__file__), 'files')
     return os.path.join(data_dir, filename)
 
-kast_blue = load_spectrograph('shane_kast_blue')
-kast_par = kast_blue.default_pypeit_par()
-keck_nires = load_spectrograph('keck_nires')
-
-
 @pytest.fixture
 def shane_kast_blue_sci_files():
     return [os.path.join(os.getenv('PYPEIT_DEV'), 
@@ -31,44 +26,21 @@ def shane_kast_blue_sci_files():
                          ifile) for ifile in ['b27.fits.gz', 
                                               'b28.fits.gz']]
 
-@pytest.fixture
-def nires_sci_files():
-    return [os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 
-                         'keck_nires', 'NIRES', ifile)
-            for ifile in ['s180604_0089.fits.gz', 
-                          's180604_0092.fits.gz']]
-
-@pytest.fixture
-def nires_bg_files():
-    return [os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA', 
-                         'keck_nires', 'NIRES', ifile)
-            for ifile in ['s180604_0090.fits.gz', 
-                          's180604_0091.fits.gz']]
-
 
-def test_proc_diff(nires_sci_files, nires_bg_files):
+@pytest.mark.raw_data('keck_nires', 'NIRES')
+def test_proc_diff(nires_sci_image, nires_bg_image, nires_science_par):
     """
     Run on near-IR frames
     """
-    # Setup
-    det = 1
-    bpm = np.zeros((2048,1024), dtype=int)
-    pixelflat = np.ones(bpm.shape, dtype=float)
-    nires_par = keck_nires.default_pypeit_par()
+    # The science and background images are processed by session fixtures, using a
+    # bpm of zeros and a pixel flat of ones with the illumination and spectral illumination
+    # corrections turned off.  The subtraction is done on a copy because the cached
+    # images are read-only.
+    sciImg = copy.deepcopy(nires_sci_image)
+    bgImg = nires_bg_image
 
-    # Sci image
-    flatImages = flatfield.FlatImages(pixelflat_norm=pixelflat)
-    nires_par['scienceframe']['process']['use_illumflat'] = False
-    nires_par['scienceframe']['process']['use_specillum'] = False
-    sciImg = buildimage.buildimage_fromlist(keck_nires, det, nires_par['scienceframe'],
-                                            nires_sci_files, bias=None, bpm=bpm,
-                                            flatimages=flatImages)
-    # Bg image
-    bgImg = buildimage.buildimage_fromlist(keck_nires, det, nires_par['scienceframe'],
-                                           nires_bg_files, bias=None, bpm=bpm,
-                                           flatimages=flatImages)
     # Difference
-    sciImg = sciImg.sub(bgImg, nires_par['scienceframe']['process'])
+    sciImg = sciImg.sub(bgImg, nires_science_par['scienceframe']['process'])
     # Test
     assert isinstance(sciImg, pypeitimage.PypeItImage)
 
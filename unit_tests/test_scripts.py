@@ -24,6 +24,9 @@ from pypeit import onespec
 from pypeit.pypeitsetup import PypeItSetup
 from pypeit.pypmsgs import PypeItError
 
+# Writes into (or changes) the working directory, which the pytest-xdist workers share
+pytestmark = pytest.mark.xdist_group('cwd')
+
 
 def test_quicklook():
     # The following needs the LRISb calibration files to be
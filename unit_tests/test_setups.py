@@ -23,6 +23,9 @@ from pypeit import pypeit
 from pypeit import pypeitsetup
 from pypeit import inputfiles
 
+# Writes into (or changes) the working directory, which the pytest-xdist workers share
+pytestmark = pytest.mark.xdist_group('cwd')
+
 
 def expected_file_extensions():
     return ['sorted']
@@ -0,0 +1,308 @@
+""" Benchmark the autoid wavelength calibration algorithms on the archived arcs in TEST_DATA.
+
+Every longslit arc (Kast, LRIS, DEIMOS) is run through each of the autoid algorithms, and the HIRES ThAr
+echelle arcs in TEST_DATA/HIREDUX through autoid.General. The wall time, peak memory, RMS and number
+of fitted lines of each run are written to a scoreboard, which can be compared with the scoreboard of
+another PypeIt version:
+
+    python benchmark_wavecalib.py --repeat 5
+    python benchmark_wavecalib.py --repeat 5 --compare scoreboard_<other version>.json
+
+The timings are the minimum and median over the repeats. The peak memory is measured in a separate run
+with tracemalloc, so that it does not slow down the timed runs.
+"""
+from __future__ import (print_function, absolute_import, division, unicode_literals)
+
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+import subprocess
+
+import numpy as np
+import h5py
+import astropy.io.fits as pyfits
+
+import pypeit
+from pypeit.core.wavecal import autoid
+
+test_arc_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TEST_DATA')
+
+# Favored parameters (should match those in the defaults)
+LONGSLIT_PAR = dict(min_ampl=1000., min_nmatch=10)
+THAR_PAR = dict(min_ampl=200., rms_threshold=0.15, toler=0.001)
+
+# The longslit arcs. wv_cen and disp are only used by semi_brute
+LONGSLIT_CASES = [
+    dict(name='LRISb_600_4000_longslit', file='lrisb_600_4000_PYPIT.json', lines=['CdI','HgI','ZnI'],
+         wv_cen=4400., disp=1.26, fidx=0, score=dict(rms=0.1, nxfit=13, nmatch=10)),
+    dict(name='LRISb_400_3400_B_PYPIT.json', file='lrisb_400_3400_B_PYPIT.json',
+         lines=['NeI', 'ArI', 'CdI', 'KrI', 'XeI', 'ZnI', 'HgI'], wv_cen=4400., disp=1.26, fidx=0,
+         score=dict(rms=0.1, nxfit=13, nmatch=10)),
+    dict(name='LRISb_400_3400_longslit', file='lrisb_400_3400_PYPIT.json',
+         lines=['NeI', 'ArI', 'CdI', 'KrI', 'XeI', 'ZnI', 'HgI'], wv_cen=4400., disp=1.26, fidx=0,
+         score=dict(rms=0.1, nxfit=13, nmatch=10)),
+    # LRISb off-center. NeI lines are seen beyond the dichroic but are ignored
+    dict(name='LRISb_600_4000_red', file='LRISb_600_LRX.hdf5', lines=['CdI','ZnI','HgI'],
+         wv_cen=5000., disp=1.26, fidx=18, score=dict(rms=0.08, nxfit=10, nmatch=10)),
+    dict(name='LRISr_600_7500_longslit', file='lrisr_600_7500_PYPIT.json', lines=['ArI','HgI','KrI','NeI','XeI'],
+         wv_cen=7000., disp=1.6, fidx=-1, score=dict(rms=0.08, nxfit=30, nmatch=50)),
+    # LRISr 900/XX00 longslit -- blue
+    dict(name='LRISr_900_XX00_longslit', file='lrisr_900_XX00_PYPIT.json',
+         lines=['ArI','HgI','KrI','NeI','XeI','CdI','ZnI'], wv_cen=5800., disp=1.08, fidx=-1,
+         score=dict(rms=0.08, nxfit=10, nmatch=10)),
+    dict(name='LRISr_400_8500_longslit', file='lrisr_400_8500_PYPIT.json', lines=['ArI','HgI','KrI','NeI','XeI'],
+         wv_cen=8000., disp=2.382, fidx=-1, score=dict(rms=0.1, nxfit=40, nmatch=40)),
+    dict(name='KASTb_600_standard', file='kastb_600_PYPIT.json', lines=['CdI','HeI','HgI'],
+         wv_cen=4400., disp=1.02, fidx=0, score=dict(rms=0.1, nxfit=13, nmatch=10)),
+    dict(name='KASTr_600_7500_standard', file='kastr_600_7500_PYPIT.json', lines=['ArI','NeI','HgI'],
+         wv_cen=6800., disp=2.345, fidx=0, score=dict(rms=0.1, nxfit=20, nmatch=20)),
+    dict(name='keck_deimos_830g_l', file='keck_deimos_830g_l_PYPIT.json', lines=['ArI', 'NeI', 'KrI', 'XeI'],
+         wv_cen=0.0, disp=1.0, fidx=0, score=dict(rms=0.1, nxfit=20, nmatch=20)),
+]
+
+LONGSLIT_ALGORITHMS = ['semi_brute', 'general']
+
+
+def load_longslit_arc(case):
+    """ Read the arc spectrum of a longslit case. """
+    spec_file = os.path.join(test_arc_path, case['file'])
+    exten = spec_file.split('.')[-1]
+    if exten == 'json':
+        with open(spec_file, 'r') as f:
+            pypit_fit = json.load(f)
+        try:
+            return np.array(pypit_fit['spec'])
+        except KeyError:
+            # New format
+            return np.array(pypit_fit['0']['spec'])
+    if exten == 'hdf5':
+        with h5py.File(spec_file, 'r') as hdf:
+            return hdf['arcs/{:d}/spec'.format(case['fidx'])][()]
+    raise ValueError('Unknown arc file format: {:s}'.format(spec_file))
+
+
+def load_thar_cases():
+    """ Read the HIRES ThAr echelle arcs and their line identifications. """
+    cases = []
+    for fn in sorted(glob.glob(os.path.join(test_arc_path, 'HIREDUX', '*aspec.fits.gz'))):
+        fx = pyfits.getdata(fn)
+        ids = pyfits.open(fn.replace('aspec.fits.gz', 'lines.fits.gz'))
+        pxs = ids[1].data['PIX']
+        wvs = ids[1].data['WV']
+        ordflxs, ordwavs, ordpixs = [], [], []
+        for order in range(fx.shape[0]):
+            if np.all(fx[order, :] == 0.0):
+                continue
+            ww = wvs[order, :] != 0.0
+            ordflxs.append(fx[order, :])
+            ordwavs.append(wvs[order, ww])
+            ordpixs.append(pxs[order, ww])
+        cases.append(dict(name=os.path.basename(fn), spec=np.array(ordflxs).T, wavid=ordwavs, pixid=ordpixs))
+    return cases
+
+
+def run_longslit(spec, case, algorithm, outroot=None):
+    """ Run an autoid algorithm on a longslit arc and return its patt_dict and final_fit dicts. """
+    if algorithm == 'semi_brute':
+        return autoid.semi_brute(spec, case['lines'], case['wv_cen'], case['disp'], outroot=outroot, **LONGSLIT_PAR)
+    if algorithm == 'general':
+        arcfitter = autoid.General(spec.reshape((spec.size, 1)), case['lines'], min_ampl=LONGSLIT_PAR['min_ampl'],
+                                   outroot=outroot, rms_threshold=case['score']['rms'])
+        return arcfitter._all_patt_dict, arcfitter._all_final_fit
+    raise ValueError('Unknown algorithm {:s}'.format(algorithm))
+
+
+def run_thar(case, outroot=None):
+    """ Run autoid.General on all of the orders of a ThAr arc and return its patt_dict and final_fit dicts. """
+    arcfitter = autoid.General(case['spec'], ['ThAr'], min_ampl=THAR_PAR['min_ampl'], outroot=outroot,
+                               rms_threshold=THAR_PAR['rms_threshold'])
+    return arcfitter.get_results()
+
+
+def grade_longslit(final_fit, case):
+    """ PASSED if the solution meets the RMS and number of lines of the case's score. """
+    fit = final_fit.get('0') if final_fit is not None else None
+    if fit is None or 'rms' not in fit:
+        return 'FAILED'
+    if fit['rms'] > case['score']['rms'] or len(fit['xfit']) < case['score']['nxfit']:
+        return 'FAILED'
+    return 'PASSED'
+
+
+def grade_thar(final_fit, case):
+    """ PASSED/n: the number of orders for which every identified line is within toler of the true ID. """
+    npassed = 0
+    norder = len(case['pixid'])
+    for order in range(norder):
+        fit = final_fit.get(str(order)) if final_fit is not None else None
+        if fit is None or 'xfit' not in fit:
+            continue
+        xfit, yfit = np.asarray(fit['xfit']), np.asarray(fit['yfit'])
+        wid = np.argmin(np.abs(case['pixid'][order][:, None] - xfit[None, :]), axis=1)
+        if np.all(np.abs(case['wavid'][order] - yfit[wid]) <= THAR_PAR['toler']):
+            npassed += 1
+    return 'PASSED {:d}/{:d}'.format(npassed, norder)
+
+
+def summarize_fit(final_fit):
+    """ Median RMS over the solved slits/orders, total number of fitted lines and number of solved slits/orders. """
+    fits = [fit for fit in (final_fit or {}).values() if fit is not None and 'rms' in fit]
+    if len(fits) == 0:
+        return None, 0, 0
+    return float(np.median([fit['rms'] for fit in fits])), int(sum(len(fit['xfit']) for fit in fits)), len(fits)
+
+
+def benchmark(run, repeat=1, measure_memory=True):
+    """
+    Time a benchmark run.
+
+    Args:
+        run (callable): Runs the benchmark and returns its final_fit dict.
+        repeat (int): Number of timed runs.
+        measure_memory (bool): Do an extra run with tracemalloc to measure the peak memory.
+
+    Returns:
+        tuple: final_fit of the last run, list of the wall times, and peak memory in MB (None if not measured).
+    """
+    times = []
+    for irep in range(repeat):
+        t0 = time.perf_counter()
+        final_fit = run()
+        times.append(time.perf_counter() - t0)
+    peak_mem = None
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            run()
+            peak_mem = tracemalloc.get_traced_memory()[1]/1024.0**2
+        finally:
+            tracemalloc.stop()
+    return final_fit, times, peak_mem
+
+
+def environment():
+    """ Versions of the software being benchmarked. """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(pypeit=pypeit.__version__, numpy=np.__version__, python=platform.python_version(),
+                machine=platform.machine(), processor=platform.processor(), node=platform.node(),
+                devsuite_commit=commit, date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+def print_scoreboard(results, reference=None):
+    """ Print the scoreboard, with the speedup relative to a reference scoreboard if given. """
+    ref = {} if reference is None else {(r['case'], r['algorithm']): r for r in reference['results']}
+    header = '{:<32s} {:<11s} {:>9s} {:>9s} {:>9s} {:>8s} {:>7s} {:>7s}  {:s}'.format(
+        'case', 'algorithm', 'min (s)', 'med (s)', 'mem (MB)', 'rms', 'nlines', 'nsolved', 'grade')
+    if reference is not None:
+        header += '  {:>8s} {:>8s}'.format('ref (s)', 'speedup')
+    print(header)
+    print('-'*len(header))
+    for r in results:
+        line = '{:<32s} {:<11s} {:>9s} {:>9s} {:>9s} {:>8s} {:>7d} {:>7d}  {:s}'.format(
+            r['case'][:32], r['algorithm'], _fmt(r['time_min'], '9.3f'), _fmt(r['time_median'], '9.3f'),
+            _fmt(r['peak_mem_mb'], '9.1f'), _fmt(r['rms'], '8.4f'), r['nlines'], r['nsolved'], r['grade'])
+        if reference is not None:
+            r_ref = ref.get((r['case'], r['algorithm']))
+            t_ref = None if r_ref is None else r_ref['time_min']
+            speedup = None if t_ref is None or r['time_min'] is None else t_ref/r['time_min']
+            line += '  {:>8s} {:>8s}'.format(_fmt(t_ref, '8.3f'), _fmt(speedup, '7.2f') + ('x' if speedup else ''))
+        print(line)
+
+
+def _fmt(value, fmt):
+    return '-' if value is None else ('{:' + fmt + '}').format(value)
+
+
+def parser(options=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--algorithms', nargs='+', default=LONGSLIT_ALGORITHMS, choices=LONGSLIT_ALGORITHMS,
+                        help='autoid algorithms to run on the longslit arcs')
+    parser.add_argument('--cases', nargs='+', default=None,
+                        help='Only run the cases whose names contain one of these strings')
+    parser.add_argument('--no_thar', action='store_true', default=False, help='Skip the HIRES ThAr arcs')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of timed runs of each case. Use several for stable timings')
+    parser.add_argument('--no_memory', action='store_true', default=False,
+                        help='Skip the extra run of each case that measures the peak memory')
+    parser.add_argument('--outfile', type=str, default=None,
+                        help='Scoreboard file to write. Defaults to scoreboard_<pypeit version>.json')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Scoreboard of another run to compare the timings with')
+    parser.add_argument('--qa_dir', type=str, default=None,
+                        help='Write the autoid QA plots to this directory. Off by default, as they slow down the runs')
+    return parser.parse_args() if options is None else parser.parse_args(options)
+
+
+def main(pargs):
+    if pargs.repeat < 1:
+        raise ValueError('--repeat must be at least 1')
+    if pargs.qa_dir is not None:
+        os.makedirs(pargs.qa_dir, exist_ok=True)
+
+    def selected(name):
+        return pargs.cases is None or any(c in name for c in pargs.cases)
+
+    def outroot(name):
+        return None if pargs.qa_dir is None else os.path.join(pargs.qa_dir, name)
+
+    results = []
+    for case in LONGSLIT_CASES:
+        if not selected(case['name']):
+            continue
+        if not os.path.isfile(os.path.join(test_arc_path, case['file'])):
+            print('Skipping {:s}: {:s} is not in TEST_DATA'.format(case['name'], case['file']))
+            continue
+        spec = load_longslit_arc(case)
+        for algorithm in pargs.algorithms:
+            print('Running {:s} with {:s}'.format(case['name'], algorithm))
+            final_fit, times, peak_mem = benchmark(
+                lambda: run_longslit(spec, case, algorithm, outroot=outroot(case['name']))[1],
+                repeat=pargs.repeat, measure_memory=not pargs.no_memory)
+            rms, nlines, nsolved = summarize_fit(final_fit)
+            results.append(dict(case=case['name'], algorithm=algorithm, nspec=spec.size, nslits=1,
+                                times=times, time_min=min(times), time_median=float(np.median(times)),
+                                peak_mem_mb=peak_mem, rms=rms, nlines=nlines, nsolved=nsolved,
+                                grade=grade_longslit(final_fit, case)))
+
+    if not pargs.no_thar:
+        for case in load_thar_cases():
+            if not selected(case['name']):
+                continue
+            print('Running {:s} with general'.format(case['name']))
+            final_fit, times, peak_mem = benchmark(lambda: run_thar(case, outroot=outroot(case['name']))[1],
+                                                   repeat=pargs.repeat, measure_memory=not pargs.no_memory)
+            rms, nlines, nsolved = summarize_fit(final_fit)
+            results.append(dict(case=case['name'], algorithm='general', nspec=case['spec'].shape[0],
+                                nslits=case['spec'].shape[1], times=times, time_min=min(times),
+                                time_median=float(np.median(times)), peak_mem_mb=peak_mem, rms=rms, nlines=nlines,
+                                nsolved=nsolved, grade=grade_thar(final_fit, case)))
+
+    scoreboard = dict(environment=environment(), repeat=pargs.repeat, results=results)
+    outfile = 'scoreboard_{:s}.json'.format(pypeit.__version__) if pargs.outfile is None else pargs.outfile
+    with open(outfile, 'w') as f:
+        json.dump(scoreboard, f, indent=2)
+
+    reference = None
+    if pargs.compare is not None:
+        with open(pargs.compare) as f:
+            reference = json.load(f)
+        print('Compared with PypeIt {:s} ({:s})'.format(reference['environment']['pypeit'],
+                                                        reference['environment']['date']))
+    print('==============================================================')
+    print_scoreboard(results, reference=reference)
+    print('Scoreboard written to {:s}'.format(outfile))
+    return 0 if all(r['grade'].startswith('PASSED') for r in results) else 1
+
+
+# Test
+if __name__ == '__main__':
+    sys.exit(main(parser()))